@@ -89,8 +89,7 @@ class ListManager(object):
         '''Checks whether a given string has the format of a valid email.
         Returns True if valid, else returns False.
         '''
-        emailRegex = '[^@]+@[^@]+\.[^@]+'
-        return True if re.match(emailRegex, str_email) else False
+        return True if RE_EMAIL.match(str_email) else False  # Pattern is precompiled in utils.py.
 
     def is_valid_listname(self, str_listname):
         """ Check if listname is valid.
@@ -186,7 +185,7 @@ class ListManager(object):
 
 app = Flask(__name__)
 sys.path.insert(0, ListManager.config['global']['global_apps_root'])  # Insert parent dir into path.
-from utils import dec_err_handler  # utils.py is a shared resource across webapps.
+from utils import dec_err_handler, RE_EMAIL  # utils.py is a shared resource across webapps.
 
 
 @app.route('/')
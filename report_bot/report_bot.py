@@ -12,17 +12,32 @@ import smtplib
 import pysftp
 import shutil
 import time
+import io
+import stat
+import json
+import threading
+import contextlib
+import tempfile
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+from urllib.parse import urljoin
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email import encoders
 
-from utils import dec_err_handler, get_curr_time_as_string, get_date_ranges, get_files
+from utils import dec_err_handler, get_curr_time_as_string, get_date_ranges, get_files, FrameBuilder, UniqueKeyFilter, \
+    classify_emails, RE_EMAIL, L_EMAIL_LABELS, write_xlsx_streaming, write_csv_zip, wait_for_downloads
 from selenium.webdriver.common.action_chains import ActionChains
 
 
 class ReportBot(object):
     config = ConfigObj('C:/webapps/report_bot/report_bot.conf')
+    # Run-scoped dataset cache. Shared by all ReportBot instances in the same process, ie: one scheduler run.
+    # Key is a tuple of (<source name>, <parameters>...). eg: ('opera_sftp', '2019-05-01', '2019-05-31').
+    di_run_cache = {}
     # SMTP = config['smtp']  # dict structure containing data related to mail server.
     # MAIL_SERVER = config['smtp']['mail_server']
     # PORT = config['smtp']['port']
@@ -102,6 +117,56 @@ class ReportBot(object):
             handler.close()
             self.logger.removeHandler(handler)
 
+    def get_dataset(self, tup_key, func_load):
+        """ Returns the dataset for tup_key from the run-scoped cache, loading it with func_load() on first request.
+        A second report bot asking for the same source and parameters in the same run gets the same object at no cost.
+        Note: Cached objects are shared. Callers must not modify them in place.
+        :param tup_key: Tuple of (<source name>, <parameters>...). eg: ('opera_sftp', str_dt_from, str_dt_to).
+        :param func_load: Function taking no arguments, which returns the dataset.
+        :return: The dataset.
+        """
+        if tup_key in ReportBot.di_run_cache:
+            self.logger.info('[RUN CACHE] HIT: {}'.format(tup_key))
+        else:
+            self.logger.info('[RUN CACHE] MISS: {}'.format(tup_key))
+            ReportBot.di_run_cache[tup_key] = func_load()
+        return ReportBot.di_run_cache[tup_key]
+
+    @classmethod
+    def clear_run_cache(cls):
+        """ Empties the run-scoped dataset cache, to free up memory once no more reports need the cached datasets.
+        """
+        ReportBot.di_run_cache.clear()
+
+    def write_attachment(self, df, str_fp_out, str_report):
+        """ Writes df to a file, to be sent as an email attachment. XLSX files are written with a constant-memory streaming writer.
+        Per-report settings are in the [attachments] section of the CONF file, in a sub-section named str_report. eg:
+            [attachments]
+            [[op_email_list]]
+            max_xlsx_rows = 100000  # Above this number of rows, write fallback_format instead of XLSX. 0 (default) = always XLSX.
+            fallback_format = zip  # 'zip' (zipped CSV, the default) or 'csv.gz'.
+        :param df: DataFrame to write.
+        :param str_fp_out: Full path of the XLSX file. If the fallback format is used, the extension is changed accordingly.
+        :param str_report: Name of the report. eg: 'op_email_list', 'str_perf'.
+        :return: Full path of the file actually written.
+        """
+        di_conf = self.config.get('attachments', {}).get(str_report, {})
+        i_max_xlsx_rows = int(di_conf.get('max_xlsx_rows', 0))
+        str_fallback_format = di_conf.get('fallback_format', 'zip')
+
+        if i_max_xlsx_rows and (len(df) > i_max_xlsx_rows):
+            str_fp_base = os.path.splitext(str_fp_out)[0]
+            if str_fallback_format == 'csv.gz':
+                str_fp_out = str_fp_base + '.csv.gz'
+                df.to_csv(str_fp_out, index=False, compression='gzip')
+            else:
+                str_fp_out = str_fp_base + '.zip'
+                write_csv_zip(df, str_fp_out)
+            self.logger.info('[write_attachment] {} rows exceeds {} for XLSX. Wrote {}'.format(len(df), i_max_xlsx_rows, str_fp_out))
+        else:
+            write_xlsx_streaming(df, str_fp_out)
+        return str_fp_out
+
     def build_body(self, str_template_file, di_params=None):
         templateLoader = jinja2.FileSystemLoader(searchpath=self.config['global']['global_templates'])
         templateEnv = jinja2.Environment(loader=templateLoader)
@@ -112,8 +177,7 @@ class ReportBot(object):
         '''Checks whether a given string has the format of a valid email.
         Returns True if valid, else returns False.
         '''
-        emailRegex = '[^@]+@[^@]+\.[^@]+'
-        return True if re.match(emailRegex, str_email) else False
+        return True if RE_EMAIL.match(str_email) else False  # Pattern is precompiled in utils.py.
 
 
 class AdminReportBot(ReportBot):
@@ -184,14 +248,460 @@ class AdminReportBot(ReportBot):
         self.logger.info('Sent email with subject "{}"'.format(str_subject))
 
 
+class STRSession(object):
+    """ A logged-in browser session on STR ReportsOnline, reused for all the STAR report downloads of a run.
+    Logs in once. If the session drops (eg: STR logs us out, or the browser dies), open_reports_page() logs in again.
+    Usage:
+        with STRSession(str_rb) as session:
+            str_rb.download_rpt_basic_perf_01(str_dt_from, str_dt_to, session=session)
+            ...
+    """
+    STR_URL = 'https://clients.str.com/ReportsOnline.aspx'
+
+    def __init__(self, str_rb, str_download_folder=None, is_headless=None):
+        """ :param str_rb: STRReportBot, for its config, logger, and wait_for_xpath().
+        :param str_download_folder: Folder where the browser saves downloads (set through the browser preferences).
+        Defaults to the run's temp folder. See STRReportBot.get_str_download_folder().
+        :param is_headless: If True, run the browser without a window. Defaults to "headless" in [data_sources][str] (True).
+        """
+        self.str_rb = str_rb
+        self.str_download_folder = str_rb.get_str_download_folder() if str_download_folder is None else str_download_folder
+        if is_headless is None:
+            is_headless = str(str_rb.config['data_sources']['str'].get('headless', 'True')).lower() == 'true'
+        self.is_headless = is_headless
+        # URL can be changed in the CONF file ("url" in [data_sources][str]). eg: To a local stand-in server for testing.
+        self.str_url = str_rb.config['data_sources']['str'].get('url', self.STR_URL)
+        self.driver = None
+        self.i_logins = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.quit()
+
+    def start(self):
+        """ Starts the browser, and logs in.
+        """
+        from selenium import webdriver
+
+        # Path to chromedriver executable. Get latest versions from https://sites.google.com/a/chromium.org/chromedriver/downloads. Also see http://chromedriver.chromium.org/downloads/version-selection
+        config = self.str_rb.config
+        str_fn_chromedriver = os.path.join(config['global']['global_bin'], config['chromedriver']['exe_name'])
+        options = webdriver.ChromeOptions()
+        if self.is_headless:
+            options.add_argument('--headless')
+            options.add_argument('--window-size=1920,1080')  # Some page elements are not clickable in the small default window.
+        options.add_experimental_option('prefs', {'download.default_directory': os.path.abspath(self.str_download_folder),
+                                                  'download.prompt_for_download': False,
+                                                  'download.directory_upgrade': True,
+                                                  'safebrowsing.enabled': True})
+        self.driver = webdriver.Chrome(executable_path=str_fn_chromedriver, options=options)
+        if self.is_headless:
+            # Headless Chrome blocks downloads, unless allowed explicitly.
+            self.driver.execute_cdp_cmd('Page.setDownloadBehavior', {'behavior': 'allow',
+                                                                     'downloadPath': os.path.abspath(self.str_download_folder)})
+        self.driver.get(self.str_url)
+        self.login()
+
+    def login(self):
+        """ Fills in and submits the login form. Assumes that the browser is on the login page.
+        """
+        config = self.str_rb.config
+        input_email = self.driver.find_element_by_xpath('//*[@id="username"]')
+        input_email.send_keys(config['data_sources']['str']['userid'])
+        input_password = self.driver.find_element_by_xpath('//*[@id="password"]')
+        input_password.send_keys(config['data_sources']['str']['password'])
+        input_password.submit()  # Walks up the tree until it finds the enclosing Form, and submits that. http://selenium-python.readthedocs.io/navigating.html
+        self.i_logins += 1
+        self.str_rb.logger.info('[STRSession] Logged in to STR (login #{})'.format(self.i_logins))
+
+    def is_browser_alive(self):
+        """ True if the browser is still running and responding.
+        """
+        from selenium.common.exceptions import WebDriverException
+
+        if self.driver is None:
+            return False
+        try:
+            self.driver.window_handles  # Any command will do. Raises if the browser or chromedriver is gone.
+            return True
+        except WebDriverException:
+            return False
+
+    def open_reports_page(self):
+        """ Goes to the STAR report selection page, and returns the webdriver.
+        Starts the browser if not started, or restarts it if it has died. Logs in again if STR has logged us out.
+        """
+        if not self.is_browser_alive():
+            self.quit()
+            self.start()
+        else:
+            # Close any tabs left open by earlier downloads, then go back to the reports page in the original tab.
+            wn_handle = self.driver.window_handles[0]
+            for wn in self.driver.window_handles[1:]:
+                self.driver.switch_to.window(wn)
+                self.driver.close()
+            self.driver.switch_to.window(wn_handle)
+            self.driver.get(self.str_url)
+            if self.driver.find_elements_by_xpath('//*[@id="username"]'):  # Session dropped. Redirected to the login page.
+                self.str_rb.logger.info('[STRSession] Session dropped. Logging in again.')
+                self.login()
+
+        # Go to STAR report selection page. Waits for page to load before trying to access it.
+        self.str_rb.wait_for_xpath(self.driver, '//*[@id="menu-reports"]/a').click()
+        return self.driver
+
+    def quit(self):
+        """ Quits the browser, if started. Errors are ignored, as the browser may already be gone.
+        """
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+            self.driver = None
+
+
+class STRHttpError(Exception):
+    """ Raised by STRHttpClient when an STR page is not as expected (eg: a form or link is not found, or a page is returned
+    instead of a report). STR may have changed its pages. STRReportBot then falls back to the browser. See try_str_perf_http().
+    """
+
+
+class STRFormParser(HTMLParser):
+    """ Reads the forms of an STR page: their action, and the values a browser would post for them as they are.
+    Form elements are also indexed by element id, as the ids are what the browser automation (and STRHttpClient) refer to.
+    Also picks up the link to the STAR report selection page ("menu-reports").
+    """
+    def __init__(self):
+        super().__init__()
+        self.l_forms = []  # Format: {'action': str, 'fields': {name: value}, 'ids': {id: (name, value)}, 'options': {id: [values]}}
+        self.str_reports_href = None
+        self._is_in_menu_reports = False
+        self._select = None  # (id, name, is_multiple) of the select being read.
+
+    def handle_starttag(self, tag, attrs):
+        di_attrs = dict(attrs)
+        if di_attrs.get('id') == 'menu-reports':
+            self._is_in_menu_reports = True
+        elif (tag == 'a') and self._is_in_menu_reports:
+            self.str_reports_href = di_attrs.get('href')
+            self._is_in_menu_reports = False
+
+        if tag == 'form':
+            self.l_forms.append({'action': di_attrs.get('action') or '', 'fields': {}, 'ids': {}, 'options': {}})
+            return
+        if not self.l_forms:
+            return
+        form = self.l_forms[-1]
+        str_id = di_attrs.get('id')
+        str_name = di_attrs.get('name')
+
+        if (tag == 'input') and str_name:
+            str_type = (di_attrs.get('type') or 'text').lower()
+            str_value = di_attrs.get('value')
+            if str_value is None:
+                str_value = 'on' if str_type in ('checkbox', 'radio') else ''  # Browsers post 'on' for these, if no value.
+            form['ids'][str_id] = (str_name, str_value)
+            if str_type in ('submit', 'button', 'image', 'reset'):
+                return  # Only posted when clicked.
+            if (str_type in ('checkbox', 'radio')) and ('checked' not in di_attrs):
+                return  # Only posted when checked.
+            form['fields'][str_name] = str_value
+        elif (tag == 'select') and str_name:
+            self._select = (str_id, str_name, 'multiple' in di_attrs)
+            form['ids'][str_id] = (str_name, None)
+            form['options'][str_id] = []
+            form['fields'][str_name] = [] if self._select[2] else None
+        elif (tag == 'option') and (self._select is not None):
+            str_id, str_name, is_multiple = self._select
+            str_value = di_attrs.get('value') or ''
+            form['options'][str_id].append(str_value)
+            if is_multiple:
+                if 'selected' in di_attrs:
+                    form['fields'][str_name].append(str_value)
+            elif ('selected' in di_attrs) or (form['fields'][str_name] is None):  # Single select defaults to its first option.
+                form['fields'][str_name] = str_value
+
+    def handle_endtag(self, tag):
+        if (tag == 'select') and (self._select is not None):
+            if self.l_forms[-1]['fields'][self._select[1]] is None:  # No options.
+                del self.l_forms[-1]['fields'][self._select[1]]
+            self._select = None
+
+    def get_form(self, str_id):
+        """ Returns the form holding the element with id str_id. None if not found.
+        """
+        for form in self.l_forms:
+            if str_id in form['ids']:
+                return form
+        return None
+
+
+class STRHttpClient(object):
+    """ Downloads the STR STAR reports over plain HTTP, by posting the forms of STR ReportsOnline without a browser.
+    Has the same report methods and arguments as the download_rpt_basic_perf_* methods of STRReportBot, except for the browser
+    session. But they return the XLS files as bytes, instead of saving them to the download folder.
+    read_rpt_basic_perf_01() parses these straight from memory, so nothing is written to disk.
+    Logs in once. If the session drops (eg: STR logs us out), get_reports_form() logs in again.
+    Form elements are found by the same element ids as the browser automation uses. So the browser path (STRSession) is the
+    fallback if STR changes its pages. See STRReportBot.get_str_perf_http().
+    Usage:
+        with STRHttpClient(str_rb) as client:
+            bytes_xls = client.download_rpt_basic_perf_01a(str_dt_from, str_dt_to)
+    """
+    STR_URL = STRSession.STR_URL
+    # Values of the industry segments in the multiselect "sSelectGrp2Segment".
+    DI_IND_SEGMENTS = {'upscale': 'Market Class: Singapore - Upscale Class',
+                       'upper_upscale': 'Market Class: Singapore - Upper Upscale Class'}
+
+    def __init__(self, str_rb):
+        """ :param str_rb: STRReportBot, for its config and logger.
+        """
+        self.str_rb = str_rb
+        # URL can be changed in the CONF file ("url" in [data_sources][str]). eg: To a local stand-in server for testing.
+        self.str_url = str_rb.config['data_sources']['str'].get('url', self.STR_URL)
+        self.f_timeout = float(str_rb.config['data_sources']['str'].get('page_timeout', 30))
+        self.http = None
+        self.str_reports_url = None
+        self.i_logins = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.quit()
+
+    def start(self):
+        """ Starts the HTTP session, and logs in.
+        """
+        import requests
+
+        self.http = requests.Session()
+        self.login(self.request('get', self.str_url))
+
+    def request(self, str_method, str_url, **kwargs):
+        """ Sends a GET or POST in the session, and returns the response. Raises on an HTTP error status.
+        """
+        resp = self.http.request(str_method, str_url, timeout=self.f_timeout, **kwargs)
+        resp.raise_for_status()
+        return resp
+
+    @staticmethod
+    def parse(resp):
+        parser = STRFormParser()
+        parser.feed(resp.text)
+        parser.close()
+        return parser
+
+    def login(self, resp):
+        """ Fills in and posts the login form. Assumes that resp is the login page.
+        Remembers the link to the STAR report selection page, from the page after the login.
+        """
+        config = self.str_rb.config
+        form = self.parse(resp).get_form('password')
+        if form is None:
+            raise STRHttpError('[STRHttpClient] Login form not found at {}'.format(resp.url))
+        di_data = dict(form['fields'])
+        di_data[form['ids']['username'][0]] = config['data_sources']['str']['userid']
+        di_data[form['ids']['password'][0]] = config['data_sources']['str']['password']
+        resp = self.request('post', urljoin(resp.url, form['action']), data=di_data)
+
+        parser = self.parse(resp)
+        if parser.get_form('password') is not None:  # Still on the login page.
+            raise STRHttpError('[STRHttpClient] Login to STR failed')
+        if parser.str_reports_href is not None:
+            self.str_reports_url = urljoin(resp.url, parser.str_reports_href)
+        if self.str_reports_url is None:
+            raise STRHttpError('[STRHttpClient] Link to the STAR reports not found at {}'.format(resp.url))
+        self.i_logins += 1
+        self.str_rb.logger.info('[STRHttpClient] Logged in to STR (login #{})'.format(self.i_logins))
+
+    def get_reports_form(self):
+        """ Gets the STAR report selection page. Returns its URL and its report form (see STRFormParser).
+        Starts the session if not started. Logs in again if STR has logged us out.
+        """
+        if self.http is None:
+            self.start()
+        resp = self.request('get', self.str_reports_url)
+        parser = self.parse(resp)
+        if parser.get_form('password') is not None:  # Session dropped. Redirected to the login page.
+            self.str_rb.logger.info('[STRHttpClient] Session dropped. Logging in again.')
+            self.login(resp)
+            resp = self.request('get', self.str_reports_url)
+            parser = self.parse(resp)
+
+        form = parser.get_form('ctl00_ContentPlaceHolder1_btnSubmit2')
+        if form is None:
+            raise STRHttpError('[STRHttpClient] STAR report form not found at {}'.format(resp.url))
+        return resp.url, form
+
+    def post_form(self, str_url, form, di_values, str_id_button):
+        """ Posts the form, as if button str_id_button was clicked after setting the elements in di_values.
+        :param di_values: dict of {<element id>: <value>}. A value of True checks a checkbox or radio button (posts its own value).
+        None unchecks it (or clears the element). A list sets the selected values of a multiselect.
+        :return: The response.
+        """
+        di_data = dict(form['fields'])  # Includes the ASP.NET hidden fields (eg: "__VIEWSTATE"), which must be posted back as is.
+        for str_id, value in di_values.items():
+            str_name, str_value = form['ids'][str_id]
+            if value is None:
+                di_data.pop(str_name, None)
+            else:
+                di_data[str_name] = str_value if value is True else value
+        str_name, str_value = form['ids'][str_id_button]
+        di_data[str_name] = str_value
+        return self.request('post', urljoin(str_url, form['action']), data=di_data)
+
+    def get_report(self, str_url, form, str_dt_from, str_dt_to, di_values):
+        """ Submits the report form for the date range, with di_values (see post_form()). Returns the XLS file as bytes.
+        """
+        di_values = dict(di_values, ctl00_ContentPlaceHolder1_txtStartDate=str_dt_from, ctl00_ContentPlaceHolder1_txtEndDate=str_dt_to)
+        resp = self.post_form(str_url, form, di_values, 'ctl00_ContentPlaceHolder1_btnSubmit2')
+        if 'html' in resp.headers.get('Content-Type', ''):  # Returned a page (eg: with a validation error), not a file.
+            raise STRHttpError('[STRHttpClient] STR returned a page instead of the report, for {}'.format(di_values))
+        return resp.content
+
+    def get_portfolio_ids(self, form, df_hotels):
+        """ Hotel ids in df_hotels which are options of the portfolio multiselect. Others are skipped, as in the browser.
+        """
+        l_options = form['options']['ctl00_ContentPlaceHolder1_sProperty']
+        return [str_id for str_id in df_hotels['str_hotel_id'].astype(str) if str_id in l_options]
+
+    def download_rpt_basic_perf_01(self, str_dt_from, str_dt_to, df_hotels=None):
+        """ STR STAR basic report by Property, for specified date range. See STRReportBot.download_rpt_basic_perf_01().
+        :param df_hotels: Defaults to STRReportBot.get_str_hotels().
+        :return: List of XLS files as bytes, one for each hotel in df_hotels.
+        """
+        if df_hotels is None:
+            df_hotels = self.str_rb.get_str_hotels()
+        l_xls = []
+        for idx, row in df_hotels.iterrows():
+            self.str_rb.logger.info('DOWNLOADING STR REPORT (PROPERTY): ' + row['str_hotel_name'])
+            str_url, form = self.get_reports_form()
+            l_xls.append(self.get_report(str_url, form, str_dt_from, str_dt_to, {'ctl00_CensusID': str(row['str_hotel_id'])}))
+        return l_xls
+
+    def download_rpt_basic_perf_01a(self, str_dt_from, str_dt_to, df_hotels=None):
+        """ STR STAR basic report for ALL portfolio properties in df_hotels, for specified date range.
+        See STRReportBot.download_rpt_basic_perf_01a().
+        :param df_hotels: Defaults to STRReportBot.get_str_hotels(is_sg_only=True), as in the browser.
+        :return: The XLS file as bytes.
+        """
+        if df_hotels is None:
+            df_hotels = self.str_rb.get_str_hotels(is_sg_only=True)
+        self.str_rb.logger.info('DOWNLOADING STR REPORT (ALL)')
+        str_url, form = self.get_reports_form()
+        return self.get_report(str_url, form, str_dt_from, str_dt_to,
+                               {'ctl00_ContentPlaceHolder1_sProperty': self.get_portfolio_ids(form, df_hotels),
+                                'ctl00_ContentPlaceHolder1_ckIncDups': None})  # Unchecked, to EXCLUDE duplicates.
+
+    def download_rpt_basic_perf_01b(self, str_dt_from, str_dt_to, str_ind_seg, df_hotels=None):
+        """ STR STAR basic report for ALL portfolio properties in df_hotels, against Industry Segment str_ind_seg
+        ('upscale' or 'upper_upscale'), for specified date range. See STRReportBot.download_rpt_basic_perf_01b().
+        :param df_hotels: Defaults to STRReportBot.get_str_hotels(is_sg_only=True), as in the browser.
+        :return: The XLS file as bytes.
+        """
+        if df_hotels is None:
+            df_hotels = self.str_rb.get_str_hotels(is_sg_only=True)
+        self.str_rb.logger.info('DOWNLOADING STR REPORT (IND_SEG: {})'.format(str_ind_seg))
+        str_url, form = self.get_reports_form()
+        di_values = {'ctl00_ContentPlaceHolder1_sProperty': self.get_portfolio_ids(form, df_hotels),
+                     'ctl00_ContentPlaceHolder1_rbIndSegment': True}  # "My industry segments" radiobutton.
+
+        # Selecting the segment is a postback, which returns the page with the segment added. The report is submitted from that page.
+        di_select = dict(di_values, ctl00_ContentPlaceHolder1_sSelectGrp2Segment=[self.DI_IND_SEGMENTS[str_ind_seg]])
+        resp = self.post_form(str_url, form, di_select, 'ctl00_ContentPlaceHolder1_btnGrp2Select')
+        form = self.parse(resp).get_form('ctl00_ContentPlaceHolder1_btnSubmit2')
+        if form is None:
+            raise STRHttpError('[STRHttpClient] STAR report form not found after selecting segment {}'.format(str_ind_seg))
+        return self.get_report(resp.url, form, str_dt_from, str_dt_to, di_values)
+
+    def quit(self):
+        """ Closes the HTTP session, if started.
+        """
+        if self.http is not None:
+            self.http.close()
+            self.http = None
+
+
 class STRReportBot(ReportBot):
+    # Columns of the "Period" line read by read_rpt_basic_perf_01(), after normalising the different STR report layouts.
+    L_STR_METRIC_COLUMNS = ['occ', 'occ_comp', 'occ_chng_pct', 'occ_comp_chng_pct', 'occ_mpi', 'occ_rank',
+                            'adr', 'adr_comp', 'adr_chng_pct', 'adr_comp_chng_pct', 'adr_ari', 'adr_rank',
+                            'revpar', 'revpar_comp', 'revpar_chng_pct', 'revpar_comp_chng_pct', 'revpar_rgi', 'revpar_rank']
+    # Schema for FrameBuilder. Metric columns are not cast, because some cells may hold text. period_name may be Categorical.
+    DI_STR_SCHEMA = dict([('hotel_code', 'object'), ('period_name', None), ('date_from', 'datetime64[ns]'),
+                          ('date_to', 'datetime64[ns]')] + [(col, None) for col in L_STR_METRIC_COLUMNS])
+
     def __init__(self):
         super().__init__()
         # INIT LOGGER #
         self._init_logger(logger_name='str_report_bot')
 
-    def __del__(self):
-        super().__del__()
+    def get_str_download_folder(self, session=None):
+        """ Folder where the browser saves the STR report downloads. That of the session, if given.
+        Otherwise a temp folder for this run, created on first use in "download_root" (in [data_sources][str] of the CONF file.
+        Defaults to the system temp folder). It is never the user's shared Downloads folder, so that only this run's files are
+        ever read, and two STR jobs can run at the same time.
+        The caller deletes it when done, with reset_str_download_folder(). send_str_perf() does so, even after an error.
+        """
+        if session is not None:
+            return session.str_download_folder
+        if getattr(self, 'str_run_folder', None) is None:
+            self.str_run_folder = tempfile.mkdtemp(prefix='str_run_',
+                                                   dir=self.config['data_sources']['str'].get('download_root') or None)
+        return self.str_run_folder
+
+    def reset_str_download_folder(self):
+        """ Deletes the run's temp download folder, with any files left in it. The next get_str_download_folder() makes a new one.
+        """
+        if getattr(self, 'str_run_folder', None) is not None:
+            shutil.rmtree(self.str_run_folder, ignore_errors=True)
+            self.str_run_folder = None
+
+    def get_str_archive_folder(self):
+        """ Folder where the downloaded STR XLS files are kept after reading, with the interim CSV of get_str_perf_weekly().
+        From "archive_folder" in [data_sources][str] of the CONF file. Defaults to 'C:/Users/feh_admin/Downloads/temp', as before.
+        Created if not there.
+        None if set to blank or "None". The downloads are then deleted after reading, and no interim CSV is written.
+        """
+        str_folder = self.config['data_sources']['str'].get('archive_folder', 'C:/Users/feh_admin/Downloads/temp')
+        if (not str_folder) or (str(str_folder).lower() == 'none'):
+            return None
+        os.makedirs(str_folder, exist_ok=True)
+        return str_folder
+
+    def wait_for_str_downloads(self, i_count, session=None):
+        """ Returns as soon as the download folder holds i_count completed XLS files. See utils.wait_for_downloads().
+        Timeout is "download_timeout" (seconds) in [data_sources][str] of the CONF file. Defaults to 120.
+        """
+        f_timeout = float(self.config['data_sources']['str'].get('download_timeout', 120))
+        return wait_for_downloads(self.get_str_download_folder(session), i_count, pattern='xls$', f_timeout=f_timeout)
+
+    def wait_for_xpath(self, driver, str_xpath):
+        """ Returns the element at str_xpath, as soon as it is clickable (eg: once the page has loaded).
+        Timeout is "page_timeout" (seconds) in [data_sources][str] of the CONF file. Defaults to 30.
+        """
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+
+        f_timeout = float(self.config['data_sources']['str'].get('page_timeout', 30))
+        return WebDriverWait(driver, f_timeout).until(EC.element_to_be_clickable((By.XPATH, str_xpath)))
+
+    @contextlib.contextmanager
+    def str_reports_page(self, session=None):
+        """ Yields a logged-in webdriver, on the STAR report selection page.
+        Uses session if given, and leaves it open. Otherwise starts a new STRSession, which is quit on exit.
+        """
+        session_own = STRSession(self) if session is None else None
+        try:
+            yield (session or session_own).open_reports_page()
+        finally:
+            if session_own is not None:
+                session_own.quit()
 
     @dec_err_handler(retries=3)
     def send_str_perf(self, str_listname='str_perf_rpt_weekly', str_type='Weekly'):
@@ -209,11 +719,8 @@ class STRReportBot(ReportBot):
         # str_listname = 'test_aa'  # DEBUG
         # print(str_listname)
 
-        # ALWAYS CLEAR DOWNLOAD FOLDER OF XLS FILES BEFORE STARTING, TO ALLOW A CLEAN RETRY AFTER EXCEPTION.
-        str_dl_folder = os.path.join(os.getenv('USERPROFILE'), 'Downloads')
-        l_str_fn_with_path = get_files(str_folder=str_dl_folder, pattern='xls$')
-        for fp, _ in l_str_fn_with_path:
-            os.remove(fp)
+        # ALWAYS START WITH A NEW, EMPTY DOWNLOAD FOLDER, TO ALLOW A CLEAN RETRY AFTER EXCEPTION.
+        self.reset_str_download_folder()
 
         str_subject = 'STR {} Report - Raw Data'.format(str_type)  # 'Weekly'/'Monthly'
         str_msg = """
@@ -247,14 +754,17 @@ class STRReportBot(ReportBot):
         l_email_recipients = df['email'].tolist()
 
         # GET DATAFRAME AND OUTPUT TO XLSX FILE #
-        if str_type == 'Weekly':
-            df_str = self.get_str_perf_weekly()
-        elif str_type == 'Monthly':
-            df_str = self.get_str_perf_monthly()
+        try:
+            if str_type == 'Weekly':
+                df_str = self.get_str_perf_weekly()
+            elif str_type == 'Monthly':
+                df_str = self.get_str_perf_monthly()
+        finally:
+            self.reset_str_download_folder()  # All downloads have been read and archived by now. After an error, none are kept.
 
         str_fn_out = 'STR_{}_Report'.format(str_type) + get_curr_time_as_string() + '.xlsx'
-        str_fp_out = 'C:/fehdw/temp/' + str_fn_out
-        df_str.to_excel(str_fp_out, index=False)
+        str_fp_out = self.write_attachment(df_str, 'C:/fehdw/temp/' + str_fn_out, str_report='str_perf')
+        str_fn_out = os.path.basename(str_fp_out)  # Extension may have changed, if the row count was over the XLSX threshold.
 
         # SEND EMAIL #
         MAIL_SERVER = self.config['smtp']['mail_server']
@@ -285,55 +795,106 @@ class STRReportBot(ReportBot):
         # Note: All sent emails will be logged. This includes emails which were sent by other applications, which leverage upon ReportBot's functionalities!
         self.logger.info('Sent email with subject "{}"'.format(str_subject))
 
-    def download_rpt_basic_perf_01(self, str_dt_from, str_dt_to):
+    def download_rpt_basic_perf_01(self, str_dt_from, str_dt_to, session=None, df_hotels=None):
         """ Downloads the STR STAR basic report by Property, for specified date range.
+        If an STRSession is given, its logged-in browser is used (and left open). Otherwise a new browser is started, and quit at the end.
         Note: OSKL is requested to be included in the individual properties, but NOT in the "ALL".
         Note 2: Total should be (11+3)x4 -> 64.
+        :param df_hotels: Hotels to download, with columns 'str_hotel_id' and 'str_hotel_name'. Defaults to get_str_hotels().
+        """
+        if df_hotels is None:
+            df_hotels = self.get_str_hotels()
+
+        # LOGIN, OR REUSE THE LOGGED-IN SESSION. GO TO STAR REPORT SELECTION PAGE # Own browser is quit on leaving the "with" block.
+        with self.str_reports_page(session) as driver:
+            wn_handle = driver.current_window_handle  # original window handle of the main browser tab.
+            i_count = len(get_files(str_folder=self.get_str_download_folder(session), pattern='xls$'))  # XLS files already downloaded.
+
+            for idx, row in df_hotels.iterrows():
+                # SELECT HOTEL IN DDLB #
+                self.logger.info('DOWNLOADING STR REPORT (PROPERTY): ' + row['str_hotel_name'])
+                str_xpath = "//*[@id='ctl00_CensusID']/option[@value='{}']".format(row['str_hotel_id'])
+
+                # el_hotel_ddlb = driver.find_element_by_xpath(
+                #     '//*[@id="ctl00_CensusID"]')  # The dropdown at the top select for hotel selection. Selecting the DDLB is different from selecting its Options!
+                el_hotel = driver.find_element_by_xpath(str_xpath)
+                el_hotel.click()
+
+                # CHANGE DATE RANGE SELECTION #
+                input_dt_from = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_txtStartDate"]')
+                input_dt_from.clear()
+                input_dt_from.send_keys(str_dt_from)
+                input_dt_to = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_txtEndDate"]')
+                input_dt_to.clear()
+                input_dt_to.send_keys(str_dt_to)
+
+                # SUBMIT #
+                driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_btnSubmit2"]').click()
+
+                # Wait for report to be downloaded before closing window below! Otherwise the XLS file may not be complete.
+                i_count += 1
+                self.wait_for_str_downloads(i_count, session=session)
+                # Switches back to the original browser tab (Note: For some reason, this will leave the new tabs opened until browser is closed)
+                for wn in driver.window_handles:
+                    if wn_handle != wn:
+                        # Close all windows other than the original one.
+                        # Switch to the window, then close it. Then later switch back to original window.
+                        driver.switch_to.window(wn)
+                        driver.close()
+                driver.switch_to.window(wn_handle)
+
+    def get_str_hotels(self, is_sg_only=False):
+        """ Returns the hotels for the STR STAR reports, as a DataFrame with columns 'str_hotel_id' and 'str_hotel_name'.
+        :param is_sg_only: If True, only the Singapore hotels (excl 'OSKL'), for the reports on the portfolio ("ALL").
         """
-        from selenium import webdriver
-        from selenium.common.exceptions import NoSuchElementException
-
         # GET LIST OF HOTELS #
-        # 11 hotels (excl VHS).
+        # 11 hotels (excl VHS). 10 hotels if is_sg_only (excl VHS, OSKL).
         # 17 May 2019: ML asked that VHS to be included, so commented out in the SQL. This covers TOH as well, because same compset as VHS.
         str_sql = """
         SELECT str_hotel_id, str_hotel_name FROM cfg_map_properties
         WHERE operator = 'feh'
         AND asset_type = 'hotel'
+        {}
         AND str_hotel_id IS NOT NULL
         -- AND cluster <> 'Sentosa'  -- Excl Sentosa hotels.
         ORDER BY str_hotel_name
-        """
-        df_hotels = pd.read_sql(str_sql, self.db_fehdw_conn)
+        """.format("AND country = 'SG'  -- Excl 'OSKL'" if is_sg_only else '')
+        return pd.read_sql(str_sql, self.db_fehdw_conn)
 
-        # Path to chromedriver executable. Get latest versions from https://sites.google.com/a/chromium.org/chromedriver/downloads. Also see http://chromedriver.chromium.org/downloads/version-selection
-        # LOGIN #
-        str_fn_chromedriver = os.path.join(self.config['global']['global_bin'], self.config['chromedriver']['exe_name'])
-        driver = webdriver.Chrome(executable_path=str_fn_chromedriver)  # NOTE: Check for presence of 'options!'.
-        driver.get('https://clients.str.com/ReportsOnline.aspx')
-        input_email = driver.find_element_by_xpath('//*[@id="username"]')
-        input_email.send_keys(self.config['data_sources']['str']['userid'])
-        input_password = driver.find_element_by_xpath('//*[@id="password"]')
-        input_password.send_keys(self.config['data_sources']['str']['password'])
-        input_password.submit()  # Walks up the tree until it finds the enclosing Form, and submits that. http://selenium-python.readthedocs.io/navigating.html
-
-        # Go to STAR report selection page.
-        time.sleep(2)  # Wait for page to load before trying to access it.
-        driver.find_element_by_xpath('//*[@id="menu-reports"]/a').click()
-
-        wn_handle = driver.current_window_handle  # original window handle of the main browser tab.
-
-        for idx, row in df_hotels.iterrows():
-            # SELECT HOTEL IN DDLB #
-            self.logger.info('DOWNLOADING STR REPORT (PROPERTY): ' + row['str_hotel_name'])
-            str_xpath = "//*[@id='ctl00_CensusID']/option[@value='{}']".format(row['str_hotel_id'])
+    def download_rpt_basic_perf_01a(self, str_dt_from, str_dt_to, session=None, df_hotels=None):
+        """ Downloads the STR STAR basic report for ALL portfolio properties, for specified date range.
+        Differs from download_rpt_basic_perf_01() in that we're running STAR report on the PORTFOLIO instead of property.
+        session: As for download_rpt_basic_perf_01().
+        :param df_hotels: Hotels of the portfolio. Defaults to get_str_hotels(is_sg_only=True). Given by the workers of
+        get_str_perf_parallel(), which must not use the database connection.
+        """
+        from selenium.common.exceptions import NoSuchElementException
 
-            # el_hotel_ddlb = driver.find_element_by_xpath(
-            #     '//*[@id="ctl00_CensusID"]')  # The dropdown at the top select for hotel selection. Selecting the DDLB is different from selecting its Options!
-            el_hotel = driver.find_element_by_xpath(str_xpath)
-            el_hotel.click()
+        self.logger.info('DOWNLOADING STR REPORT (ALL)')
 
-            # CHANGE DATE RANGE SELECTION #
+        if df_hotels is None:
+            df_hotels = self.get_str_hotels(is_sg_only=True)  # 10 hotels (excl VHS, OSKL).
+
+        # LOGIN, OR REUSE THE LOGGED-IN SESSION. GO TO STAR REPORT SELECTION PAGE # Own browser is quit on leaving the "with" block.
+        with self.str_reports_page(session) as driver:
+            for idx, row in df_hotels.iterrows():
+                # SELECT HOTELS IN MULTISELECT #
+                str_xpath = "option[@value='{}']".format(row['str_hotel_id'])
+                try:
+                    el_multiselect = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_sProperty"]')  # Focus on the multiselect (list of hotels).
+                    opt_hotel = el_multiselect.find_element_by_xpath(str_xpath)
+                except NoSuchElementException:
+                    continue  # Cannot find in the multiselect, so skip this hotel
+                if opt_hotel is not None:
+                    actions = ActionChains(driver)  # For some reason, must always re-instantiate to get new one. Otherwise cannot double-click a second time.
+                    actions.double_click(opt_hotel).perform()
+
+            # Click the "Duplicates?" checkbox if not checked already. We want to EXCLUDE duplicates by unchecking.
+            el_cb = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_ckIncDups"]')
+            if el_cb.get_attribute('checked'):
+                el_cb.click()
+
+            # # CHANGE DATE RANGE SELECTION #
             input_dt_from = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_txtStartDate"]')
             input_dt_from.clear()
             input_dt_from.send_keys(str_dt_from)
@@ -342,186 +903,73 @@ class STRReportBot(ReportBot):
             input_dt_to.send_keys(str_dt_to)
 
             # SUBMIT #
+            i_count = len(get_files(str_folder=self.get_str_download_folder(session), pattern='xls$'))  # XLS files already downloaded.
             driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_btnSubmit2"]').click()
+            self.wait_for_str_downloads(i_count + 1, session=session)  # Wait for the report to be downloaded, before quitting the browser.
 
-            # If wait time is too short, XLS file may not have finished downloading! Wait for report to be downloaded before closing window below!
-            # 4s seems too short; 10s seems okay.
-            time.sleep(10)
-            # Switches back to the original browser tab (Note: For some reason, this will leave the new tabs opened until browser is closed)
-            for wn in driver.window_handles:
-                if wn_handle != wn:
-                    # Close all windows other than the original one.
-                    # Switch to the window, then close it. Then later switch back to original window.
-                    driver.switch_to.window(wn)
-                    driver.close()
-            driver.switch_to.window(wn_handle)
-
-        # LOGOUT #
-        # driver.find_element_by_xpath('//*[@id="str-universal"]/a/i').click()  # Click the square icon.
-        # driver.find_element_by_xpath('//*[@id="um-logout"]/div/strong').click()
-        time.sleep(3)  # Wait a bit, in case the last download has not completed! Symptom is if the last download does not seem to be there.
-        driver.quit()  # Quit the browser
-
-    def download_rpt_basic_perf_01a(self, str_dt_from, str_dt_to):
-        """ Downloads the STR STAR basic report for ALL portfolio properties, for specified date range.
-        Differs from download_rpt_basic_perf_01() in that we're running STAR report on the PORTFOLIO instead of property.
-        """
-        from selenium import webdriver
-        from selenium.common.exceptions import NoSuchElementException
-
-        self.logger.info('DOWNLOADING STR REPORT (ALL)')
-
-        # GET LIST OF HOTELS #
-        # 10 hotels (excl VHS, OSKL).
-        # 17 May 2019: ML asked that VHS to be included, so commented out in the SQL. This covers TOH as well, because same compset as VHS.
-        str_sql = """
-        SELECT str_hotel_id, str_hotel_name FROM cfg_map_properties
-        WHERE operator = 'feh'
-        AND asset_type = 'hotel'
-        AND country = 'SG'  -- Excl 'OSKL'
-        AND str_hotel_id IS NOT NULL
-        -- AND cluster <> 'Sentosa'  -- Excl Sentosa hotels.
-        ORDER BY str_hotel_name
-        """
-        df_hotels = pd.read_sql(str_sql, self.db_fehdw_conn)
-
-        # Path to chromedriver executable. Get latest versions from https://sites.google.com/a/chromium.org/chromedriver/downloads
-        # LOGIN #
-        str_fn_chromedriver = os.path.join(self.config['global']['global_bin'], self.config['chromedriver']['exe_name'])
-        driver = webdriver.Chrome(executable_path=str_fn_chromedriver)  # NOTE: Check for presence of 'options!'.
-        driver.get('https://clients.str.com/ReportsOnline.aspx')
-        input_email = driver.find_element_by_xpath('//*[@id="username"]')
-        input_email.send_keys(self.config['data_sources']['str']['userid'])
-        input_password = driver.find_element_by_xpath('//*[@id="password"]')
-        input_password.send_keys(self.config['data_sources']['str']['password'])
-        input_password.submit()  # Walks up the tree until it finds the enclosing Form, and submits that. http://selenium-python.readthedocs.io/navigating.html
-
-        # Go to STAR report selection page.
-        time.sleep(2)  # Wait for page to load before trying to access it.
-        driver.find_element_by_xpath('//*[@id="menu-reports"]/a').click()
-
-        for idx, row in df_hotels.iterrows():
-            # SELECT HOTELS IN MULTISELECT #
-            str_xpath = "option[@value='{}']".format(row['str_hotel_id'])
-            try:
-                el_multiselect = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_sProperty"]')  # Focus on the multiselect (list of hotels).
-                opt_hotel = el_multiselect.find_element_by_xpath(str_xpath)
-            except NoSuchElementException:
-                continue  # Cannot find in the multiselect, so skip this hotel
-            if opt_hotel is not None:
-                actions = ActionChains(driver)  # For some reason, must always re-instantiate to get new one. Otherwise cannot double-click a second time.
-                actions.double_click(opt_hotel).perform()
-
-        # Click the "Duplicates?" checkbox if not checked already. We want to EXCLUDE duplicates by unchecking.
-        el_cb = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_ckIncDups"]')
-        if el_cb.get_attribute('checked'):
-            el_cb.click()
-
-        # # CHANGE DATE RANGE SELECTION #
-        input_dt_from = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_txtStartDate"]')
-        input_dt_from.clear()
-        input_dt_from.send_keys(str_dt_from)
-        input_dt_to = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_txtEndDate"]')
-        input_dt_to.clear()
-        input_dt_to.send_keys(str_dt_to)
-
-        # SUBMIT #
-        driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_btnSubmit2"]').click()
-
-        # LOGOUT #
-        # driver.find_element_by_xpath('//*[@id="str-universal"]/a/i').click()  # Click the square icon.
-        # driver.find_element_by_xpath('//*[@id="um-logout"]/div/strong').click()
-        time.sleep(10)  # Wait a bit, in case the last download has not completed! Symptom is if the last download does not seem to be there.
-        driver.quit()  # Quit the browser
-
-    def download_rpt_basic_perf_01b(self, str_dt_from, str_dt_to, str_ind_seg):
+    def download_rpt_basic_perf_01b(self, str_dt_from, str_dt_to, str_ind_seg, session=None, df_hotels=None):
         """ Downloads the STR STAR basic report for ALL portfolio properties, for specified date range.
         Differs from download_rpt_basic_perf_01a(). This one compares the 3 metrics against Industry Segment rather than against compset.
+        session, df_hotels: As for download_rpt_basic_perf_01a().
         """
-        from selenium import webdriver
         from selenium.common.exceptions import NoSuchElementException
 
         self.logger.info('DOWNLOADING STR REPORT (IND_SEG: {})'.format(str_ind_seg))
 
-        # GET LIST OF HOTELS #
-        # 10 hotels (excl VHS, OSKL).
-        # 17 May 2019: ML asked that VHS to be included, so commented out in the SQL. This covers TOH as well, because same compset as VHS.
-        str_sql = """
-        SELECT str_hotel_id, str_hotel_name FROM cfg_map_properties
-        WHERE operator = 'feh'
-        AND asset_type = 'hotel'
-        AND country = 'SG'  -- Excl 'OSKL'
-        AND str_hotel_id IS NOT NULL
-        -- AND cluster <> 'Sentosa'  -- Excl Sentosa hotels.
-        ORDER BY str_hotel_name
-        """
-        df_hotels = pd.read_sql(str_sql, self.db_fehdw_conn)
-
-        # Path to chromedriver executable. Get latest versions from https://sites.google.com/a/chromium.org/chromedriver/downloads
-        # LOGIN #
-        str_fn_chromedriver = os.path.join(self.config['global']['global_bin'], self.config['chromedriver']['exe_name'])
-        driver = webdriver.Chrome(executable_path=str_fn_chromedriver)  # NOTE: Check for presence of 'options!'.
-        driver.get('https://clients.str.com/ReportsOnline.aspx')
-        input_email = driver.find_element_by_xpath('//*[@id="username"]')
-        input_email.send_keys(self.config['data_sources']['str']['userid'])
-        input_password = driver.find_element_by_xpath('//*[@id="password"]')
-        input_password.send_keys(self.config['data_sources']['str']['password'])
-        input_password.submit()  # Walks up the tree until it finds the enclosing Form, and submits that. http://selenium-python.readthedocs.io/navigating.html
-
-        # Go to STAR report selection page.
-        time.sleep(2)  # Wait for page to load before trying to access it.
-        driver.find_element_by_xpath('//*[@id="menu-reports"]/a').click()
+        if df_hotels is None:
+            df_hotels = self.get_str_hotels(is_sg_only=True)  # 10 hotels (excl VHS, OSKL).
+
+        # LOGIN, OR REUSE THE LOGGED-IN SESSION. GO TO STAR REPORT SELECTION PAGE # Own browser is quit on leaving the "with" block.
+        with self.str_reports_page(session) as driver:
+            for idx, row in df_hotels.iterrows():
+                # SELECT HOTELS IN MULTISELECT #
+                str_xpath = "option[@value='{}']".format(row['str_hotel_id'])
+                try:
+                    el_multiselect = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_sProperty"]')  # Focus on the multiselect (list of hotels).
+                    opt_hotel = el_multiselect.find_element_by_xpath(str_xpath)
+                except NoSuchElementException:
+                    continue  # Cannot find in the multiselect, so skip this hotel
+                if opt_hotel is not None:
+                    actions = ActionChains(driver)  # For some reason, must always re-instantiate to get new one. Otherwise cannot double-click a second time.
+                    actions.double_click(opt_hotel).perform()
+
+            # Click "My industry segments" radiobutton.
+            driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_rbIndSegment"]').click()
+
+            if str_ind_seg == 'upscale':
+                driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_sSelectGrp2Segment"]/option[@value="Market Class: Singapore - Upscale Class"]').click()
+                driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_btnGrp2Select"]').click()
+            elif str_ind_seg == 'upper_upscale':
+                driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_sSelectGrp2Segment"]/option[@value="Market Class: Singapore - Upper Upscale Class"]').click()
+                driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_btnGrp2Select"]').click()
+
+            # # CHANGE DATE RANGE SELECTION #
+            input_dt_from = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_txtStartDate"]')
+            input_dt_from.clear()
+            input_dt_from.send_keys(str_dt_from)
+            input_dt_to = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_txtEndDate"]')
+            input_dt_to.clear()
+            input_dt_to.send_keys(str_dt_to)
 
-        for idx, row in df_hotels.iterrows():
-            # SELECT HOTELS IN MULTISELECT #
-            str_xpath = "option[@value='{}']".format(row['str_hotel_id'])
-            try:
-                el_multiselect = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_sProperty"]')  # Focus on the multiselect (list of hotels).
-                opt_hotel = el_multiselect.find_element_by_xpath(str_xpath)
-            except NoSuchElementException:
-                continue  # Cannot find in the multiselect, so skip this hotel
-            if opt_hotel is not None:
-                actions = ActionChains(driver)  # For some reason, must always re-instantiate to get new one. Otherwise cannot double-click a second time.
-                actions.double_click(opt_hotel).perform()
-
-        # Click "My industry segments" radiobutton.
-        driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_rbIndSegment"]').click()
-
-        if str_ind_seg == 'upscale':
-            driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_sSelectGrp2Segment"]/option[@value="Market Class: Singapore - Upscale Class"]').click()
-            driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_btnGrp2Select"]').click()
-        elif str_ind_seg == 'upper_upscale':
-            driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_sSelectGrp2Segment"]/option[@value="Market Class: Singapore - Upper Upscale Class"]').click()
-            driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_btnGrp2Select"]').click()
-
-        # # CHANGE DATE RANGE SELECTION #
-        input_dt_from = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_txtStartDate"]')
-        input_dt_from.clear()
-        input_dt_from.send_keys(str_dt_from)
-        input_dt_to = driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_txtEndDate"]')
-        input_dt_to.clear()
-        input_dt_to.send_keys(str_dt_to)
-
-        # SUBMIT #
-        driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_btnSubmit2"]').click()
-
-        # LOGOUT #
-        # driver.find_element_by_xpath('//*[@id="str-universal"]/a/i').click()  # Click the square icon.
-        # driver.find_element_by_xpath('//*[@id="um-logout"]/div/strong').click()
-        time.sleep(12)  # Wait a bit, in case the last download has not completed! Symptom is if the last download does not seem to be there.
-        driver.quit()  # Quit the browser
+            # SUBMIT #
+            i_count = len(get_files(str_folder=self.get_str_download_folder(session), pattern='xls$'))  # XLS files already downloaded.
+            driver.find_element_by_xpath('//*[@id="ctl00_ContentPlaceHolder1_btnSubmit2"]').click()
+            self.wait_for_str_downloads(i_count + 1, session=session)  # Wait for the report to be downloaded, before quitting the browser.
 
     def read_rpt_basic_perf_01(self, str_fn, str_dt_from, str_dt_to, str_period_name):
         """ Given an XLS file, read the pre-prescribed line of data. Obtain only the row of data in the "Period" line.
         Basically, we want to get all columns of data, for the "Period" line.
         Note: "str_hotel_id" is translated to "hotel_code" through the mapping table cfg_map_properties.
-        :param str_fn: The STR STAR report XLS file to read.
+        :param str_fn: The STR STAR report XLS file to read. Either its path, or its content as bytes (eg: from STRHttpClient).
         :param str_dt_from: Used only to demarcate period start/end.
         :param str_dt_to: Used only to demarcate period start/end.
         :param str_period_name: Used to indicate what this period is (eg: "MTD", "YTD").
         :return:
         """
-        df = pd.read_excel(str_fn, skiprows=1, nrows=1, header=None)  # Second row of the STR report contains the keys we want.
+        def read_excel(**kwargs):  # File content is wrapped anew for each read, as each read consumes the buffer.
+            return pd.read_excel(io.BytesIO(str_fn) if isinstance(str_fn, bytes) else str_fn, **kwargs)
+
+        df = read_excel(skiprows=1, nrows=1, header=None)  # Second row of the STR report contains the keys we want.
 
         str_hotel_name_row = df[1][0]
         if str_hotel_name_row.count('#') > 1:  # If there are multiple '#' in the raw string, means there are multiple hotels, ie: not for a single property.
@@ -543,7 +991,7 @@ class STRReportBot(ReportBot):
         # Cater for "Industry Segment" report rather than by compset.
         # Note: Do NOT use "else" clause here -- if str_hotel_code is anyway other than expected values, the insertions will not take place and code will crash (expecting EXACTLY 18 columns!).
         if str_hotel_code == 'ALL':
-            df = pd.read_excel(str_fn, skiprows=2, nrows=1, header=None)  # Third row of the STR report contains the keys we want.
+            df = read_excel(skiprows=2, nrows=1, header=None)  # Third row of the STR report contains the keys we want.
             str_cell = df[1][0]
             if str_cell == 'Industry: Market Class: Singapore - Upscale':  # SEARCH STRING!
                 str_hotel_code = 'ALL_UPSC'
@@ -551,7 +999,7 @@ class STRReportBot(ReportBot):
                 str_hotel_code = 'ALL_UPPER_UPSC'
 
         # GET PERIOD LINE's ALL DATA #
-        df = pd.read_excel(str_fn, skiprows=6)
+        df = read_excel(skiprows=6)
         df = df[df['Date'] == 'Period']  # "Period" line.
         df.dropna(axis=1, inplace=True)  # Drop blank columns
         df.drop(['Date'], axis=1, inplace=True)
@@ -583,9 +1031,7 @@ class STRReportBot(ReportBot):
             df.insert(4, column='occ_mpi', value=np.nan)
             df.insert(5, column='occ_rank', value=np.nan)
 
-        df.columns = ['occ', 'occ_comp', 'occ_chng_pct', 'occ_comp_chng_pct', 'occ_mpi', 'occ_rank',
-                      'adr', 'adr_comp', 'adr_chng_pct', 'adr_comp_chng_pct', 'adr_ari', 'adr_rank',
-                      'revpar', 'revpar_comp', 'revpar_chng_pct', 'revpar_comp_chng_pct', 'revpar_rgi', 'revpar_rank']
+        df.columns = self.L_STR_METRIC_COLUMNS
 
         # Insert additional columns at the front of dataframe. These are key columns.
         df.insert(loc=0, column='hotel_code', value=str_hotel_code)
@@ -605,21 +1051,22 @@ class STRReportBot(ReportBot):
         :param str_dir_target: If provided, will copy the downloaded files from STR to here, before deleting the originals.
         :return: DataFrame containing all "Period" lines (10+1) for a specific period (str_period_name).
         """
-        # By default, download directory is the 'Downloads' folder of the user.
+        # By default, download directory is the run's temp download folder.
         if str_dir_src is None:
-            str_dl_folder = os.path.join(os.getenv('USERPROFILE'), 'Downloads')
+            str_dl_folder = self.get_str_download_folder()
         else:
             str_dl_folder = str_dir_src
 
         l_str_fn_with_path = get_files(str_folder=str_dl_folder, pattern='xls$')  # Filenames can start with 'Cmp_Daily*" or "STR_OnlineReport*"
 
-        df_all = DataFrame()
+        fb_all = FrameBuilder(di_schema=self.DI_STR_SCHEMA)
         for str_fn_with_path, _ in l_str_fn_with_path:
             self.logger.info('READING FILE: ' + str_fn_with_path)
             df = self.read_rpt_basic_perf_01(str_fn_with_path, str_dt_from, str_dt_to, str_period_name)
-            df_all = df_all.append(df)
+            fb_all.add(df)
+        df_all = fb_all.build()
 
-        # Downloaded files from STR will always be deleted. Copy files to str_dir_target if specified. eg: to 'C:/Users/feh_admin/Downloads/temp'
+        # Downloaded files from STR will always be deleted. Copy files to str_dir_target if specified. eg: to get_str_archive_folder()
         # Deletion must always happen after use, because there could be another download from STR for a different period, immediately after this! (Note: this is unlikely to be thread-safe!)
         if str_dir_target is not None:
             for str_fn_with_path, str_fn in l_str_fn_with_path:
@@ -644,38 +1091,48 @@ class STRReportBot(ReportBot):
         self.logger.info('[get_str_perf_weekly] STARTING RUN')
 
         di_periods = get_date_ranges(l_periods=['P07D', 'MTD', 'P90D', 'YTD'])  # str_dt_ref defaults to current date.
-        df_all = DataFrame()
+        df_all = self.try_str_perf_http(di_periods)
+        if df_all is not None:
+            return df_all
+        if self.get_str_max_workers() > 1:
+            return self.get_str_perf_parallel(di_periods)
+        fb_all = FrameBuilder(di_schema=self.DI_STR_SCHEMA)
+        str_dir_archive = self.get_str_archive_folder()
+        if str_dir_archive is not None:  # Interim output. See below.
+            str_temp_fn = os.path.join(str_dir_archive, 'df_all' + get_curr_time_as_string() + '.csv')
 
         # For each period, download the 10 + 1 (hotels + ALL) XLS files.
-        for str_period_name, v in di_periods.items():
-            self.logger.info('Processing for period type: {} {}'.format(str_period_name, v))
+        # One browser session (one login) for all downloads of all periods. See STRSession.
+        with STRSession(self) as session:
+            for str_period_name, v in di_periods.items():
+                self.logger.info('Processing for period type: {} {}'.format(str_period_name, v))
 
-            # DOWNLOAD FILES FOR PERIOD #
-            self.download_rpt_basic_perf_01(str_dt_from=v[0], str_dt_to=v[1])   # Individual Hotels
-            self.logger.info('COMPLETED: download_rpt_basic_perf_01')
-            time.sleep(3)  # Add delay between each call. Fight against ('Connection aborted.', ConnectionResetError(10054, 'An existing connection was forcibly closed by the remote host', None, 10054, None)
+                # DOWNLOAD FILES FOR PERIOD #
+                self.download_rpt_basic_perf_01(str_dt_from=v[0], str_dt_to=v[1], session=session)   # Individual Hotels
+                self.logger.info('COMPLETED: download_rpt_basic_perf_01')
 
-            self.download_rpt_basic_perf_01a(str_dt_from=v[0], str_dt_to=v[1])  # "ALL"
-            self.logger.info('COMPLETED: download_rpt_basic_perf_01a')
-            time.sleep(3)
+                self.download_rpt_basic_perf_01a(str_dt_from=v[0], str_dt_to=v[1], session=session)  # "ALL"
+                self.logger.info('COMPLETED: download_rpt_basic_perf_01a')
 
-            self.download_rpt_basic_perf_01b(str_dt_from=v[0], str_dt_to=v[1], str_ind_seg='upscale')
-            self.logger.info('COMPLETED: download_rpt_basic_perf_01b - upscale')
-            time.sleep(3)
+                self.download_rpt_basic_perf_01b(str_dt_from=v[0], str_dt_to=v[1], str_ind_seg='upscale',
+                                                   session=session)
+                self.logger.info('COMPLETED: download_rpt_basic_perf_01b - upscale')
 
-            self.download_rpt_basic_perf_01b(str_dt_from=v[0], str_dt_to=v[1], str_ind_seg='upper_upscale')
-            self.logger.info('COMPLETED: download_rpt_basic_perf_01b - upper_upscale')
-            time.sleep(3)
+                self.download_rpt_basic_perf_01b(str_dt_from=v[0], str_dt_to=v[1], str_ind_seg='upper_upscale',
+                                                   session=session)
+                self.logger.info('COMPLETED: download_rpt_basic_perf_01b - upper_upscale')
 
-            # READ FILES #
-            df = self.read_rpt_basic_perf_01_all(str_dt_from=v[0], str_dt_to=v[1], str_period_name=str_period_name,
-                                                 str_dir_src=None, str_dir_target='C:/Users/feh_admin/Downloads/temp')
-            df_all = df_all.append(df)
+                # READ FILES #
+                df = self.read_rpt_basic_perf_01_all(str_dt_from=v[0], str_dt_to=v[1], str_period_name=str_period_name,
+                                                     str_dir_src=None, str_dir_target=str_dir_archive)
+                fb_all.add(df)
 
-            # Interim output of df_all. So that if fails mid-way, the costly processing is not wasted. Can just read the CSV and continue.
-            str_temp_fn = 'C:/Users/feh_admin/Downloads/temp/df_all' + get_curr_time_as_string() + '.csv'
-            df_all.to_csv(str_temp_fn, index=False)
+                # Interim output of df_all. So that if fails mid-way, the costly processing is not wasted. Can just read the CSV and continue.
+                # Each period's rows are appended to the same CSV file, so it always holds all the periods done so far.
+                if str_dir_archive is not None:
+                    df.to_csv(str_temp_fn, index=False, mode='a', header=not os.path.isfile(str_temp_fn))
 
+        df_all = fb_all.build()
         # Sort again, because we appended period-by-period, so it's not in our desired sort order!
         df_all.sort_values(by=['hotel_code', 'period_name'], inplace=True)
         df_all.reset_index(drop=True, inplace=True)
@@ -693,49 +1150,315 @@ class STRReportBot(ReportBot):
         # Reference date to be set as the 1st day of the current month.
         str_dt_ref = dt.datetime.today().date().replace(day=1).strftime(format='%Y-%m-%d')
         di_periods = get_date_ranges(str_dt_ref=str_dt_ref, l_periods=['P07D', 'MTD', 'P90D', 'YTD'])  # str_dt_ref defaults to current date.
+        df_all = self.try_str_perf_http(di_periods)
+        if df_all is not None:
+            return df_all
+        if self.get_str_max_workers() > 1:
+            return self.get_str_perf_parallel(di_periods)
 
-        df_all = DataFrame()
+        fb_all = FrameBuilder(di_schema=self.DI_STR_SCHEMA)
 
         # For each period, download the 10 + 1 (hotels + ALL) XLS files.
-        for str_period_name, v in di_periods.items():
-            self.logger.info('Processing for period type: {} {}'.format(str_period_name, v))
+        # One browser session (one login) for all downloads of all periods. See STRSession.
+        with STRSession(self) as session:
+            for str_period_name, v in di_periods.items():
+                self.logger.info('Processing for period type: {} {}'.format(str_period_name, v))
 
-            # DOWNLOAD FILES FOR PERIOD #
-            self.download_rpt_basic_perf_01(str_dt_from=v[0], str_dt_to=v[1])   # Individual Hotels
-            self.logger.info('COMPLETED: download_rpt_basic_perf_01')
-            time.sleep(3)  # Add delay between each call. Fight against ('Connection aborted.', ConnectionResetError(10054, 'An existing connection was forcibly closed by the remote host', None, 10054, None)
+                # DOWNLOAD FILES FOR PERIOD #
+                self.download_rpt_basic_perf_01(str_dt_from=v[0], str_dt_to=v[1], session=session)   # Individual Hotels
+                self.logger.info('COMPLETED: download_rpt_basic_perf_01')
 
-            self.download_rpt_basic_perf_01a(str_dt_from=v[0], str_dt_to=v[1])  # "ALL"
-            self.logger.info('COMPLETED: download_rpt_basic_perf_01a')
-            time.sleep(2)
+                self.download_rpt_basic_perf_01a(str_dt_from=v[0], str_dt_to=v[1], session=session)  # "ALL"
+                self.logger.info('COMPLETED: download_rpt_basic_perf_01a')
 
-            self.download_rpt_basic_perf_01b(str_dt_from=v[0], str_dt_to=v[1], str_ind_seg='upscale')
-            self.logger.info('COMPLETED: download_rpt_basic_perf_01b - upscale')
-            time.sleep(2)
+                self.download_rpt_basic_perf_01b(str_dt_from=v[0], str_dt_to=v[1], str_ind_seg='upscale',
+                                                   session=session)
+                self.logger.info('COMPLETED: download_rpt_basic_perf_01b - upscale')
 
-            self.download_rpt_basic_perf_01b(str_dt_from=v[0], str_dt_to=v[1], str_ind_seg='upper_upscale')
-            self.logger.info('COMPLETED: download_rpt_basic_perf_01b - upper_upscale')
+                self.download_rpt_basic_perf_01b(str_dt_from=v[0], str_dt_to=v[1], str_ind_seg='upper_upscale',
+                                                   session=session)
+                self.logger.info('COMPLETED: download_rpt_basic_perf_01b - upper_upscale')
 
-            # READ FILES #
-            df = self.read_rpt_basic_perf_01_all(str_dt_from=v[0], str_dt_to=v[1], str_period_name=str_period_name,
-                                                 str_dir_src=None, str_dir_target='C:/Users/feh_admin/Downloads/temp')
-            df_all = df_all.append(df)
+                # READ FILES #
+                df = self.read_rpt_basic_perf_01_all(str_dt_from=v[0], str_dt_to=v[1], str_period_name=str_period_name,
+                                                     str_dir_src=None, str_dir_target=self.get_str_archive_folder())
+                fb_all.add(df)
 
+        df_all = fb_all.build()
         # Sort again, because we appended period-by-period, so it's not in our desired sort order!
         df_all.sort_values(by=['hotel_code', 'period_name'], inplace=True)
         df_all.reset_index(drop=True, inplace=True)
         return df_all
 
+    def get_str_max_workers(self):
+        """ Number of parallel browser workers for the STR downloads ("max_workers" in [data_sources][str] of the CONF file).
+        Defaults to 1, ie: the sequential downloads in a single session. Keep it low. STR may throttle or block an account with
+        too many concurrent sessions.
+        """
+        return int(self.config['data_sources']['str'].get('max_workers', 1))
+
+    def get_str_client(self):
+        """ How the STR reports are downloaded ("client" in [data_sources][str] of the CONF file).
+        'browser' (default): Through the browser (STRSession). 'http': Through STRHttpClient, with the browser as the fallback.
+        """
+        return self.config['data_sources']['str'].get('client', 'browser').lower()
+
+    def try_str_perf_http(self, di_periods):
+        """ get_str_perf_http(), if "client" is 'http' (see get_str_client()). None if the browser is to be used instead.
+        Falls back to the browser only if STR's pages are not as STRHttpClient expects (STRHttpError), and then for the rest
+        of this bot's life, including the retries of send_str_perf(). Other errors (eg: network, database, a report which
+        cannot be read) are raised as is, as the browser would not fare any better.
+        """
+        if (self.get_str_client() != 'http') or getattr(self, 'is_str_http_failed', False):
+            return None
+        try:
+            return self.get_str_perf_http(di_periods)
+        except STRHttpError as ex:
+            self.logger.warning('[get_str_perf_http] {}. Falling back to the browser.'.format(ex))
+            self.is_str_http_failed = True
+            self.reset_str_download_folder()  # The browser run starts with an empty download folder.
+            return None
+
+    def get_str_perf_http(self, di_periods):
+        """ Gives the same DataFrame as the download-and-read loop of get_str_perf_weekly(), using STRHttpClient instead of a browser.
+        Each XLS report is parsed straight from the HTTP response. No file is downloaded, so none is archived either.
+        That is why this has its own period loop: the browser loop reads the files of each period from the download folder.
+        The hotels are read from the database once, instead of once per report.
+        :param di_periods: dict of {<period name>: (str_dt_from, str_dt_to)}, as from get_date_ranges().
+        :return: DataFrame containing all "Period" lines for ALL periods.
+        """
+        df_hotels = self.get_str_hotels()
+        df_hotels_sg = self.get_str_hotels(is_sg_only=True)
+        fb_all = FrameBuilder(di_schema=self.DI_STR_SCHEMA)
+
+        with STRHttpClient(self) as client:  # One login for all reports of all periods.
+            for str_period_name, (str_dt_from, str_dt_to) in di_periods.items():
+                self.logger.info('Processing for period type: {} {}'.format(str_period_name, (str_dt_from, str_dt_to)))
+                l_xls = client.download_rpt_basic_perf_01(str_dt_from, str_dt_to, df_hotels=df_hotels)  # Individual Hotels
+                l_xls.append(client.download_rpt_basic_perf_01a(str_dt_from, str_dt_to, df_hotels=df_hotels_sg))  # "ALL"
+                for str_ind_seg in ['upscale', 'upper_upscale']:
+                    l_xls.append(client.download_rpt_basic_perf_01b(str_dt_from, str_dt_to, str_ind_seg, df_hotels=df_hotels_sg))
+
+                for bytes_xls in l_xls:
+                    fb_all.add(self.read_rpt_basic_perf_01(bytes_xls, str_dt_from, str_dt_to, str_period_name))
+
+        df_all = fb_all.build()
+        df_all['period_name'] = pd.Categorical(df_all['period_name'], categories=['YTD', 'P90D', 'MTD', 'P07D'])  # For custom sort order.
+        df_all.sort_values(by=['hotel_code', 'period_name'], inplace=True)
+        df_all.reset_index(drop=True, inplace=True)
+        return df_all
+
+    def get_str_perf_parallel(self, di_periods):
+        """ Gives the same DataFrame as the download-and-read loop of get_str_perf_weekly(), with the downloads spread over a pool of
+        headless browser workers. Pool size is get_str_max_workers().
+        Every download is one job: each hotel, the portfolio ("ALL"), and each industry segment, for each period.
+        Each worker has its own STRSession (own login) and its own download folder, so that downloads never mix.
+        Each finished download is moved into a folder for its period, which is then read with read_rpt_basic_perf_01_all().
+        To respect STR rate limits, job starts of all workers are at least "min_job_interval" seconds apart
+        (in [data_sources][str] of the CONF file. Defaults to 1).
+        Worker folders are created inside the run's temp download folder. See get_str_download_folder().
+        :param di_periods: dict of {<period name>: (str_dt_from, str_dt_to)}, as from get_date_ranges().
+        :return: DataFrame containing all "Period" lines for ALL periods.
+        """
+        f_min_interval = float(self.config['data_sources']['str'].get('min_job_interval', 1))
+        str_run_folder = tempfile.mkdtemp(prefix='parallel_', dir=self.get_str_download_folder())
+        # Hotels are read here, once. The workers never use the database connection, which is not thread-safe.
+        df_hotels = self.get_str_hotels()
+        df_hotels_sg = self.get_str_hotels(is_sg_only=True)
+
+        # JOBS. Format: (<period name>, <report type>, <argument>) #
+        l_jobs = []
+        for str_period_name in di_periods:
+            os.makedirs(os.path.join(str_run_folder, str_period_name))
+            l_jobs += [(str_period_name, 'property', df_hotels.iloc[[i]]) for i in range(len(df_hotels))]  # One hotel per job.
+            l_jobs += [(str_period_name, 'all', None),
+                       (str_period_name, 'ind_seg', 'upscale'),
+                       (str_period_name, 'ind_seg', 'upper_upscale')]
+        self.logger.info('[get_str_perf_parallel] {} jobs, {} workers, in {}'.format(len(l_jobs), self.get_str_max_workers(),
+                                                                                    str_run_folder))
+
+        # Each worker thread starts its own session on first use, and keeps it for all the jobs it is given.
+        tl_session = threading.local()
+        l_sessions = []  # All started sessions, to be quit at the end.
+        lock = threading.Lock()
+        di_throttle = {'f_time_next': 0.}  # Earliest time for the next job start, over all workers.
+
+        def get_session():
+            if getattr(tl_session, 'session', None) is None:
+                with lock:
+                    str_folder = os.path.join(str_run_folder, 'worker_{}'.format(len(l_sessions)))
+                    os.makedirs(str_folder)  # Before the session, which points the browser at it.
+                    tl_session.session = STRSession(self, str_download_folder=str_folder, is_headless=True)
+                    l_sessions.append(tl_session.session)
+            return tl_session.session
+
+        def run_job(i_job, job):
+            str_period_name, str_type, arg = job
+            str_dt_from, str_dt_to = di_periods[str_period_name]
+            session = get_session()
+
+            with lock:
+                f_time_now = time.time()
+                f_wait = di_throttle['f_time_next'] - f_time_now
+                di_throttle['f_time_next'] = max(di_throttle['f_time_next'], f_time_now) + f_min_interval
+            if f_wait > 0:
+                time.sleep(f_wait)  # Rate limit. Not a wait for a download.
+
+            if str_type == 'property':
+                self.download_rpt_basic_perf_01(str_dt_from=str_dt_from, str_dt_to=str_dt_to, session=session, df_hotels=arg)
+            elif str_type == 'all':
+                self.download_rpt_basic_perf_01a(str_dt_from=str_dt_from, str_dt_to=str_dt_to, session=session,
+                                                 df_hotels=df_hotels_sg)
+            else:
+                self.download_rpt_basic_perf_01b(str_dt_from=str_dt_from, str_dt_to=str_dt_to, str_ind_seg=arg, session=session,
+                                                 df_hotels=df_hotels_sg)
+
+            # Move the download into the folder of its period. The job number prefix avoids clashes between same-named files.
+            for str_fn_with_path, str_fn in get_files(str_folder=session.str_download_folder, pattern='xls$'):
+                shutil.move(str_fn_with_path, os.path.join(str_run_folder, str_period_name, '{:04d}_{}'.format(i_job, str_fn)))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.get_str_max_workers()) as executor:
+                l_futures = [executor.submit(run_job, i_job, job) for i_job, job in enumerate(l_jobs)]
+                for future in as_completed(l_futures):
+                    if future.exception() is not None:
+                        for future_other in l_futures:  # Do not start any more jobs. The run will be retried as a whole.
+                            future_other.cancel()
+                    future.result()  # Re-raises any exception from the worker.
+        finally:
+            for session in l_sessions:
+                session.quit()
+
+        # READ FILES, PERIOD BY PERIOD #
+        fb_all = FrameBuilder(di_schema=self.DI_STR_SCHEMA)
+        for str_period_name, v in di_periods.items():
+            df = self.read_rpt_basic_perf_01_all(str_dt_from=v[0], str_dt_to=v[1], str_period_name=str_period_name,
+                                                 str_dir_src=os.path.join(str_run_folder, str_period_name),
+                                                 str_dir_target=self.get_str_archive_folder())
+            fb_all.add(df)
+        shutil.rmtree(str_run_folder, ignore_errors=True)
+
+        df_all = fb_all.build()
+        df_all.sort_values(by=['hotel_code', 'period_name'], inplace=True)
+        df_all.reset_index(drop=True, inplace=True)
+        return df_all
+
+
+class TimedFile(object):
+    """ Wraps a binary file object, and adds up the time spent waiting in read() and readline() in f_seconds.
+    For timing a transfer (eg: over SFTP) on its own, when parsing is interleaved with the reads.
+    All other attributes are those of the wrapped file object.
+    """
+    def __init__(self, fo):
+        self.fo = fo
+        self.f_seconds = 0.0
+
+    def read(self, *args):
+        f_start = time.perf_counter()
+        try:
+            return self.fo.read(*args)
+        finally:
+            self.f_seconds += time.perf_counter() - f_start
+
+    def readline(self, *args):
+        f_start = time.perf_counter()
+        try:
+            return self.fo.readline(*args)
+        finally:
+            self.f_seconds += time.perf_counter() - f_start
+
+    def __getattr__(self, name):
+        return getattr(self.fo, name)
+
+
+class OperaFileBody(io.RawIOBase):
+    """ Read-only view over the data portion of an Opera text export (column header line + reservation rows).
+    The 2 title lines at the top and the 2 summary lines at the bottom are located up front and stripped here,
+    so that pd.read_csv() can use the fast C engine instead of engine='python' with skipfooter.
+    Works on any seekable binary file object, ie: a local file or a pysftp/paramiko remote file handle.
+    If is_prefetch is True, fo must be a paramiko remote file handle. Once the footer is found (a small read at the end of file),
+    the rest of the body is requested in parallel with prefetch(). The footer is not prefetched, as it is never read again,
+    and paramiko keeps prefetched blocks in memory until they are read.
+    """
+    I_HEADER_LINES = 2  # Report title lines, before the column header line.
+    I_FOOTER_LINES = 2  # Report summary lines, after the last data row.
+    I_TAIL_BLOCK = 64 * 1024  # Bytes to read from the end of file when searching for the footer.
+
+    def __init__(self, fo, is_prefetch=False):
+        super().__init__()
+        self.fo = fo
+        i_end = self._find_footer_offset()
+
+        # Skip the header lines. readline() handles both '\n' and '\r\n' line endings.
+        self.fo.seek(0)
+        for i in range(self.I_HEADER_LINES):
+            self.fo.readline()
+        self.i_remaining = max(i_end - self.fo.tell(), 0)
+        if is_prefetch and self.i_remaining:
+            self.fo.prefetch(i_end)  # From the current position (past any buffered bytes) up to the footer.
+
+    def _find_footer_offset(self):
+        """ Returns the byte offset where the footer lines start, ie: the end of the last data row (incl its newline).
+        """
+        self.fo.seek(0, io.SEEK_END)  # Note: paramiko's seek() returns None, so use tell() for the file size.
+        i_size = self.fo.tell()
+        i_block = self.I_TAIL_BLOCK
+        while True:
+            i_start = max(i_size - i_block, 0)
+            self.fo.seek(i_start)
+            raw_tail = self.fo.read(i_size - i_start)
+
+            # A single line terminator at the very end of file does not count as a line (same as the csv module).
+            i_pos = len(raw_tail)
+            if raw_tail.endswith(b'\n'):
+                i_pos -= 1
+            for i in range(self.I_FOOTER_LINES):
+                i_pos = raw_tail.rfind(b'\n', 0, i_pos)
+                if i_pos < 0:
+                    break
+            if i_pos >= 0:
+                return i_start + i_pos + 1  # Keep the newline ending the last data row.
+            if i_start == 0:
+                return 0  # File has no more lines than the footer itself.
+            i_block *= 4  # Footer is longer than the block read. Try again with a bigger block.
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        i_len = min(len(b), self.i_remaining)
+        if i_len == 0:
+            return 0
+        raw = self.fo.read(i_len)
+        b[:len(raw)] = raw
+        self.i_remaining -= len(raw)
+        return len(raw)
+
 
 class OperaEmailQualityMonitorReportBot(ReportBot):
-    # Get labels for Opera columns.
+    # Labels for Opera columns. Loaded on first use by get_op_labels(), not at import. See there.
     fn_op_mt = 'C:/fehdw/config/Opera Text File mapping.xlsx'
-    df = pd.read_excel(io=fn_op_mt, sheet_name='Sheet2', skiprows=1, keep_default_na=False, na_values=' ')
-    df.drop(labels=df.columns[2:], axis=1, inplace=True)  # Drop all columns starting from 3rd column.
-    df.columns = ['code', 'name']
-    df.sort_values(by=['name'], axis=0, inplace=True)
-    df.reset_index(drop=True, inplace=True)
-    df_op_labels = df
+    di_op_labels = None
+    lock_op_labels = threading.Lock()
+
+    # Memo of raw Opera arrival date strings (eg: '01-JAN-19') to parsed datetimes. Shared by all files and chunks read.
+    di_op_date_cache = {}
+    lock_op_date_cache = threading.Lock()  # Files are parsed concurrently. See get_l_df_from_all_opera_files_sftp().
+
+    # Count columns of the daily per-resort rollup table. See update_op_daily_rollup().
+    L_OP_ROLLUP_COUNTS = ['n', 'n_blank', 'n_malformed', 'n_ota_proxy', 'n_repeat_guest']
+
+    # Columns used by the reports. In streaming mode, only these are loaded from the Opera files.
+    L_OP_COLUMNS = ['resort', 'confirmation_number', 'email', 'first_name', 'last_name', 'market_code', 'rate_code',
+                    'reservation_status', 'stayed_room_type', 'vip_code', 'arrival_date']
+    # Low-cardinality code columns. Read directly as Categorical, which cuts memory and speeds up the isin() filters and groupbys.
+    L_OP_CATEGORY_COLUMNS = ['resort', 'market_code', 'rate_code', 'reservation_status', 'stayed_room_type', 'vip_code',
+                             'arrival_date']
+    # Schema for FrameBuilder, when accumulating filtered Opera rows. confirmation_number is left to the integer downcast.
+    DI_OP_SCHEMA = {'resort': 'category', 'confirmation_number': None, 'email': 'object', 'first_name': 'object',
+                    'last_name': 'object', 'market_code': 'category', 'rate_code': 'category', 'reservation_status': 'category',
+                    'stayed_room_type': 'category', 'vip_code': 'category', 'arrival_date': 'category',
+                    'arrival_date_dt': 'datetime64[ns]'}
 
     def __init__(self):
         super().__init__()
@@ -746,29 +1469,89 @@ class OperaEmailQualityMonitorReportBot(ReportBot):
     def __del__(self):
         super().__del__()
 
-    def get_df_from_opera_file(self, fn=None, dt_from=None, dt_to=None):
+    def read_opera_file(self, fo, is_prefetch=False, **kwargs):
+        """ Reads an Opera text export (pipe-delimited) from an open binary file object, and returns the raw DataFrame.
+        Column names are still the Opera codes (eg: 'C93'); no renaming or filtering is done here.
+        The header and footer lines are stripped by OperaFileBody, which lets us use the C engine.
+        Gives the same DataFrame as the former read_csv(skiprows=2, skipfooter=2, engine='python').
+        :param fo: Seekable binary file object. eg: open(fn, 'rb') or srv.open(fn, mode='rb').
+        :param is_prefetch: If True, prefetch the body of a remote file. See OperaFileBody.
+        :param kwargs: Passed through to pd.read_csv(). eg: usecols, chunksize.
+        :return: DataFrame, or a TextFileReader if chunksize is given.
         """
-        Given a filename (with path) of an Opera text file, read it and output a dataframe.
-        Filters the rows using 'arrival_date_dt', which should be between dt_from and dt_to, inclusive.
-        This way, can handle both data request scenarios (weekly and monthly).
+        # Note: 'quoting'=3 (QUOTE_NONE) will prevent an error. Otherwise if a string has a double-quote, python expects a "|".
+        # low_memory=False and float_precision='round_trip' give the same dtypes and float values as the python engine.
+        di_params = {'sep': '|', 'keep_default_na': False, 'na_values': ' ', 'engine': 'c', 'error_bad_lines': False,
+                     'quoting': 3, 'low_memory': False, 'float_precision': 'round_trip'}
+        di_params.update(kwargs)
+        return pd.read_csv(OperaFileBody(fo, is_prefetch=is_prefetch), **di_params)
+
+    def get_op_labels(self):
+        """ Returns the Opera Code to OperaFieldName mapping, as a dict of {<Opera code>: <column name>}. eg: {'C93': 'origin'}.
+        Column names are already lowercase, with underscores instead of spaces, so the dict can be used in a single rename.
+        Loaded on first use, and kept for the rest of the process. To avoid parsing the mapping Excel file each time, the mapping
+        is cached as a JSON file ("labels_cache" in [data_sources][opera]), which is rebuilt whenever the Excel file's mtime changes.
+        :return: dict
         """
-        # Get string representing last month (eg: 'SEP'), for use in filtering later.
-        # str_last_month = str.upper((dt.datetime.today() - dt.timedelta(days=30)).strftime('%b'))
+        with self.lock_op_labels:
+            if OperaEmailQualityMonitorReportBot.di_op_labels is None:
+                OperaEmailQualityMonitorReportBot.di_op_labels = self._load_op_labels()
+        return self.di_op_labels
 
-        # Read Opera data file
-        # Note: 'quoting'=3 (QUOTE_NONE) will prevent an error. Otherwise if a string has a double-quote, python expects a "|".
-        df_op_data = pd.read_csv(fn, sep='|', skiprows=2, skipfooter=2, keep_default_na=False, na_values=' ',
-                                 engine='python', error_bad_lines=False, quoting=3)
-        # Iterate through Opera Code to OperaFieldName mapping table. Swap out codes for names, in the other df.
-        for idx, row in self.df_op_labels.iterrows():
-            df_op_data.rename(columns={row['code']: row['name']},
-                              inplace=True)  # eg: df_op_data.rename(columns={'C93': 'Origin'}
+    def _load_op_labels(self):
+        """ Loads the mapping for get_op_labels(), from the JSON cache if still valid, else from the mapping Excel file.
+        """
+        f_mtime = os.path.getmtime(self.fn_op_mt)
+        str_fn_cache = self.config['data_sources'].get('opera', {}).get('labels_cache', 'C:/fehdw/temp/opera_labels_cache.json')
+        if os.path.isfile(str_fn_cache):
+            with open(str_fn_cache, 'r') as fo:
+                di_cache = json.load(fo)
+            if di_cache.get('mtime') == f_mtime:
+                return dict(di_cache['labels'])  # Stored as a list of [code, name] pairs.
+
+        df = pd.read_excel(io=self.fn_op_mt, sheet_name='Sheet2', skiprows=1, keep_default_na=False, na_values=' ')
+        df.drop(labels=df.columns[2:], axis=1, inplace=True)  # Drop all columns starting from 3rd column.
+        df.columns = ['code', 'name']
+        df.sort_values(by=['name'], axis=0, inplace=True)
+
+        # If a code appears more than once, the first name (in sort order) wins, same as the former row-by-row renames.
+        di_labels = {}
+        for str_code, str_name in zip(df['code'], df['name']):
+            di_labels.setdefault(str_code, str(str_name).lower().replace(' ', '_'))
+
+        with open(str_fn_cache, 'w') as fo:
+            json.dump({'mtime': f_mtime, 'labels': list(di_labels.items())}, fo)
+        self.logger.info('[get_op_labels] Rebuilt Opera labels cache: ' + str_fn_cache)
+        return di_labels
+
+    def get_opera_usecols(self):
+        """ Returns the set of Opera column codes (eg: 'C93') which map to the column names in L_OP_COLUMNS.
+        For use with read_csv(usecols=...), so that the other columns are never loaded.
+        """
+        return {str_code for str_code, str_name in self.get_op_labels().items() if str_name in self.L_OP_COLUMNS}
 
-        df_op_data.columns = df_op_data.columns.str.lower()  # Convert all column names to lowercase.
-        df_op_data.drop(labels='', axis=1, inplace=True)  # Drop the column for the blank colname. All values are blank.
+    def get_opera_dtypes(self):
+        """ Returns a dict of {<Opera column code>: 'category'} for the columns in L_OP_CATEGORY_COLUMNS.
+        For use with read_csv(dtype=...), so that these columns are never held as Python strings.
+        """
+        return {str_code: 'category' for str_code, str_name in self.get_op_labels().items()
+                if str_name in self.L_OP_CATEGORY_COLUMNS}
+
+    def prep_opera_df(self, df_op_data, dt_from=None, dt_to=None):
+        """ Given a raw DataFrame (or chunk) read from an Opera file, swap the column names as per mapping Excel file,
+        then apply the exclusion filters, and keep only rows where dt_from <= arrival_date <= dt_to.
+        :param df_op_data: Raw DataFrame from read_opera_file().
+        :param dt_from: datetime object. Or a list of them, for a union of date ranges. See get_arrival_date_mask().
+        :param dt_to: datetime object. Or a list of them, of the same length as dt_from.
+        :return: The filtered DataFrame.
+        """
+        # Swap out Opera codes for names, using the Opera Code to OperaFieldName mapping. eg: {'C93': 'origin'}
+        df_op_data.rename(columns=self.get_op_labels(), inplace=True)
 
-        # Column names -> underscores instead of spaces.
-        df_op_data.columns = [x.replace(' ', '_') for x in list(df_op_data.columns)]
+        # Any unmapped column names -> lowercase, and underscores instead of spaces. Same as the mapped names.
+        df_op_data.columns = [str(x).lower().replace(' ', '_') for x in list(df_op_data.columns)]
+        # Drop the column for the blank colname. All values are blank. Not present when usecols is given.
+        df_op_data.drop(labels='', axis=1, inplace=True, errors='ignore')
 
         # Filter away Airline crew and Wholesales Groups, as identified by the market_code field of the Opera transaction.
         df_op_data = df_op_data[~(df_op_data['market_code'].isin(['ALC', 'ALI', 'WHG']))]
@@ -779,10 +1562,104 @@ class OperaEmailQualityMonitorReportBot(ReportBot):
         # Filter away rate_code = 'SHR'. Room sharers are not required to give their emails in the hotel registration card.
         df_op_data = df_op_data[~(df_op_data['rate_code'].isin(['SHR']))]
         # Convert 'arrival_date' to datetime format.
-        df_op_data['arrival_date_dt'] = pd.to_datetime(df_op_data['arrival_date'].apply(lambda x: x[0:-2] + '20' + x[-2:]),
-                                                       format='%d-%b-%Y')
-        # Filter by 'arrival_date_dt' to contain only rows in between dt_from and dt_to.
-        df_op_data = df_op_data[(df_op_data['arrival_date_dt'] >= dt_from) & (df_op_data['arrival_date_dt'] <= dt_to)]
+        df_op_data['arrival_date_dt'] = self.parse_opera_dates(df_op_data['arrival_date'])
+        # Filter by 'arrival_date_dt' to contain only rows in between dt_from and dt_to. Skipped if both are None (eg: for ingest_opera_store()).
+        if pd.api.types.is_list_like(dt_from) or not (pd.isnull(dt_from) and pd.isnull(dt_to)):
+            df_op_data = df_op_data[self.get_arrival_date_mask(df_op_data['arrival_date_dt'], dt_from, dt_to)]
+
+        return df_op_data
+
+    @staticmethod
+    def get_arrival_date_mask(sr_dt, dt_from, dt_to):
+        """ Boolean Series, True where dt_from <= sr_dt <= dt_to.
+        dt_from and dt_to may also be equal-length lists (or DatetimeIndexes) of range starts and ends. The mask is then True
+        for the union of the ranges. eg: The arrival date windows of get_windows(), when they do not overlap.
+        """
+        if not pd.api.types.is_list_like(dt_from):
+            return (sr_dt >= dt_from) & (sr_dt <= dt_to)
+        sr_mask = Series(False, index=sr_dt.index)
+        for dt_range_from, dt_range_to in zip(dt_from, dt_to):
+            sr_mask |= (sr_dt >= dt_range_from) & (sr_dt <= dt_range_to)
+        return sr_mask
+
+    def parse_opera_dates(self, sr_dates):
+        """ Converts a Series of Opera date strings (format 'DD-MON-YY', eg: '01-JAN-19') to datetimes.
+        Each distinct string is parsed only once, and memoised in di_op_date_cache for all later files and chunks.
+        The result is mapped back onto the rows with a vectorised lookup, instead of a per-row apply().
+        Two-digit years are always taken as 20YY (eg: '19' -> 2019), as Opera has no reservations before 2000.
+        :param sr_dates: Series of strings.
+        :return: Series of datetime64, with the same index as sr_dates.
+        """
+        is_categorical = hasattr(sr_dates, 'cat')  # The .cat accessor only exists for Categorical Series.
+        if is_categorical:
+            # Categories are those of the whole file or chunk, incl those of rows already filtered away. Those are not parsed.
+            sr_dates = sr_dates.cat.remove_unused_categories()
+        arr_distinct = sr_dates.cat.categories if is_categorical else sr_dates.dropna().unique()
+
+        di_cache = self.di_op_date_cache
+        with self.lock_op_date_cache:
+            l_new = [x for x in arr_distinct if x not in di_cache]  # Loops over the distinct values only.
+            if l_new:
+                sr_new = Series(l_new)
+                sr_new_dt = pd.to_datetime(sr_new.str[:-2] + '20' + sr_new.str[-2:], format='%d-%b-%Y')
+                di_cache.update(zip(l_new, sr_new_dt))
+            # Look up the distinct values of this Series only. The cache itself can hold many more.
+            arr_distinct_dt = pd.DatetimeIndex([di_cache[x] for x in arr_distinct]).values
+
+        # Expand by the position of each row's value in arr_distinct. Position -1 (NaN) picks the NaT appended at the end.
+        arr_dt = np.append(arr_distinct_dt, np.datetime64('NaT'))
+        arr_pos = sr_dates.cat.codes.values if is_categorical else pd.Index(arr_distinct).get_indexer(sr_dates)
+        return Series(arr_dt.take(arr_pos), index=sr_dates.index)
+
+    def read_opera_file_filtered(self, fo, dt_from=None, dt_to=None, i_chunksize=None, is_prefetch=False):
+        """ Reads an Opera file from an open binary file object, and returns the filtered DataFrame (see prep_opera_df()).
+        If i_chunksize is given, runs in streaming mode: the file is read i_chunksize rows at a time, only the columns in
+        L_OP_COLUMNS are loaded, and each chunk is filtered before the next is read.
+        Peak memory is then bounded by the chunk size plus the rows kept, rather than by the file size.
+        :param fo: Seekable binary file object.
+        :param dt_from: datetime object.
+        :param dt_to: datetime object.
+        :param i_chunksize: Number of rows per chunk. None or 0 to read the whole file with all columns.
+        :param is_prefetch: If True, prefetch the body of a remote file. See OperaFileBody.
+        :return: DataFrame
+        """
+        f_start = time.perf_counter()
+        if not i_chunksize:
+            df_op_data = self.prep_opera_df(self.read_opera_file(fo, is_prefetch=is_prefetch, dtype=self.get_opera_dtypes()),
+                                            dt_from=dt_from, dt_to=dt_to)
+        else:
+            set_usecols = self.get_opera_usecols()
+            reader = self.read_opera_file(fo, is_prefetch=is_prefetch, usecols=lambda x: x in set_usecols,
+                                          dtype=self.get_opera_dtypes(), chunksize=i_chunksize)
+            fb_chunks = FrameBuilder(di_schema=self.DI_OP_SCHEMA, downcast=True)
+            for df_chunk in reader:
+                fb_chunks.add(self.prep_opera_df(df_chunk, dt_from=dt_from, dt_to=dt_to))
+            df_op_data = fb_chunks.build(ignore_index=False)
+
+        # Ingest profile. For comparing the effect of settings (eg: chunksize) across runs.
+        self.logger.info('[INGEST PROFILE] Rows kept: {:,}; Time taken: {:.2f}s; Distinct arrival dates parsed so far: {:,}'.format(
+            len(df_op_data), time.perf_counter() - f_start, len(self.di_op_date_cache)))
+        return df_op_data
+
+    def get_opera_chunksize(self):
+        """ Returns the streaming ingest chunk size ("chunksize" in [data_sources][opera] of the CONF file).
+        0 means streaming mode is off, ie: read whole files with all columns.
+        """
+        return int(self.config['data_sources'].get('opera', {}).get('chunksize', 100000))
+
+    def get_df_from_opera_file(self, fn=None, dt_from=None, dt_to=None, i_chunksize=None):
+        """
+        Given a filename (with path) of an Opera text file, read it and output a dataframe.
+        Filters the rows using 'arrival_date_dt', which should be between dt_from and dt_to, inclusive.
+        This way, can handle both data request scenarios (weekly and monthly).
+        :param i_chunksize: If given, read in streaming mode. See read_opera_file_filtered().
+        """
+        # Get string representing last month (eg: 'SEP'), for use in filtering later.
+        # str_last_month = str.upper((dt.datetime.today() - dt.timedelta(days=30)).strftime('%b'))
+
+        # Read Opera data file
+        with open(fn, 'rb') as fo:  # Auto file close.
+            df_op_data = self.read_opera_file_filtered(fo, dt_from=dt_from, dt_to=dt_to, i_chunksize=i_chunksize)
 
         # Filter arrival_date to contain only str_last_month value.
         # DEBUG-20171013 df_op_data = df_op_data[df_op_data['arrival_date'].str.contains(str_last_month)]
@@ -799,20 +1676,21 @@ class OperaEmailQualityMonitorReportBot(ReportBot):
 
         r = re.compile('.+Historical.+txt$')  # Format: " *Historical*.txt ".
         l_op_files = list(filter(r.match, list(os.walk(str_dir))[0][2]))  # List of raw Opera files to aggregate. Picks ALL files in directory.
+        i_chunksize = self.get_opera_chunksize()
+        # Drop any possible duplicates of 'confirmation_number', keeping the first occurrence. Done file by file, as they are read.
+        key_filter = UniqueKeyFilter('confirmation_number')
 
-        df_in = DataFrame()
+        fb_in = FrameBuilder(di_schema=self.DI_OP_SCHEMA, downcast=True)
 
         for file in l_op_files:
             fn = os.path.join(str_dir, file)
-            df_temp = self.get_df_from_opera_file(fn=fn, dt_from=dt_from, dt_to=dt_to)  # Call the function.
-            df_in = df_in.append(df_temp, ignore_index=True)
+            df_temp = self.get_df_from_opera_file(fn=fn, dt_from=dt_from, dt_to=dt_to, i_chunksize=i_chunksize)  # Call the function.
+            fb_in.add(key_filter.filter(df_temp))
 
-        # Drop any possible duplicates of 'confirmation_number', keeping the first occurrence.
-        df_in = df_in[~df_in['confirmation_number'].duplicated(keep='first')]
-
-        return df_in
+        return fb_in.build()
 
-    def get_df_from_opera_file_sftp(self, sftp_srv=None, str_folder_remote=None, fn=None, str_dt_from=None, str_dt_to=None):
+    def get_df_from_opera_file_sftp(self, sftp_srv=None, str_folder_remote=None, fn=None, str_dt_from=None, str_dt_to=None,
+                                    i_chunksize=None):
         """ Given a filename fn, open a connection to the configured SFTP server. Changed working directory to str_folder_remote.
         Read the file (specially formatted) and swap the column names as per mapping Excel file.
         Apply filters (very specific logic). Filters include dt_from <= arrival_date <= dt_to.
@@ -821,89 +1699,670 @@ class OperaEmailQualityMonitorReportBot(ReportBot):
         :param str_folder_remote: The SFTP folder where we should be based.
         :param str_dt_from:
         :param str_dt_to:
+        :param i_chunksize: If given, read in streaming mode. See read_opera_file_filtered().
         :return:
         """
         # CREATE SFTP CONNECTION TO REMOTE SERVER. ONLY IF NOT SUPPLIED. THIS MAKES IS FASTER THAN REPEATEDLY RE-OPENING CONNECTIONS. #
         if sftp_srv is None:
-            cnopts = pysftp.CnOpts()
-            cnopts.hostkeys = None
-            str_host = self.config['sftp']['sftp_server']
-            str_userid = self.config['sftp']['userid']
-            str_pw = self.config['sftp']['password']
-            str_folder_remote = str_folder_remote  #'/C/FESFTP/Opera'
-            srv = pysftp.Connection(host=str_host, username=str_userid, password=str_pw, cnopts=cnopts)
-            srv.cwd(str_folder_remote)  # Change current working dir to here.
+            srv = self.open_sftp(str_folder_remote=str_folder_remote)  #'/C/FESFTP/Opera'
         else:
             srv = sftp_srv
 
         dt_from = pd.to_datetime(str_dt_from)  # Type conversion, so can do comparison later.
         dt_to = pd.to_datetime(str_dt_to)
 
-        with srv.open(fn) as fo:  # Auto file close.
-            df_op_data = pd.read_csv(fo, sep='|', skiprows=2, skipfooter=2, keep_default_na=False, na_values=' ',
-                                     engine='python', error_bad_lines=False, quoting=3)
-        # Iterate through Opera Code to OperaFieldName mapping table. Swap out codes for names, in the other df.
-        for idx, row in self.df_op_labels.iterrows():
-            df_op_data.rename(columns={row['code']: row['name']},
-                              inplace=True)  # eg: df_op_data.rename(columns={'C93': 'Origin'}
+        # Read-ahead: the file body is requested in parallel with prefetch(), instead of one small read per round trip.
+        # Only once the footer has been found, with a small read at the end of file. See OperaFileBody.
+        # Reads are also buffered in large blocks. See "prefetch" and "bufsize" in [sftp] of the CONF file.
+        is_prefetch = str(self.config['sftp'].get('prefetch', 'True')).lower() == 'true'
+        i_bufsize = int(self.config['sftp'].get('bufsize', 1048576))  # 1 MB.
+        with srv.open(fn, mode='rb', bufsize=i_bufsize) as fo:  # Auto file close.
+            i_size = fo.stat().st_size
+            fo_timed = TimedFile(fo)  # Parsing is interleaved with the reads. Only the time spent in the reads is the transfer.
+            df_op_data = self.read_opera_file_filtered(fo_timed, dt_from=dt_from, dt_to=dt_to, i_chunksize=i_chunksize,
+                                                       is_prefetch=is_prefetch)
+        self.log_sftp_throughput(fn, i_size, fo_timed.f_seconds)
 
-        df_op_data.columns = df_op_data.columns.str.lower()  # Convert all column names to lowercase.
-        df_op_data.drop(labels='', axis=1, inplace=True)  # Drop the column for the blank colname. All values are blank.
+        return df_op_data
 
-        # Column names -> underscores instead of spaces.
-        df_op_data.columns = [x.replace(' ', '_') for x in list(df_op_data.columns)]
+    def log_sftp_throughput(self, fn, i_bytes, f_seconds):
+        """ Logs the transfer throughput of one file read over SFTP. eg: [OPERA SFTP THROUGHPUT] x.txt: 12,345,678 bytes in 4.2s (2.80 MB/s)
+        """
+        self.logger.info('[OPERA SFTP THROUGHPUT] {}: {:,} bytes in {:.1f}s ({:.2f} MB/s)'.format(
+            fn, i_bytes, f_seconds, i_bytes / max(f_seconds, 1e-6) / 1048576))
 
-        # Filter away Airline crew and Wholesales Groups, as identified by the market_code field of the Opera transaction.
-        df_op_data = df_op_data[~(df_op_data['market_code'].isin(['ALC', 'ALI', 'WHG']))]
-        # Filter away 'CANCELLED' and 'NO SHOW' bookings.
-        df_op_data = df_op_data[~(df_op_data['reservation_status'].isin(['CANCELLED', 'NO SHOW']))]
-        # Filter away pseudo rooms.
-        df_op_data = df_op_data[~(df_op_data['stayed_room_type'].isin(['PM']))]
-        # Filter away rate_code = 'SHR'. Room sharers are not required to give their emails in the hotel registration card.
-        df_op_data = df_op_data[~(df_op_data['rate_code'].isin(['SHR']))]
-        # Convert 'arrival_date' to datetime format.
-        df_op_data['arrival_date_dt'] = pd.to_datetime(
-            df_op_data['arrival_date'].apply(lambda x: x[0:-2] + '20' + x[-2:]),
-            format='%d-%b-%Y')
-        # Filter by 'arrival_date_dt' to contain only rows in between dt_from and dt_to.
-        df_op_data = df_op_data[(df_op_data['arrival_date_dt'] >= dt_from) & (df_op_data['arrival_date_dt'] <= dt_to)]
+    def open_sftp(self, str_folder_remote=None):
+        """ Opens a new connection to the configured SFTP server. Caller is responsible for closing it.
+        :param str_folder_remote: If given, change the current working dir of the connection to this folder.
+        :return: pysftp.Connection
+        """
+        cnopts = pysftp.CnOpts()
+        cnopts.hostkeys = None
+        # Transport compression. Opera text files are highly compressible, which helps on slow links. Costs CPU on both ends.
+        cnopts.compression = str(self.config['sftp'].get('compression', 'False')).lower() == 'true'
+        str_host = self.config['sftp']['sftp_server']
+        str_userid = self.config['sftp']['userid']
+        str_pw = self.config['sftp']['password']
+        srv = pysftp.Connection(host=str_host, username=str_userid, password=str_pw, cnopts=cnopts)
+        if str_folder_remote is not None:
+            srv.cwd(str_folder_remote)  # Change current working dir to here.
+        return srv
 
-        return df_op_data
+    def list_opera_files_sftp(self, str_folder_remote='/C/FESFTP/Opera'):
+        """ Lists all "*Historical*.txt" files in the remote folder, over a connection opened for the listing only.
+        listdir_attr() saves an isfile() round trip per file. The attributes also carry the remote size and mtime.
+        :param str_folder_remote:
+        :return: List of paramiko SFTPAttributes, in listing order. Filename is in .filename.
+        """
+        srv = self.open_sftp(str_folder_remote=str_folder_remote)
+        r = re.compile('.+Historical.+txt$')  # Format: " *Historical*.txt ".
+        l_op_attrs = [attr for attr in srv.listdir_attr() if r.match(attr.filename) and stat.S_ISREG(attr.st_mode)]
+        srv.close()
+        return l_op_attrs
 
-    def get_df_from_all_opera_files_sftp(self, str_folder_remote='/C/FESFTP/Opera', str_dt_from=None, str_dt_to=None):
+    def get_l_df_from_all_opera_files_sftp(self, str_folder_remote='/C/FESFTP/Opera', str_dt_from=None, str_dt_to=None,
+                                           drop_duplicates=False, l_filenames=None):
         """ Given a (hardcoded) remote folder, read all "*Historical*.txt" files.
-        Filter str_dt_from <= arrival_date <= str_dt_to. Return the consolidated DataFrame.
+        Filter str_dt_from <= arrival_date <= str_dt_to. Return a list of DataFrames, one per file, in listing order.
+        See iter_df_from_all_opera_files_sftp() for the parameters, the connection pool and the local cache.
+        :return:
+        """
+        return list(self.iter_df_from_all_opera_files_sftp(str_folder_remote=str_folder_remote, str_dt_from=str_dt_from,
+                                                           str_dt_to=str_dt_to, drop_duplicates=drop_duplicates,
+                                                           l_filenames=l_filenames))
+
+    def iter_df_from_all_opera_files_sftp(self, str_folder_remote='/C/FESFTP/Opera', str_dt_from=None, str_dt_to=None,
+                                          drop_duplicates=False, l_filenames=None):
+        """ Given a (hardcoded) remote folder, read all "*Historical*.txt" files.
+        Filter str_dt_from <= arrival_date <= str_dt_to. Yields one DataFrame per file, in listing order.
+        If drop_duplicates is True, duplicates of 'confirmation_number' are dropped (keeping the first occurrence, in listing order)
+        as soon as each file's turn comes up, so that duplicate rows from overlapping files are not held until the end.
+        Files are fetched and parsed concurrently, over a bounded pool of SFTP connections (one per worker thread).
+        Pool size is "max_connections" in the [sftp] section of the CONF file. Defaults to 4; set to 1 for the old sequential behaviour.
+        At most 2 files per connection are read ahead of the caller. A caller which keeps only aggregates of each file
+        (eg: backfill_email_quality()) therefore never holds more than a few files at once.
+        Raw files are kept in a local cache folder ("cache_folder" in [sftp]), with a manifest of the remote size and mtime.
+        Only new or changed files are transferred. Set cache_folder to blank to always read straight from the SFTP server.
+        The manifest is only updated once all files have been yielded.
         :param str_folder_remote:
         :param str_dt_from:
         :param str_dt_to:
+        :param drop_duplicates:
+        :param l_filenames: If given, read only these files (still in listing order). eg: only new files, for update_op_daily_rollup().
+        :return: Generator of DataFrames.
+        """
+        i_max_conn = int(self.config['sftp'].get('max_connections', 4))
+        str_cache_folder = self.config['sftp'].get('cache_folder', 'C:/fehdw/temp/opera_sftp_cache')
+        i_chunksize = self.get_opera_chunksize()
+        dt_from = pd.to_datetime(str_dt_from)  # Type conversion, so can do comparison later.
+        dt_to = pd.to_datetime(str_dt_to)
+
+        l_op_attrs = self.list_opera_files_sftp(str_folder_remote=str_folder_remote)
+        l_op_attrs_all = l_op_attrs  # For the cache manifest, which covers every file on the server.
+        if l_filenames is not None:
+            set_filenames = set(l_filenames)
+            l_op_attrs = [attr for attr in l_op_attrs if attr.filename in set_filenames]
+
+        # LOAD LOCAL CACHE MANIFEST. Format: {<filename>: {'size': <bytes>, 'mtime': <epoch seconds>}} #
+        di_manifest = {}
+        if str_cache_folder:
+            os.makedirs(str_cache_folder, exist_ok=True)
+            str_fn_manifest = os.path.join(str_cache_folder, 'manifest.json')
+            if os.path.isfile(str_fn_manifest):
+                with open(str_fn_manifest, 'r') as fo:
+                    di_manifest = json.load(fo)
+
+        # Each worker thread opens its own connection on first use, and keeps it for all the files it is given.
+        tl_conn = threading.local()
+        l_srv = []  # All opened connections, to be closed at the end.
+        lock = threading.Lock()
+
+        def get_conn():
+            if getattr(tl_conn, 'srv', None) is None:
+                tl_conn.srv = self.open_sftp(str_folder_remote=str_folder_remote)
+                with lock:
+                    l_srv.append(tl_conn.srv)
+            return tl_conn.srv
+
+        def fetch(attr):
+            """ Returns a 2-tuple of (<filtered DataFrame>, <True if served from local cache>). """
+            file = attr.filename
+            if not str_cache_folder:
+                self.logger.info('READING FILE (SFTP): ' + file)
+                return self.get_df_from_opera_file_sftp(sftp_srv=get_conn(), str_folder_remote=str_folder_remote, fn=file,
+                                                        str_dt_from=str_dt_from, str_dt_to=str_dt_to,
+                                                        i_chunksize=i_chunksize), False
+
+            str_fn_local = os.path.join(str_cache_folder, file)
+            di_remote = {'size': attr.st_size, 'mtime': attr.st_mtime}
+            is_hit = (di_manifest.get(file) == di_remote) and os.path.isfile(str_fn_local) \
+                and (os.path.getsize(str_fn_local) == attr.st_size)
+            if is_hit:
+                self.logger.info('READING FILE (CACHE HIT): ' + file)
+            else:
+                self.logger.info('READING FILE (CACHE MISS): ' + file)
+                str_fn_temp = str_fn_local + '.part'  # Download to a temp file first, so an aborted transfer never looks complete.
+                f_time_start = time.time()
+                get_conn().get(file, localpath=str_fn_temp)  # Prefetches by default.
+                self.log_sftp_throughput(file, attr.st_size, time.time() - f_time_start)
+                os.replace(str_fn_temp, str_fn_local)
+            return self.get_df_from_opera_file(fn=str_fn_local, dt_from=dt_from, dt_to=dt_to, i_chunksize=i_chunksize), is_hit
+
+        l_is_hit = []
+        key_filter = UniqueKeyFilter('confirmation_number')
+        i_workers = max(min(i_max_conn, len(l_op_attrs)), 1)
+        it_attrs = iter(l_op_attrs)
+        try:
+            with ThreadPoolExecutor(max_workers=i_workers) as executor:
+                # Read-ahead window. Results are taken in listing order, so that "keep first" de-duplication is unchanged.
+                # Files that finish early wait in their future for the ones before them.
+                dq_futures = deque(executor.submit(fetch, attr) for attr in islice(it_attrs, 2 * i_workers))
+                while dq_futures:
+                    df, is_hit = dq_futures.popleft().result()  # Re-raises any exception from the worker.
+                    attr = next(it_attrs, None)
+                    if attr is not None:  # Keep the window full.
+                        dq_futures.append(executor.submit(fetch, attr))
+                    l_is_hit.append(is_hit)
+                    yield key_filter.filter(df) if drop_duplicates else df
+        finally:
+            for srv in l_srv:
+                srv.close()
+
+        # UPDATE LOCAL CACHE MANIFEST. Files which no longer exist on the SFTP server are removed from the cache. #
+        if str_cache_folder:
+            di_manifest_new = {attr.filename: di_manifest[attr.filename] for attr in l_op_attrs_all if attr.filename in di_manifest}
+            di_manifest_new.update({attr.filename: {'size': attr.st_size, 'mtime': attr.st_mtime} for attr in l_op_attrs})
+            for file in set(di_manifest) - set(di_manifest_new):
+                str_fn_local = os.path.join(str_cache_folder, file)
+                if os.path.isfile(str_fn_local):
+                    os.remove(str_fn_local)
+            with open(str_fn_manifest, 'w') as fo:
+                json.dump(di_manifest_new, fo, indent=2, sort_keys=True)
+
+            i_hits = sum(l_is_hit)
+            i_bytes_saved = sum(attr.st_size for attr, is_hit in zip(l_op_attrs, l_is_hit) if is_hit)
+            self.logger.info('[OPERA SFTP CACHE] Hits: {}, Misses: {}, Bytes saved: {:,}'.format(
+                i_hits, len(l_op_attrs) - i_hits, i_bytes_saved))
+
+    def get_df_from_all_opera_files_sftp(self, str_folder_remote='/C/FESFTP/Opera', str_dt_from=None, str_dt_to=None,
+                                         from_store=False, drop_duplicates=True):
+        """ Given a (hardcoded) remote folder, read all "*Historical*.txt" files.
+        Filter str_dt_from <= arrival_date <= str_dt_to. Return the consolidated DataFrame.
+        :param str_folder_remote:
+        :param str_dt_from: Or a list of range starts, with str_dt_to a list of range ends, to read the union of several ranges.
+        :param str_dt_to:
+        :param from_store: If True, read only the partitions of the Opera store (see ingest_opera_store()) which overlap
+        the date range, instead of re-reading all the files.
+        :param drop_duplicates: If False, duplicates of 'confirmation_number' are kept, in file and row order. See get_windows().
         :return:
         """
-        str_host = self.config['sftp']['sftp_server']
-        str_userid = self.config['sftp']['userid']
-        str_pw = self.config['sftp']['password']
+        if from_store:
+            return self.get_df_from_opera_store(str_dt_from=str_dt_from, str_dt_to=str_dt_to, drop_duplicates=drop_duplicates)
+
+        # Duplicates of 'confirmation_number' are dropped as the files come in, keeping the first occurrence.
+        l_df = self.get_l_df_from_all_opera_files_sftp(str_folder_remote=str_folder_remote, str_dt_from=str_dt_from,
+                                                       str_dt_to=str_dt_to, drop_duplicates=drop_duplicates)
+        fb_in = FrameBuilder(di_schema=self.DI_OP_SCHEMA, downcast=True)
+        for df_temp in l_df:
+            fb_in.add(df_temp)
+
+        return fb_in.build()
+
+    @classmethod
+    def is_op_store_enabled(cls):
+        """ True if "use_store" in [data_sources][opera] is set to True. Then get() and get_windows() read the Opera store,
+        and the scheduler rebuilds the store once a day, before the reports are run. See ingest_opera_store().
+        A classmethod, so that the scheduler can check it without connecting to the databases.
+        """
+        return str(cls.config['data_sources'].get('opera', {}).get('use_store', 'False')).lower() == 'true'
 
-        # CREATE SFTP CONNECTION TO REMOTE SERVER #
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        srv = pysftp.Connection(host=str_host, username=str_userid, password=str_pw, cnopts=cnopts)
-        srv.cwd(str_folder_remote)  # Change current working dir to here.
+    def get_opera_store_folder(self):
+        """ Returns the root folder of the Opera store ("store_folder" in [data_sources][opera] of the CONF file).
+        """
+        return self.config['data_sources'].get('opera', {}).get('store_folder', 'C:/fehdw/temp/opera_store')
+
+    def ingest_opera_store(self, str_folder_remote='/C/FESFTP/Opera'):
+        """ Reads all "*Historical*.txt" files, and writes the filtered rows (all arrival dates) into a Parquet dataset,
+        partitioned by arrival year and month. eg: <store_folder>/arrival_year=2018/arrival_month=1/<part>.parquet
+        The store is rebuilt in full on each call, then swapped in place of the previous one.
+        Rows are NOT de-duplicated here. Column "ingest_seq" keeps the original file and row order instead, so that
+        get_df_from_opera_store() can apply the same "keep first" de-duplication AFTER the date filter, like the file path does.
+        Only the columns in L_OP_COLUMNS (plus 'arrival_date_dt') are stored. Rows without an arrival date are not stored.
+        :param str_folder_remote:
+        :return: NA
+        """
+        l_df = self.get_l_df_from_all_opera_files_sftp(str_folder_remote=str_folder_remote)
+        fb = FrameBuilder(di_schema=self.DI_OP_SCHEMA, downcast=True)
+        for df_temp in l_df:
+            fb.add(df_temp)
+        df = fb.build()[list(self.DI_OP_SCHEMA)]
+        df['ingest_seq'] = np.arange(len(df))
+        # Rows without an arrival date (eg: blank in the file) can never be in a date range, so they are not stored.
+        # Keeping them would also turn the year and month into floats, and the partitions into eg: 'arrival_year=2018.0'.
+        df = df[df['arrival_date_dt'].notnull()]
+        df = df.assign(arrival_year=df['arrival_date_dt'].dt.year, arrival_month=df['arrival_date_dt'].dt.month)
+
+        # Write to a temp folder first, so that readers never see a half-written store.
+        str_store_folder = self.get_opera_store_folder()
+        str_temp_folder = str_store_folder + '.tmp'
+        shutil.rmtree(str_temp_folder, ignore_errors=True)
+        df.to_parquet(str_temp_folder, partition_cols=['arrival_year', 'arrival_month'], index=False)
+        shutil.rmtree(str_store_folder, ignore_errors=True)
+        os.rename(str_temp_folder, str_store_folder)
+
+        self.logger.info('[ingest_opera_store] Wrote {} rows from {} files into {}'.format(len(df), len(l_df), str_store_folder))
+
+    def get_df_from_opera_store(self, str_dt_from=None, str_dt_to=None, drop_duplicates=True):
+        """ Reads only the (arrival year, arrival month) partitions of the Opera store which overlap str_dt_from to str_dt_to.
+        Filter str_dt_from <= arrival_date <= str_dt_to, then drop duplicates of 'confirmation_number' keeping the first occurrence.
+        Returns the same rows as get_df_from_all_opera_files_sftp() would, at the time of the last ingest_opera_store().
+        :param str_dt_from: Or a list of range starts, with str_dt_to a list of range ends. See get_arrival_date_mask().
+        :param str_dt_to:
+        :param drop_duplicates: If False, duplicates of 'confirmation_number' are kept, in original file and row order.
+        :return: DataFrame
+        """
+        dt_from = pd.to_datetime(str_dt_from)
+        dt_to = pd.to_datetime(str_dt_to)
+        l_ranges = list(zip(dt_from, dt_to)) if pd.api.types.is_list_like(dt_from) else [(dt_from, dt_to)]
+        str_store_folder = self.get_opera_store_folder()
+
+        # First day of each month in any of the ranges.
+        l_months = sorted(set(dt_month for dt_range_from, dt_range_to in l_ranges
+                              for dt_month in pd.date_range(dt_range_from.replace(day=1), dt_range_to, freq='MS')))
+        fb_in = FrameBuilder(di_schema=self.DI_OP_SCHEMA)  # Categories differ between partitions. FrameBuilder unions them.
+        for dt_month in l_months:
+            str_partition = os.path.join(str_store_folder, 'arrival_year={}'.format(dt_month.year),
+                                         'arrival_month={}'.format(dt_month.month))
+            if os.path.isdir(str_partition):
+                fb_in.add(pd.read_parquet(str_partition))
+        self.logger.info('[get_df_from_opera_store] Read {} partitions for {} to {}'.format(len(fb_in), str_dt_from, str_dt_to))
+        if len(fb_in) == 0:
+            raise Exception('No partitions found in the Opera store for the given date range.')
+
+        df_in = fb_in.build()
+        df_in = df_in[self.get_arrival_date_mask(df_in['arrival_date_dt'], dt_from, dt_to)]
+        df_in = df_in.sort_values(by=['ingest_seq'], kind='mergesort')  # Back to original file and row order.
 
-        r = re.compile('.+Historical.+txt$')  # Format: " *Historical*.txt ".
+        # Drop any possible duplicates of 'confirmation_number', keeping the first occurrence.
+        if drop_duplicates:
+            df_in = df_in[~df_in['confirmation_number'].duplicated(keep='first')]
+        df_in = df_in.drop(labels=['ingest_seq'], axis=1).reset_index(drop=True)
 
-        l_op_files = list(filter(r.match, srv.listdir()))  # List of raw Opera files to aggregate. Picks ALL files in directory.
+        return df_in
 
-        df_in = DataFrame()
+    def get_ota_proxy_domains(self):
+        """ Returns the list of OTA domains whose emails are proxies, not the guest's own ("ota_proxy_domains" in [data_sources][opera]).
+        eg: ota_proxy_domains = booking.com, agoda-messaging.com, expediapartnercentral.com
+        Defaults to Booking.com only.
+        """
+        l_ota_domains = self.config['data_sources'].get('opera', {}).get('ota_proxy_domains', ['booking.com'])
+        return [l_ota_domains] if isinstance(l_ota_domains, str) else list(l_ota_domains)  # ConfigObj gives a str for a single value.
+
+    def get_email_quality_counts(self, df_op, sr_label=None):
+        """ Classifies the email of every row in df_op in one vectorised pass (see utils.classify_emails()),
+        then counts per resort with a single grouped aggregation.
+        Columns: 'n' (total rows), 'n_blank', 'n_malformed', 'n_ota_proxy', 'n_valid'.
+        :param df_op: DataFrame from get_df_from_all_opera_files_sftp(). Needs columns 'resort' and 'email'.
+        :param sr_label: Labels from classify_emails(), if already done. Must have the same index as df_op.
+        :return: DataFrame of counts, indexed by resort.
+        """
+        if sr_label is None:
+            sr_label = classify_emails(df_op['email'], l_ota_domains=self.get_ota_proxy_domains())
+        df_labels = DataFrame({'resort': df_op['resort'], 'label': sr_label})
+        # observed=True: 'resort' is Categorical, and resorts with no rows in this period must not appear (as 0/0).
+        df_counts = df_labels.groupby(['resort', 'label'], observed=True).size().unstack(fill_value=0)
+        df_counts = df_counts.reindex(columns=L_EMAIL_LABELS, fill_value=0)  # In case a label does not occur at all.
+        df_counts.columns = ['n_' + str(x) for x in df_counts.columns]
+        df_counts.insert(0, 'n', df_counts.sum(axis=1))
+        return df_counts.astype(int)
+
+    def get_email_quality_pct(self, df_counts):
+        """ Converts counts from get_email_quality_counts() into fractions (0 to 1) of each row's total.
+        Not Collected = Blanks
+        Invalid = Malformed + OTA proxy (eg: Booking.com). We defined OTA proxy emails to be invalid.
+        Valid = Everything else.
+        :param df_counts: DataFrame of counts. Can be per resort, or a single row of totals for the portfolio level.
+        :return: DataFrame with columns ['not_collected', 'invalid', 'valid'], with the same index as df_counts.
+        """
+        return DataFrame({'not_collected': df_counts['n_blank'] / df_counts['n'],
+                          'invalid': (df_counts['n_malformed'] + df_counts['n_ota_proxy']) / df_counts['n'],
+                          'valid': df_counts['n_valid'] / df_counts['n']},
+                         columns=['not_collected', 'invalid', 'valid'])
+
+    @classmethod
+    def is_op_rollup_enabled(cls):
+        """ True if "use_rollup" in [data_sources][opera] is set to True. Then send_op_repeat_guest_monitor() takes its counts from
+        the daily rollup table, and the scheduler keeps the table up to date. See update_op_daily_rollup().
+        get() always counts the Opera rows it attaches, so that the counts and the attachment agree.
+        """
+        return str(cls.config['data_sources'].get('opera', {}).get('use_rollup', 'False')).lower() == 'true'
 
-        for file in l_op_files:
-            if srv.isfile(file):
-                df_temp = self.get_df_from_opera_file_sftp(sftp_srv=srv, str_folder_remote=str_folder_remote, fn=file, str_dt_from=str_dt_from, str_dt_to=str_dt_to)
-                df_in = df_in.append(df_temp, ignore_index=True)
+    def get_op_rollup_tables(self):
+        """ Returns the names of the rollup tables in fehdw, as a tuple of (<daily counts>, <files processed>, <update status>).
+        Base name is "rollup_table" in [data_sources][opera]. Defaults to 'op_email_quality_daily'.
+        """
+        str_table = self.config['data_sources'].get('opera', {}).get('rollup_table', 'op_email_quality_daily')
+        return str_table, str_table + '_files', str_table + '_status'
 
-        # Drop any possible duplicates of 'confirmation_number', keeping the first occurrence.
-        df_in = df_in[~df_in['confirmation_number'].duplicated(keep='first')]
+    def create_op_rollup_tables(self):
+        """ Creates the rollup tables in fehdw, if they do not exist yet.
+        """
+        str_table, str_table_files, str_table_status = self.get_op_rollup_tables()
+        str_sql = """
+        CREATE TABLE IF NOT EXISTS {} (
+        resort VARCHAR(20) NOT NULL,
+        arrival_date DATE NOT NULL,
+        {},
+        PRIMARY KEY (resort, arrival_date)
+        )
+        """.format(str_table, ', '.join('{} INT NOT NULL DEFAULT 0'.format(x) for x in self.L_OP_ROLLUP_COUNTS))
+        pd.io.sql.execute(str_sql, self.db_fehdw_conn)
 
-        srv.close()
-        return df_in
+        str_sql = """
+        CREATE TABLE IF NOT EXISTS {} (
+        filename VARCHAR(255) NOT NULL,
+        size BIGINT NOT NULL,
+        mtime BIGINT NOT NULL,
+        dt_min DATE,
+        dt_max DATE,
+        last_update DATETIME NOT NULL,
+        PRIMARY KEY (filename)
+        )
+        """.format(str_table_files)
+        pd.io.sql.execute(str_sql, self.db_fehdw_conn)
+
+        str_sql = """
+        CREATE TABLE IF NOT EXISTS {} (
+        id TINYINT NOT NULL,
+        is_ok BOOLEAN NOT NULL,
+        message VARCHAR(1000),
+        last_update DATETIME NOT NULL,
+        PRIMARY KEY (id)
+        )
+        """.format(str_table_status)
+        pd.io.sql.execute(str_sql, self.db_fehdw_conn)
+
+    def get_op_daily_counts(self, df_op):
+        """ Counts per resort and arrival date, with the columns in L_OP_ROLLUP_COUNTS. Emails are labelled with classify_emails().
+        :param df_op: DataFrame of filtered Opera rows. Needs columns 'resort', 'email', 'vip_code' and 'arrival_date_dt'.
+        :return: DataFrame with columns ['resort', 'arrival_date'] + L_OP_ROLLUP_COUNTS.
+        """
+        sr_label = classify_emails(df_op['email'], l_ota_domains=self.get_ota_proxy_domains())
+        df = DataFrame({'resort': df_op['resort'], 'arrival_date': df_op['arrival_date_dt'].dt.date, 'n': 1,
+                        'n_blank': sr_label == 'blank', 'n_malformed': sr_label == 'malformed',
+                        'n_ota_proxy': sr_label == 'ota_proxy', 'n_repeat_guest': df_op['vip_code'] == 'Repeat Guests'},
+                       index=df_op.index)
+        df = df.groupby(['resort', 'arrival_date'], observed=True).sum().astype(int).reset_index()
+        return df[['resort', 'arrival_date'] + self.L_OP_ROLLUP_COUNTS]
+
+    def update_op_daily_rollup(self, str_folder_remote='/C/FESFTP/Opera'):
+        """ Brings the daily per-resort rollup table up to date with the Opera files on the SFTP server.
+        Only files which are new, changed (by size and mtime) or removed since the last update are looked at. Nothing is read
+        if there are none. Otherwise the daily counts are recomputed from the current data of ALL files. The rollup rows are
+        replaced (DELETE + INSERT) for the arrival dates which these files cover (now, or at the last update), and for any other
+        date whose counts differ from the table. So changes to bookings already counted (eg: cancellations, emails added or
+        fixed, VIP code changes, arrival date moves) are picked up, and nothing drifts.
+        Unchanged files are read from the local SFTP cache. See get_l_df_from_all_opera_files_sftp().
+        Duplicates of 'confirmation_number' are dropped over ALL files, keeping the first occurrence, then counted by arrival date.
+        So the table is always the same as from a full rebuild. It differs from get() only for a booking whose arrival date
+        moved between files: get() de-duplicates within its date range, so it may count such a booking at either date.
+        All writes are done in one transaction, so that a failed update leaves the tables as they were.
+        The outcome is kept in the <rollup_table>_status table. See is_op_rollup_current().
+        :param str_folder_remote:
+        :return: NA
+        """
+        try:
+            self.create_op_rollup_tables()
+            self._update_op_daily_rollup(str_folder_remote)
+        except Exception as ex:
+            self.set_op_rollup_status(False, str(ex))
+            raise
+        self.set_op_rollup_status(True, '')
+
+    def _update_op_daily_rollup(self, str_folder_remote):
+        """ Does the work of update_op_daily_rollup(), which records its outcome.
+        """
+        str_table, str_table_files, _ = self.get_op_rollup_tables()
+
+        df_files = pd.read_sql('SELECT filename, size, mtime, dt_min, dt_max FROM {}'.format(str_table_files), self.db_fehdw_conn)
+        di_files_done = {row.filename: row for row in df_files.itertuples(index=False)}
+        l_op_attrs_all = self.list_opera_files_sftp(str_folder_remote=str_folder_remote)
+        l_op_attrs = [attr for attr in l_op_attrs_all if (attr.filename not in di_files_done) or
+                      ((int(attr.st_size), int(attr.st_mtime)) !=
+                       (int(di_files_done[attr.filename].size), int(di_files_done[attr.filename].mtime)))]
+        set_removed = set(di_files_done) - set(attr.filename for attr in l_op_attrs_all)
+        if (len(l_op_attrs) == 0) and (len(set_removed) == 0):
+            self.logger.info('[update_op_daily_rollup] No new, changed or removed files.')
+            return
+
+        # ARRIVAL DATES AFFECTED # Those in the new and changed files, and those which the changed and removed files held before.
+        l_df = self.get_l_df_from_all_opera_files_sftp(str_folder_remote=str_folder_remote,
+                                                       l_filenames=[attr.filename for attr in l_op_attrs])
+        l_ranges = []
+        l_di_files = []
+        for attr, df_temp in zip(l_op_attrs, l_df):
+            dt_min, dt_max = df_temp['arrival_date_dt'].min(), df_temp['arrival_date_dt'].max()
+            if not pd.isnull(dt_min):
+                l_ranges.append((dt_min, dt_max))
+            l_di_files.append({'filename': attr.filename, 'size': int(attr.st_size), 'mtime': int(attr.st_mtime),
+                               'dt_min': None if pd.isnull(dt_min) else dt_min.date(),
+                               'dt_max': None if pd.isnull(dt_max) else dt_max.date(), 'last_update': dt.datetime.now()})
+        del l_df
+        for str_fn in [attr.filename for attr in l_op_attrs] + sorted(set_removed):
+            row = di_files_done.get(str_fn)
+            if (row is not None) and not pd.isnull(row.dt_min):
+                l_ranges.append((pd.to_datetime(row.dt_min), pd.to_datetime(row.dt_max)))
+
+        # RECOMPUTE FROM ALL FILES # Duplicates of 'confirmation_number' are dropped over all files (keeping the first occurrence,
+        # in listing order) before any date is looked at. So the counts are those of a full rebuild, whichever dates are written.
+        # Only the daily counts of each file are kept.
+        l_df_counts = [self.get_op_daily_counts(df_temp) for df_temp in
+                       self.iter_df_from_all_opera_files_sftp(str_folder_remote=str_folder_remote, drop_duplicates=True)]
+        df_counts = pd.concat(l_df_counts) if l_df_counts else DataFrame(columns=['resort', 'arrival_date'] + self.L_OP_ROLLUP_COUNTS)
+        df_counts = df_counts.astype({'resort': str}).groupby(['resort', 'arrival_date']).sum().astype(int).reset_index()
+
+        # Also the dates whose counts differ from the table. eg: A booking whose first occurrence was in a removed file, or which
+        # first occurs in a new file, is now counted at the arrival date of its new first occurrence.
+        df_done = pd.read_sql('SELECT resort, arrival_date, {} FROM {}'.format(', '.join(self.L_OP_ROLLUP_COUNTS), str_table),
+                              self.db_fehdw_conn)
+
+        def get_set_rows(df):
+            return set(zip(df['resort'].astype(str), pd.to_datetime(df['arrival_date']),
+                           *[df[x].astype(int) for x in self.L_OP_ROLLUP_COUNTS]))
+
+        l_ranges += [(tup[1], tup[1]) for tup in get_set_rows(df_counts) ^ get_set_rows(df_done)]
+        l_dt_from, l_dt_to = self.merge_date_ranges(l_ranges)
+        if l_dt_from:
+            sr_mask = self.get_arrival_date_mask(pd.to_datetime(df_counts['arrival_date']), pd.to_datetime(l_dt_from),
+                                                 pd.to_datetime(l_dt_to))
+            l_di_counts = df_counts[sr_mask].astype(object).to_dict('records')  # Python ints, for the DB driver.
+        else:
+            l_di_counts = []
+
+        str_sql = 'INSERT INTO {} (resort, arrival_date, {}) VALUES (:resort, :arrival_date, {})'.format(
+            str_table, ', '.join(self.L_OP_ROLLUP_COUNTS), ', '.join(':' + x for x in self.L_OP_ROLLUP_COUNTS))
+        with self.db_fehdw_conn.begin():
+            if l_dt_from:
+                self.db_fehdw_conn.execute(sqlalchemy.text(
+                    'DELETE FROM {} WHERE arrival_date >= :dt_from AND arrival_date <= :dt_to'.format(str_table)),
+                    [{'dt_from': str_dt_from, 'dt_to': str_dt_to} for str_dt_from, str_dt_to in zip(l_dt_from, l_dt_to)])
+            if l_di_counts:
+                self.db_fehdw_conn.execute(sqlalchemy.text(str_sql), l_di_counts)
+            if set_removed:
+                self.db_fehdw_conn.execute(sqlalchemy.text('DELETE FROM {} WHERE filename = :filename'.format(str_table_files)),
+                                           [{'filename': str_fn} for str_fn in sorted(set_removed)])
+            if l_di_files:
+                self.db_fehdw_conn.execute(sqlalchemy.text(
+                    'REPLACE INTO {} (filename, size, mtime, dt_min, dt_max, last_update) '
+                    'VALUES (:filename, :size, :mtime, :dt_min, :dt_max, :last_update)'.format(str_table_files)), l_di_files)
+
+        self.logger.info('[update_op_daily_rollup] {} new or changed files, {} removed. Recomputed {} resort-days in {} date ranges.'
+                         .format(len(l_op_attrs), len(set_removed), len(l_di_counts), len(l_dt_from)))
+
+    def set_op_rollup_status(self, is_ok, str_message):
+        """ Records the outcome of the last update_op_daily_rollup(). Errors are only logged, as this runs on the error path too.
+        """
+        _, _, str_table_status = self.get_op_rollup_tables()
+        try:
+            with self.db_fehdw_conn.begin():
+                self.db_fehdw_conn.execute(sqlalchemy.text(
+                    'REPLACE INTO {} (id, is_ok, message, last_update) VALUES (1, :is_ok, :message, :last_update)'.format(
+                        str_table_status)), {'is_ok': is_ok, 'message': str_message[:1000], 'last_update': dt.datetime.now()})
+        except Exception as ex:
+            self.logger.error('[set_op_rollup_status] {}'.format(ex))
+
+    def is_op_rollup_current(self):
+        """ True if the last update_op_daily_rollup() succeeded. False if it failed, or if there has been none.
+        """
+        _, _, str_table_status = self.get_op_rollup_tables()
+        try:
+            df = pd.read_sql('SELECT is_ok FROM {} WHERE id = 1'.format(str_table_status), self.db_fehdw_conn)
+        except Exception:  # Assume that the table does not exist yet.
+            return False
+        return (len(df) > 0) and bool(df['is_ok'].iloc[0])
+
+    @staticmethod
+    def merge_date_ranges(l_ranges):
+        """ Merges date ranges which overlap or adjoin. Ranges which do not are kept apart (the gaps are not bridged).
+        :param l_ranges: List of (dt_from, dt_to) tuples, inclusive. Anything pd.to_datetime() takes.
+        :return: 2-tuple of (<list of range starts>, <list of range ends>), sorted, as strings. eg: (['2018-03-01'], ['2018-03-31']).
+        """
+        l_merged = []
+        for dt_from, dt_to in sorted((pd.to_datetime(x[0]), pd.to_datetime(x[1])) for x in l_ranges):
+            if l_merged and (dt_from <= l_merged[-1][1] + pd.Timedelta(days=1)):  # Overlaps or adjoins the previous range.
+                l_merged[-1][1] = max(l_merged[-1][1], dt_to)
+            else:
+                l_merged.append([dt_from, dt_to])
+        return ([dt.datetime.strftime(x[0], '%Y-%m-%d') for x in l_merged],
+                [dt.datetime.strftime(x[1], '%Y-%m-%d') for x in l_merged])
+
+    def get_op_rollup_daily_totals(self, str_dt_from, str_dt_to):
+        """ Portfolio totals per arrival date from the daily rollup table, for arrival dates str_dt_from to str_dt_to (inclusive).
+        Every date in the range has a row. Dates without bookings are 0.
+        :param str_dt_from:
+        :param str_dt_to:
+        :return: DataFrame with columns L_OP_ROLLUP_COUNTS, indexed by arrival date (datetime).
+        """
+        str_table, _, _ = self.get_op_rollup_tables()
+        str_sql = """
+        SELECT arrival_date, {} FROM {}
+        WHERE arrival_date >= '{}' AND arrival_date <= '{}'
+        GROUP BY arrival_date
+        """.format(', '.join('SUM({0}) AS {0}'.format(x) for x in self.L_OP_ROLLUP_COUNTS), str_table, str_dt_from, str_dt_to)
+        df = pd.read_sql(str_sql, self.db_fehdw_conn, index_col='arrival_date').astype(int)
+        df.index = pd.to_datetime(df.index)
+        return df.reindex(pd.date_range(str_dt_from, str_dt_to, freq='D'), fill_value=0)
+
+    def get_repeat_guest_ratios(self, str_dt_to, l_days=(30, 90, 365)):
+        """ Repeat guest ratios (repeat guests / all bookings) over rolling windows of arrival dates, ending on str_dt_to (inclusive).
+        Computed from one query of the daily rollup table, covering the longest window. No Opera files are read.
+        :param str_dt_to: Last arrival date of every window.
+        :param l_days: Window lengths, in days.
+        :return: Series of ratios (0 to 1), indexed by window length in days. NaN if a window has no bookings.
+        """
+        dt_to = pd.to_datetime(str_dt_to)
+        dt_from = dt_to - pd.Timedelta(days=max(l_days) - 1)
+        df = self.get_op_rollup_daily_totals(dt.datetime.strftime(dt_from, '%Y-%m-%d'), dt.datetime.strftime(dt_to, '%Y-%m-%d'))
+        # Cumulative sums from the latest date backwards. Each window is then a single lookup.
+        df_cum = df[['n', 'n_repeat_guest']].iloc[::-1].cumsum()
+        return Series({i_days: (df_cum['n_repeat_guest'].iloc[i_days - 1] / df_cum['n'].iloc[i_days - 1])
+                       if df_cum['n'].iloc[i_days - 1] else np.nan for i_days in l_days})
+
+    def get_windows(self, di_windows, from_store=None):
+        """ Computes the per-resort email quality counts for several arrival date windows, from a single read of the Opera files.
+        The union of the windows is read once (overlapping windows are merged; disjoint ones are not bridged), and every email
+        is classified once.
+        Each window is then cut out of that dataset with a vectorised date mask, and de-duplicated within the window,
+        which gives the same rows as reading the window on its own.
+        The rows and counts of each window are put in the run cache, so that a following get() for the same window costs nothing.
+        eg: rb.get_windows({'weekly': ('2018-04-20', '2018-04-26'), 'monthly': ('2018-03-01', '2018-03-31')})
+        :param di_windows: dict of {<window name>: (str_dt_from, str_dt_to)}.
+        :param from_store: Passed to get_df_from_all_opera_files_sftp(). Defaults to is_op_store_enabled().
+        :return: dict of {<window name>: DataFrame of counts from get_email_quality_counts()}.
+        """
+        if from_store is None:
+            from_store = self.is_op_store_enabled()
+        l_dt_from, l_dt_to = self.merge_date_ranges(di_windows.values())  # Union of the windows.
+
+        # Duplicates are kept here, in file and row order. A booking may fall into one window but not another.
+        df_all = self.get_dataset(('opera_sftp_all', tuple(l_dt_from), tuple(l_dt_to)),
+                                  lambda: self.get_df_from_all_opera_files_sftp(str_dt_from=l_dt_from, str_dt_to=l_dt_to,
+                                                                                from_store=from_store, drop_duplicates=False))
+        sr_label = classify_emails(df_all['email'], l_ota_domains=self.get_ota_proxy_domains())
+
+        di_counts = {}
+        for str_window, (str_dt_from, str_dt_to) in di_windows.items():
+            arr_keep = ((df_all['arrival_date_dt'] >= pd.to_datetime(str_dt_from)) &
+                        (df_all['arrival_date_dt'] <= pd.to_datetime(str_dt_to))).to_numpy(copy=True)
+            # Of the rows in the window, keep the first occurrence of each 'confirmation_number'.
+            arr_keep[arr_keep] = ~df_all['confirmation_number'][arr_keep].duplicated(keep='first').to_numpy()
+
+            df_op = self.get_dataset(('opera_sftp', str_dt_from, str_dt_to), lambda: df_all[arr_keep].reset_index(drop=True))
+            di_counts[str_window] = self.get_dataset(('op_email_counts', str_dt_from, str_dt_to),
+                                                     lambda: self.get_email_quality_counts(
+                                                         df_op, sr_label=sr_label[arr_keep].reset_index(drop=True)))
+            self.logger.info('[get_windows] {}: {} to {}, {} rows'.format(str_window, str_dt_from, str_dt_to, len(df_op)))
+        return di_counts
+
+    def backfill_email_quality(self, str_dt_from, str_dt_to, str_folder_remote='/C/FESFTP/Opera', save_history=False):
+        """ Computes the per-resort email quality counts of every month from str_dt_from to str_dt_to, in a single pass over the
+        Opera files. Meant for rebuilding months or years of history, instead of calling get() once per month.
+        Files are read with iter_df_from_all_opera_files_sftp() (connection pool, local cache, read-ahead of a few files), and each
+        row is routed to the month of its arrival date. Only running counts, and the confirmation numbers seen per month, are kept.
+        Memory therefore grows with the number of distinct bookings in the period (the confirmation numbers), not with the rows
+        or columns of the files read.
+        Each month gives the same counts as get() for that month: duplicates of 'confirmation_number' are dropped within the month,
+        keeping the first occurrence in file and row order.
+        :param str_dt_from:
+        :param str_dt_to:
+        :param str_folder_remote:
+        :param save_history: If True, save each month's results with save_email_quality_history().
+        :return: DataFrame of counts (same columns as get_email_quality_counts()), indexed by (month, resort). eg: ('2018-03', 'HRS').
+        """
+        dt_from = pd.to_datetime(str_dt_from)
+        dt_to = pd.to_datetime(str_dt_to)
+        l_ota_domains = self.get_ota_proxy_domains()
+        di_key_filters = {}  # {<month>: UniqueKeyFilter}. Duplicates are dropped within each month.
+        sr_counts = None  # Running counts, indexed by (month, resort, label).
+
+        i_files = 0
+        # Files come in listing order, so the first occurrence kept within each month is the same as for get().
+        for df in self.iter_df_from_all_opera_files_sftp(str_folder_remote=str_folder_remote, str_dt_from=str_dt_from,
+                                                         str_dt_to=str_dt_to, drop_duplicates=False):
+            i_files += 1
+            df = df.reset_index(drop=True)  # Index = row position, for the keep mask below.
+            sr_month = df['arrival_date_dt'].dt.strftime('%Y-%m')
+
+            arr_keep = np.zeros(len(df), dtype=bool)
+            for str_month, arr_idx in sr_month.groupby(sr_month).indices.items():  # Row positions are in row order.
+                key_filter = di_key_filters.setdefault(str_month, UniqueKeyFilter('confirmation_number'))
+                arr_keep[key_filter.filter(df.iloc[arr_idx][['confirmation_number']]).index] = True
+
+            # As str, not Categorical. Categories differ between files, and the counts of all files are added up.
+            df_labels = DataFrame({'month': sr_month[arr_keep], 'resort': df['resort'][arr_keep].astype(str),
+                                   'label': classify_emails(df['email'][arr_keep], l_ota_domains=l_ota_domains).astype(str)})
+            sr_file_counts = df_labels.groupby(['month', 'resort', 'label']).size()
+            sr_counts = sr_file_counts if sr_counts is None else sr_counts.add(sr_file_counts, fill_value=0)
+            del df, df_labels  # Only the counts are kept from each file.
+
+        if sr_counts is None:
+            raise Exception('No Opera files found.')
+        df_counts = sr_counts.astype(int).unstack(fill_value=0)
+        df_counts = df_counts.reindex(columns=L_EMAIL_LABELS, fill_value=0)  # In case a label does not occur at all.
+        df_counts.columns = ['n_' + str(x) for x in df_counts.columns]
+        df_counts.insert(0, 'n', df_counts.sum(axis=1))
+        df_counts.index.names = ['month', 'resort']
+        self.logger.info('[backfill_email_quality] {} files, {} months.'.format(i_files, len(di_key_filters)))
+
+        if save_history:
+            for str_month in df_counts.index.get_level_values('month').unique():
+                dt_month = pd.to_datetime(str_month + '-01')
+                dt_month_end = dt_month + pd.offsets.MonthEnd(0)
+                df_out = self.get_df_out(df_counts.loc[str_month], dt.datetime.strftime(dt_month, '%m_%Y'))
+                self.save_email_quality_history(df_out=df_out,
+                                                str_dt_from=dt.datetime.strftime(max(dt_month, dt_from), '%Y-%m-%d'),
+                                                str_dt_to=dt.datetime.strftime(min(dt_month_end, dt_to), '%Y-%m-%d'))
+        return df_counts
 
     @dec_err_handler(retries=0)
     def get(self, str_dt_from, str_dt_to):
@@ -915,76 +2374,125 @@ class OperaEmailQualityMonitorReportBot(ReportBot):
         self.str_dt_from = str_dt_from
         self.str_dt_to = str_dt_to
 
-        # Get data from text files.
-        df_op = self.get_df_from_all_opera_files_sftp(str_dt_from=str_dt_from, str_dt_to=str_dt_to)  # Get using SFTP protocol.
+        # Get data from text files. Get using SFTP protocol. Or from the Opera store, if enabled (see is_op_store_enabled()).
+        # Cached for the run, so that other reports for the same period (eg: op_repeat_guest_monitor) do not re-read the files.
+        df_op = self.get_dataset(('opera_sftp', str_dt_from, str_dt_to),
+                                 lambda: self.get_df_from_all_opera_files_sftp(str_dt_from=str_dt_from, str_dt_to=str_dt_to,
+                                                                               from_store=self.is_op_store_enabled()))
         self.df_op = df_op  # Work-around. Solely for use with send_op_repeat_guest_monitor().
 
         # Create XLSX file to send as email attachment; delete file immediately after sending.
+        # Large lists may be written as a zipped CSV instead. See write_attachment().
         str_fn = 'email_list - {} to {}.xlsx'.format(str_dt_from, str_dt_to)
-        self.str_fn = str_fn
         str_email_attach_fn = os.path.join(os.getcwd(), str_fn)  # Fully qualified path to Excel file.
-        self.str_email_attach_fn = str_email_attach_fn
         df_email_attach = df_op[
             ['resort', 'confirmation_number', 'email', 'first_name', 'last_name', 'market_code', 'rate_code',
              'arrival_date_dt']]
-        df_email_attach.to_excel(str_email_attach_fn, index=False)
+        str_email_attach_fn = self.write_attachment(df_email_attach, str_email_attach_fn, str_report='op_email_list')
+        self.str_email_attach_fn = str_email_attach_fn
+        self.str_fn = os.path.basename(str_email_attach_fn)
 
-        df = df_op[['resort', 'email']]  # taken only relevant columns.
-        df['email_is_blank'] = df['email'] == ''
-        df['email_is_valid_tech'] = df['email'].apply(self.check_valid_email)
+        # Classify every email once, and count per resort in a single groupby. Portfolio level is the sum over all resorts.
+        # Already in the run cache if get_windows() was called for this period.
+        # Always counted from df_op, even if the rollup is enabled, so that the counts agree with the attachment.
+        df_counts = self.get_dataset(('op_email_counts', str_dt_from, str_dt_to),
+                                     lambda: self.get_email_quality_counts(df_op))
+        self.df_counts = df_counts
+        df_counts = df_counts[['n'] + ['n_' + x for x in L_EMAIL_LABELS]]
+        sr_portfolio = self.get_email_quality_pct(df_counts.sum().to_frame().T).iloc[0]
 
         # PORTFOLIO LEVEL STATISTICS #
-        i_size = len(df)
-        # Invalid = TechnicallyInvalid - Blanks + Booking.com
-        i_bookingdotcom = len(df[df['email'].str.contains('BOOKING.COM', case=False)])
-        i_invalid = sum(~df['email_is_valid_tech']) - sum(df['email_is_blank']) + i_bookingdotcom
-
-        # Valid = TechnicallyValid - Booking.com
+        # Invalid = Malformed + OTA proxy (eg: Booking.com)
         str_portfolio_level_stats = """ Here is the email collection information from Opera:
                 
         <b>[PORTFOLIO LEVEL STATISTICS]</b>
         Not Collected: {}% 
         Invalid: {}% 
         Valid: {}% 
-        """.format(round( (sum(df['email_is_blank']) / i_size) * 100, 1),
-                  round( i_invalid / i_size * 100, 1),
-                  round( (sum(df['email_is_valid_tech']) - i_bookingdotcom) / i_size * 100, 1)
-                  )
+        """.format(round(sr_portfolio['not_collected'] * 100, 1),
+                   round(sr_portfolio['invalid'] * 100, 1),
+                   round(sr_portfolio['valid'] * 100, 1)
+                   )
 
         self.str_portfolio_level_stats = str_portfolio_level_stats
 
-        sr_email_is_blank = ( df[df['email_is_blank']==True].groupby(['resort']).size() ) / ( df.groupby(['resort']).size() )
-        sr_email_is_blank.fillna(0., inplace=True)
-        sr_email_is_invalid_tech = df[df['email_is_valid_tech']==False].groupby(['resort']).size() / ( df.groupby(['resort']).size())
-        sr_email_is_invalid_tech.fillna(0., inplace=True)
-        sr_email_is_valid_tech = df[df['email_is_valid_tech']==True].groupby(['resort']).size() / ( df.groupby(['resort']).size())
-        sr_email_is_invalid_less_blanks = sr_email_is_invalid_tech - sr_email_is_blank  # Percent of emails which are invalid, less blanks.
-        sr_email_has_bookingdotcom_domain = df[df['email'].str.contains('BOOKING.COM', case=False)].groupby(['resort']).size() / ( df.groupby(['resort']).size() )
-        sr_email_has_bookingdotcom_domain.fillna(0., inplace=True)  # Replace NaN with 0, so that downstream operations will not become NaN unnecessarily.
+        str_month_year = dt.datetime.strftime(dt.datetime.today() - dt.timedelta(days=30), '%m_%Y')  # Last month.
+        self.df_out = self.get_df_out(df_counts, str_month_year)
 
-        # We defined booking.com emails to be invalid.
-        sr_email_invalid = sr_email_is_invalid_less_blanks + sr_email_has_bookingdotcom_domain
-        sr_email_valid = sr_email_is_valid_tech - sr_email_has_bookingdotcom_domain
-
-        df_out = DataFrame({'not_collected': sr_email_is_blank, 'invalid':sr_email_invalid, 'valid': sr_email_valid})
-        #df_out = df_out[['blank_email_percent', 'invalid_email_less_blanks_percent', 'valid_email_percent', 'email_contains_bookingdotcom_percent']]
+    def get_df_out(self, df_counts, str_month_year):
+        """ Turns per-resort counts into the per-hotel table of percentages, as sent in the email and kept in the history table.
+        :param df_counts: DataFrame of counts from get_email_quality_counts(), indexed by resort.
+        :param str_month_year: Value of the 'month_year' column. Format: '%m_%Y'. eg: '03_2019'.
+        :return: DataFrame with columns ['month_year', 'Hotel', 'Not Collected', 'Invalid', 'Valid'].
+        """
+        df_out = self.get_email_quality_pct(df_counts)
 
         # Map new hotel codes to old hotel codes.
         #df_hotel_codes = pd.read_excel('C:/AA/python/mapping/mapping_hotel_codes.xlsx', keep_default_na=False, na_values=[' '])
         str_sql = """
         SELECT * FROM cfg_map_properties WHERE operator = 'feh' 
         """
-        df_hotel_codes = pd.read_sql(str_sql, self.db_fehdw_conn)
+        df_hotel_codes = self.get_dataset(('cfg_map_properties', 'feh'), lambda: pd.read_sql(str_sql, self.db_fehdw_conn))
         df_out.index = Series(df_out.index).map(Series(list(df_hotel_codes['new_code']), index=df_hotel_codes['hotel_code']))
         df_out = df_out[['not_collected', 'invalid', 'valid']]
         df_out = round(df_out * 100, 1)  # convert to percentage (based on 100)
         df_out.reset_index(drop=False, inplace=True)
         df_out.columns = ['Hotel', 'Not Collected', 'Invalid', 'Valid']  # rename to preferred column labels.
 
-        df_out['month_year'] = dt.datetime.strftime(dt.datetime.today() - dt.timedelta(days=30), '%m_%Y')  # Last month.
+        df_out['month_year'] = str_month_year
         df_out = df_out.iloc[:, [-1]+list(range(0, len(df_out.columns)-1)) ]
+        return df_out
 
-        self.df_out = df_out
+    @dec_err_handler(retries=0)
+    def save_email_quality_history(self, df_out=None, str_dt_from=None, str_dt_to=None):
+        """ Saves per-hotel results into a history table in fehdw, for trend queries. By default, those of the last get() (self.df_out).
+        Idempotent per month: The month's rows are deleted and re-inserted in one transaction, so a re-run replaces them.
+        All rows are inserted with a single batched INSERT statement.
+        Table name is "history_table" in [data_sources][opera]. Defaults to 'op_email_quality_monthly'.
+        :param df_out: DataFrame from get_df_out(), for one month. Defaults to self.df_out.
+        :param str_dt_from: Period of arrival dates which df_out covers. Defaults to the period of the last get().
+        :param str_dt_to:
+        :return: NA
+        """
+        str_table = self.config['data_sources'].get('opera', {}).get('history_table', 'op_email_quality_monthly')
+        str_sql = """
+        CREATE TABLE IF NOT EXISTS {} (
+        month_year VARCHAR(7) NOT NULL,
+        month_start DATE NOT NULL,
+        hotel VARCHAR(20) NOT NULL,
+        not_collected DOUBLE,
+        invalid DOUBLE,
+        valid DOUBLE,
+        dt_from DATE,
+        dt_to DATE,
+        last_update DATETIME NOT NULL,
+        PRIMARY KEY (month_year, hotel)
+        )
+        """.format(str_table)
+        pd.io.sql.execute(str_sql, self.db_fehdw_conn)
+
+        df = (self.df_out if df_out is None else df_out).copy()
+        df.columns = [str(x).lower().replace(' ', '_') for x in df.columns]  # eg: 'Not Collected' -> 'not_collected'.
+        if df['hotel'].isnull().any():  # Resort codes with no mapping in cfg_map_properties.
+            self.logger.warning('[save_email_quality_history] Skipped {} rows without a hotel code.'.format(df['hotel'].isnull().sum()))
+            df = df[df['hotel'].notnull()]
+        str_month_year = df['month_year'].iloc[0]  # Format: '%m_%Y'. Same for all rows.
+        df['month_start'] = pd.to_datetime('01_' + df['month_year'], format='%d_%m_%Y').dt.date
+        df['dt_from'] = pd.to_datetime(self.str_dt_from if str_dt_from is None else str_dt_from).date()
+        df['dt_to'] = pd.to_datetime(self.str_dt_to if str_dt_to is None else str_dt_to).date()
+        df['last_update'] = dt.datetime.now()
+        l_cols = ['month_year', 'month_start', 'hotel', 'not_collected', 'invalid', 'valid', 'dt_from', 'dt_to', 'last_update']
+        l_di_rows = df[l_cols].astype(object).to_dict('records')  # Python types, which the DB driver can take.
+
+        # The driver combines the rows of an INSERT ... VALUES executemany into a single multi-row statement.
+        str_sql = 'INSERT INTO {} ({}) VALUES ({})'.format(str_table, ', '.join(l_cols), ', '.join(':' + x for x in l_cols))
+        with self.db_fehdw_conn.begin():
+            self.db_fehdw_conn.execute(sqlalchemy.text('DELETE FROM {} WHERE month_year = :month_year'.format(str_table)),
+                                       {'month_year': str_month_year})
+            if l_di_rows:
+                self.db_fehdw_conn.execute(sqlalchemy.text(str_sql), l_di_rows)
+
+        self.logger.info('[save_email_quality_history] Saved {} rows for {} into {}'.format(len(l_di_rows), str_month_year, str_table))
 
     @dec_err_handler(retries=0)
     def send(self, str_listname=None, str_subject=None):
@@ -1035,22 +2543,63 @@ class OperaEmailQualityMonitorReportBot(ReportBot):
         # Write to log file #
         self.logger.info('Sent email to list "{}" with subject "{}"'.format(str_listname, str_subject))
 
+    @staticmethod
+    def format_pct(f_ratio):
+        """ Formats a ratio (0 to 1) as a percentage, to 2 decimal places. eg: 0.12345 -> '12.35%'. 'n/a' if missing (NaN).
+        """
+        return 'n/a' if pd.isnull(f_ratio) else '{}%'.format(round(f_ratio * 100, 2))
+
     @dec_err_handler(retries=0)
-    def send_op_repeat_guest_monitor(self, str_listname=None, str_subject=None):
+    def send_op_repeat_guest_monitor(self, str_listname=None, str_subject=None, str_dt_from=None, str_dt_to=None):
         """ This method is a hack, to handle the "op_repeat_guest_monitor" report, which is only slightly different
         from the opera_email_quality_monitor reports. This method uses self.df_op, populated in get(), and takes it from there.
+        If the rollup is enabled (see is_op_rollup_enabled()), the counts are summed from the daily rollup table instead,
+        and get() need not be called at all. The email then also shows the rolling 30/90/365-day ratios.
+        If the last rollup update failed (see is_op_rollup_current()), the rollup is not used, and get() is called for the period
+        (if not already done), so that the email is not based on stale counts.
         :param str_listname:
         :param str_subject:
+        :param str_dt_from: Period of arrival dates. Defaults to the period of the last get(). Required if get() was not called.
+        :param str_dt_to:
         :return: NA
         """
-        df_op = self.df_op
-        # Calculate percentage
-        i_repeat_guests = len(df_op[df_op['vip_code'] == 'Repeat Guests'])
-        i_total_guests = len(df_op)
-        str_percent = str(round(i_repeat_guests / i_total_guests * 100, 2))
+        str_dt_from = getattr(self, 'str_dt_from', None) if str_dt_from is None else str_dt_from
+        str_dt_to = getattr(self, 'str_dt_to', None) if str_dt_to is None else str_dt_to
+        if (str_dt_from is None) or (str_dt_to is None):
+            raise Exception('[send_op_repeat_guest_monitor] No period given. Pass str_dt_from and str_dt_to, or call get() first.')
+
+        str_msg_rolling = ''
+        is_rollup = self.is_op_rollup_enabled() and self.is_op_rollup_current()
+        if self.is_op_rollup_enabled() and not is_rollup:
+            self.logger.warning('[send_op_repeat_guest_monitor] Last rollup update failed. Using the Opera files instead.')
+        if (not is_rollup) and ((getattr(self, 'str_dt_from', None), getattr(self, 'str_dt_to', None)) != (str_dt_from, str_dt_to)):
+            self.df_op = None
+            self.get(str_dt_from=str_dt_from, str_dt_to=str_dt_to)  # Opera data comes from the run cache, if already read.
+            if self.df_op is None:  # get() logs and swallows its errors.
+                raise Exception('[send_op_repeat_guest_monitor] No Opera data for {} to {}.'.format(str_dt_from, str_dt_to))
+        if is_rollup:
+            df_daily = self.get_op_rollup_daily_totals(str_dt_from, str_dt_to)
+            i_repeat_guests = df_daily['n_repeat_guest'].sum()
+            i_total_guests = df_daily['n'].sum()
+            sr_dt_booked = df_daily.index[df_daily['n'] > 0]  # Arrival dates with bookings.
+            dt_arr_min, dt_arr_max = sr_dt_booked.min(), sr_dt_booked.max()
+
+            sr_ratios = self.get_repeat_guest_ratios(str_dt_to)
+            str_msg_rolling = '<br />'.join('<b> Last {} days: {} </b>'.format(i_days, self.format_pct(f_ratio))
+                                            for i_days, f_ratio in sr_ratios.items())
+            str_msg_rolling = '<p> Rolling percentage of repeat guests, up to {}: </p>'.format(str_dt_to) + str_msg_rolling
+        else:
+            df_op = self.df_op
+            i_repeat_guests = len(df_op[df_op['vip_code'] == 'Repeat Guests'])
+            i_total_guests = len(df_op)
+            dt_arr_min, dt_arr_max = df_op['arrival_date_dt'].min(), df_op['arrival_date_dt'].max()
+        # Calculate percentage. 'n/a' if there are no bookings in the period.
+        str_percent = self.format_pct(i_repeat_guests / i_total_guests if i_total_guests else np.nan)
         # Calculate date range of arrival_date for data set used. For user to get a feel of whether the data set used was correct or not.
-        str_arr_dt_min = dt.datetime.strftime(df_op['arrival_date_dt'].min(), format='%Y-%m-%d')
-        str_arr_dt_max = dt.datetime.strftime(df_op['arrival_date_dt'].max(), format='%Y-%m-%d')
+        if pd.isnull(dt_arr_min):  # No bookings.
+            str_arr_dt_range = 'n/a (no bookings)'
+        else:
+            str_arr_dt_range = dt.datetime.strftime(dt_arr_min, '%Y-%m-%d') + ' to ' + dt.datetime.strftime(dt_arr_max, '%Y-%m-%d')
 
         # Craft the email message #
         str_msg = """
@@ -1060,13 +2609,13 @@ class OperaEmailQualityMonitorReportBot(ReportBot):
         This measurement is done as a management metric to measure for the direct booking initiative a.k.a. 
         Insiders' Programme for 2018.
         </p>
-        <b> Percentage of repeat guests: {}% </b> <br />
+        <b> Percentage of repeat guests: {} </b> <br />
         <b> Arrival Date Range in Source Data Set: {} </b>
-        """.format(str_percent, str_arr_dt_min + ' to ' + str_arr_dt_max)
+        """.format(str_percent, str_arr_dt_range)
 
         di_params = {'str_msg': str_msg,  # Handcrafted msg.
                      'str_df': '',
-                     'str_msg2': '',
+                     'str_msg2': str_msg_rolling,
                      'year': dt.datetime.now().year
                      }
         str_html = self.build_body(str_template_file='jinja_basic_frame.html', di_params=di_params)
@@ -1096,7 +2645,8 @@ class OperaEmailQualityMonitorReportBot(ReportBot):
         s = smtplib.SMTP(host=MAIL_SERVER, port=PORT)
         s.sendmail(SENDER, l_email_recipients, msg.as_string())
         s.quit()
-        os.remove(self.str_email_attach_fn)  # Delete the Excel file.
+        if os.path.isfile(getattr(self, 'str_email_attach_fn', '')):  # Only there if get() was called.
+            os.remove(self.str_email_attach_fn)  # Delete the Excel file.
 
         # Write to log file #
         self.logger.info('Sent email with subject "{}"'.format(str_subject))
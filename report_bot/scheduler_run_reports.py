@@ -24,46 +24,73 @@ logger.addHandler(fh_logger_global)  # Add global handler.
 
 try:
     sys.path.insert(0, 'C:/webapps')  # Must be here, or the statement below does not work.
-    from report_bot.report_bot import OperaEmailQualityMonitorReportBot, STRReportBot
+    from report_bot.report_bot import ReportBot, OperaEmailQualityMonitorReportBot, STRReportBot
 
     TIME_NOW = dt.datetime.now().time()  # Jobs to run within specific time windows
 
+    # op_email_quality_daily rollup # Every run, if enabled. Only new, changed or removed Opera files are looked at.
+    if OperaEmailQualityMonitorReportBot.is_op_rollup_enabled():
+        rb = OperaEmailQualityMonitorReportBot()
+        try:
+            rb.update_op_daily_rollup()
+        except Exception as ex:  # Not fatal. The failure is recorded, and op_repeat_guest_monitor then reads the Opera files.
+            logger.error(ex)
+
+    # Opera store # Rebuilt once a day, before the Opera reports at 1pm, if enabled. The reports then read the store.
+    if dt.time(12, 30) <= TIME_NOW < dt.time(13, 0):
+        if OperaEmailQualityMonitorReportBot.is_op_store_enabled():
+            rb = OperaEmailQualityMonitorReportBot()
+            try:
+                rb.ingest_opera_store()
+            except Exception as ex:  # Not fatal. The previous store is left in place (it is only swapped once fully written).
+                logger.error(ex)
+
     # op_email_quality_monitor_weekly AND op_email_quality_monitor_monthly #
     # op_repeat_guest_monitor #
     # RUN TIME: 1) Weekly: Every Friday at 1pm; 2) Monthly: Every month at 1pm, on 3rd day of the month.
     if dt.time(13, 0) <= TIME_NOW < dt.time(13, 30):
-        if dt.datetime.today().day == 3:  # op_email_quality_monitor_monthly #
+        di_windows = {}  # Arrival date window of the reports due today. The Opera files are read once for all of its reports.
+        if dt.datetime.today().day == 3:
             # MONTHLY. Check that it's the 3rd day of the month. Send at same time as for WEEKLY.
             # Assume triggered run date is in following month. Take today's date, less 30 days, to get year and month from last month.
             year, month = dt.datetime.strftime(dt.datetime.today() - pd.Timedelta('30D'), fmt='%Y-%m').split('-')
             _, num_days_in_mth = calendar.monthrange(int(year), int(
                 month))  # https://stackoverflow.com/questions/36155332/how-to-get-the-first-day-and-last-day-of-current-month-in-python
-            str_dt_from = year + '-' + month + '-01'
-            str_dt_to = year + '-' + month + '-' + str(num_days_in_mth)
+            di_windows['monthly'] = (year + '-' + month + '-01', year + '-' + month + '-' + str(num_days_in_mth))
+        elif dt.datetime.today().weekday() == 4:  # WEEKLY. Friday. Not on the 3rd, which has the monthly reports only.
+            di_windows['weekly'] = (dt.datetime.strftime((dt.datetime.today() - pd.Timedelta('7D')), fmt='%Y-%m-%d'),
+                                    dt.datetime.strftime((dt.datetime.today() - pd.Timedelta('1D')), fmt='%Y-%m-%d'))
+
+        if di_windows:
+            rb = OperaEmailQualityMonitorReportBot()
+            try:
+                rb.get_windows(di_windows)  # Single scan of the Opera files. Each get() below takes the window from the run cache.
+            except Exception as ex:  # Not fatal. Each get() below will then read its own window.
+                logger.error(ex)
+
+        if 'monthly' in di_windows:  # op_email_quality_monitor_monthly #
+            str_dt_from, str_dt_to = di_windows['monthly']
             str_subject = '[op_email_quality_monitor_monthly] Arrival Date Period: {} to {}'.format(str_dt_from, str_dt_to)
             rb = OperaEmailQualityMonitorReportBot()
             rb.get(str_dt_from=str_dt_from, str_dt_to=str_dt_to)
             rb.send(str_listname='op_email_quality_monitor_monthly', str_subject=str_subject)
+            rb.save_email_quality_history()  # Keep the month's per-hotel results, for trend queries.
 
-            # op_repeat_guest_monitor #
-            # Assume triggered run date is in following month. Take today's date, less 30 days, to get year and month from last month.
-            year, month = dt.datetime.strftime(dt.datetime.today() - pd.Timedelta('30D'), fmt='%Y-%m').split('-')
-            _, num_days_in_mth = calendar.monthrange(int(year), int(
-                month))
-            str_dt_from = year + '-' + month + '-01'
-            str_dt_to = year + '-' + month + '-' + str(num_days_in_mth)
+            # op_repeat_guest_monitor # Same period as the monthly report.
             str_subject = '[op_repeat_guest_monitor] Arrival Date Period: {} to {}'.format(str_dt_from, str_dt_to)
+            # Counts come from the rollup table, if enabled and up to date. Otherwise it calls get(), which takes the Opera data
+            # of the same period as above from the run cache.
+            rb = OperaEmailQualityMonitorReportBot()
+            rb.send_op_repeat_guest_monitor(str_listname='op_repeat_guest_monitor', str_subject=str_subject,
+                                            str_dt_from=str_dt_from, str_dt_to=str_dt_to)
+
+        if 'weekly' in di_windows:  # op_email_quality_monitor_weekly #
+            str_dt_from, str_dt_to = di_windows['weekly']
+            str_subject = '[op_email_quality_monitor_weekly] Arrival Date Period: {} to {}'.format(str_dt_from, str_dt_to)
             rb = OperaEmailQualityMonitorReportBot()
             rb.get(str_dt_from=str_dt_from, str_dt_to=str_dt_to)
-            rb.send_op_repeat_guest_monitor(str_listname='op_repeat_guest_monitor', str_subject=str_subject)
-        else:  # op_email_quality_monitor_weekly #
-            if dt.datetime.today().weekday() == 4:  # Friday
-                str_dt_from = dt.datetime.strftime((dt.datetime.today() - pd.Timedelta('7D')), fmt='%Y-%m-%d')
-                str_dt_to = dt.datetime.strftime((dt.datetime.today() - pd.Timedelta('1D')), fmt='%Y-%m-%d')
-                str_subject = '[op_email_quality_monitor_weekly] Arrival Date Period: {} to {}'.format(str_dt_from, str_dt_to)
-                rb = OperaEmailQualityMonitorReportBot()
-                rb.get(str_dt_from=str_dt_from, str_dt_to=str_dt_to)
-                rb.send(str_listname='op_email_quality_monitor_weekly', str_subject=str_subject)
+            rb.send(str_listname='op_email_quality_monitor_weekly', str_subject=str_subject)
+        ReportBot.clear_run_cache()  # Opera datasets are not needed by the STR reports below.
 
     # str_perf_rpt # STR report. Weekly
     if dt.time(13, 0) <= TIME_NOW < dt.time(13, 30):  # Specified to run at 1pm.
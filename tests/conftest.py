@@ -0,0 +1,80 @@
+import os
+import sys
+import logging
+import sqlite3
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # For "report_bot" and "utils".
+
+from str_stand_in import StandInSTRServer, DI_HOTELS, USERID, PASSWORD
+from opera_stand_in import StandInSFTPServer, make_mapping_file
+
+
+@pytest.fixture
+def stand_in():
+    """ Local stand-in for STR ReportsOnline. See str_stand_in.py. """
+    with StandInSTRServer() as server:
+        yield server
+
+
+@pytest.fixture
+def str_rb(stand_in, tmp_path, monkeypatch):
+    """ STRReportBot, pointed at the stand-in. The MySQL databases are replaced by an in-memory SQLite database, holding
+    cfg_map_properties for the stand-in's hotels. Like a pymysql connection, it is not to be shared between threads.
+    Downloads go to tmp_path, and are not archived.
+    """
+    from configobj import ConfigObj
+    from report_bot.report_bot import STRReportBot
+
+    config = ConfigObj({'data_sources': {'str': {'url': stand_in.url, 'userid': USERID, 'password': PASSWORD,
+                                                 'download_root': str(tmp_path), 'page_timeout': '10',
+                                                 'min_job_interval': '0', 'archive_folder': ''}}})
+    monkeypatch.setattr(STRReportBot, 'config', config)
+
+    conn = sqlite3.connect(':memory:')  # Raises if used from another thread, as the workers of get_str_perf_parallel() must not.
+    pd.DataFrame([{'str_hotel_id': str_id, 'str_hotel_name': str_name, 'hotel_code': str_code, 'country': str_country,
+                   'operator': 'feh', 'asset_type': 'hotel'}
+                  for str_id, (str_name, str_code, str_country) in DI_HOTELS.items()]).to_sql('cfg_map_properties', conn,
+                                                                                             index=False)
+
+    rb = STRReportBot.__new__(STRReportBot)  # Without __init__(), which connects to the MySQL databases.
+    rb.logger = logging.getLogger('test_str_report_bot')
+    rb.db_fehdw_conn = conn
+    rb.db_listman_conn = conn
+    yield rb
+    rb.reset_str_download_folder()
+
+
+@pytest.fixture
+def sftp_server():
+    """ Local stand-in for the Opera SFTP server, with no files yet. See opera_stand_in.py. """
+    return StandInSFTPServer()
+
+
+@pytest.fixture
+def op_rb(sftp_server, tmp_path, monkeypatch):
+    """ OperaEmailQualityMonitorReportBot, reading the Opera files from the stand-in SFTP server. The local SFTP cache, the
+    labels cache and the Opera store are in tmp_path. The databases are replaced by an in-memory SQLite database.
+    """
+    from configobj import ConfigObj
+    from report_bot.report_bot import OperaEmailQualityMonitorReportBot
+
+    config = ConfigObj({'sftp': {'cache_folder': str(tmp_path / 'sftp_cache'), 'max_connections': '2'},
+                        'data_sources': {'opera': {'labels_cache': str(tmp_path / 'opera_labels_cache.json'),
+                                                   'store_folder': str(tmp_path / 'opera_store')}}})
+    make_mapping_file(str(tmp_path / 'opera_mapping.xlsx'))
+    monkeypatch.setattr(OperaEmailQualityMonitorReportBot, 'config', config)
+    monkeypatch.setattr(OperaEmailQualityMonitorReportBot, 'fn_op_mt', str(tmp_path / 'opera_mapping.xlsx'))
+    monkeypatch.setattr(OperaEmailQualityMonitorReportBot, 'di_op_labels', None)  # Loaded again, from the mapping file above.
+    monkeypatch.setattr(OperaEmailQualityMonitorReportBot, 'di_op_date_cache', {})
+    monkeypatch.setattr(OperaEmailQualityMonitorReportBot, 'open_sftp',
+                        lambda self, str_folder_remote=None: sftp_server.connect())
+
+    conn = sqlite3.connect(':memory:')
+    rb = OperaEmailQualityMonitorReportBot.__new__(OperaEmailQualityMonitorReportBot)  # Without __init__(). See str_rb().
+    rb.logger = logging.getLogger('test_opera_report_bot')
+    rb.db_fehdw_conn = conn
+    rb.db_listman_conn = conn
+    return rb
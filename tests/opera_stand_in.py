@@ -0,0 +1,99 @@
+""" Local stand-in for the Opera SFTP server, for the tests of OperaEmailQualityMonitorReportBot.
+Files are kept in memory, as {<filename>: (<content as bytes>, <mtime>)}, and served through the few pysftp calls the report
+bot makes: listdir_attr(), get(), open() and cwd(). make_opera_file() builds a file in the Opera text export layout, and
+make_mapping_file() the "Opera Text File mapping" Excel file for its column codes.
+Usage:
+    server = StandInSFTPServer()
+    server.put('a_Historical_1.txt', make_opera_file([{'confirmation_number': 1, 'arrival_date': '01-MAR-19'}]))
+    monkeypatch.setattr(OperaEmailQualityMonitorReportBot, 'open_sftp', lambda self, str_folder_remote=None: server.connect())
+"""
+import io
+import stat
+import threading
+import types
+
+import pandas as pd
+
+# Opera column codes of the stand-in files, and their names in the mapping file. 'C12' is a column no report uses.
+DI_OP_CODES = {'C1': 'Resort', 'C2': 'Confirmation Number', 'C3': 'Email', 'C4': 'First Name', 'C5': 'Last Name',
+               'C6': 'Market Code', 'C7': 'Rate Code', 'C8': 'Reservation Status', 'C9': 'Stayed Room Type', 'C10': 'VIP Code',
+               'C11': 'Arrival Date', 'C12': 'Other Stuff'}
+# Values of a booking which passes all the filters of prep_opera_df(). make_opera_file() starts each row from these.
+DI_OP_ROW = {'resort': 'HRS', 'confirmation_number': 1, 'email': 'guest@example.com', 'first_name': 'F', 'last_name': 'L',
+             'market_code': 'CORP', 'rate_code': 'BAR', 'reservation_status': 'CHECKED OUT', 'stayed_room_type': 'DLX',
+             'vip_code': ' ', 'arrival_date': '01-MAR-19', 'other_stuff': 'x'}
+
+
+def make_opera_file(l_rows):
+    """ An Opera text export, as bytes: 2 title lines, the header line of column codes, the rows, and 2 summary lines.
+    :param l_rows: List of dicts, over DI_OP_ROW. eg: [{'confirmation_number': 1, 'arrival_date': '01-MAR-19'}]
+    A blank value is ' ', as in the Opera files.
+    """
+    l_lines = ['Opera Historical Reservations', 'Printed 01-APR-19', '|'.join(DI_OP_CODES) + '|']
+    for di_row in l_rows:
+        di_row = dict(DI_OP_ROW, **di_row)
+        l_lines.append('|'.join(str(di_row[str_name.lower().replace(' ', '_')]) for str_name in DI_OP_CODES.values()) + '|')
+    l_lines += ['Total Reservations: {}'.format(len(l_rows)), 'End of Report']
+    return ('\r\n'.join(l_lines) + '\r\n').encode()
+
+
+def make_mapping_file(str_fn):
+    """ Writes the mapping Excel file for DI_OP_CODES, as read by OperaEmailQualityMonitorReportBot.get_op_labels(). """
+    df = pd.DataFrame([['Opera Text File mapping', None, None], ['Code', 'OperaFieldName', 'Remarks']] +
+                      [[str_code, str_name, None] for str_code, str_name in DI_OP_CODES.items()])
+    with pd.ExcelWriter(str_fn, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='Sheet2', header=False, index=False)
+
+
+class StandInRemoteFile(io.BytesIO):
+    """ A file opened with StandInSFTPConnection.open(). Has the extra calls of a paramiko SFTPFile which the report bot uses. """
+    def stat(self):
+        return types.SimpleNamespace(st_size=len(self.getvalue()))
+
+    def prefetch(self, file_size=None):
+        pass
+
+
+class StandInSFTPConnection(object):
+    def __init__(self, server):
+        self.server = server
+
+    def cwd(self, str_folder_remote):
+        pass
+
+    def listdir_attr(self):
+        with self.server.lock:
+            return [types.SimpleNamespace(filename=str_fn, st_size=len(data), st_mtime=i_mtime, st_mode=stat.S_IFREG | 0o644)
+                    for str_fn, (data, i_mtime) in sorted(self.server.di_files.items())]
+
+    def get(self, str_fn, localpath):
+        with open(localpath, 'wb') as fo:
+            fo.write(self.read(str_fn))
+
+    def open(self, str_fn, mode='rb', bufsize=-1):
+        return StandInRemoteFile(self.read(str_fn))
+
+    def read(self, str_fn):
+        with self.server.lock:
+            return self.server.di_files[str_fn][0]
+
+    def close(self):
+        pass
+
+
+class StandInSFTPServer(object):
+    """ Holds the files. Files are listed in filename order. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.di_files = {}
+
+    def put(self, str_fn, data, i_mtime=1):
+        with self.lock:
+            self.di_files[str_fn] = (data, i_mtime)
+
+    def remove(self, str_fn):
+        with self.lock:
+            del self.di_files[str_fn]
+
+    def connect(self):
+        return StandInSFTPConnection(self)
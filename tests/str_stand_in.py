@@ -0,0 +1,190 @@
+""" Local stand-in for STR ReportsOnline, for the tests of the STR report downloads.
+Serves a login page, a landing page with the link to the STAR reports, and the STAR report form (an ASP.NET form, with the
+same element ids as the real one). Submitting the form returns a fake STAR report, with the same layout as the real files
+(see STRReportBot.read_rpt_basic_perf_01()). The files are built with openpyxl, so they are XLSX, not XLS.
+pd.read_excel() tells the formats apart by their content, not by the file extension.
+The first metric of each report ("occ") is the start date of the report, as a number (eg: 20200101). So a test can tell
+which period a report was downloaded for.
+Usage:
+    with StandInSTRServer() as server:
+        config['data_sources']['str']['url'] = server.url
+"""
+import io
+import threading
+import uuid
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+USERID = 'test_user'
+PASSWORD = 'test_password'
+# Hotels of the stand-in. Format: {<str_hotel_id>: (<str_hotel_name>, <hotel_code>, <country>)}
+DI_HOTELS = {'101': ('Hotel Alpha', 'HA', 'SG'),
+             '102': ('Hotel Beta', 'HB', 'SG'),
+             '103': ('Hotel Gamma', 'HC', 'MY')}
+# Value of the industry segment option -> cell text of the report. See STRHttpClient.DI_IND_SEGMENTS.
+DI_IND_SEGMENTS = {'Market Class: Singapore - Upscale Class': 'Industry: Market Class: Singapore - Upscale',
+                   'Market Class: Singapore - Upper Upscale Class': 'Industry: Market Class: Singapore - Upper Upscale'}
+P = 'ctl00$ContentPlaceHolder1$'  # Name prefix of the report form elements.
+
+LOGIN_PAGE = '''<html><body>
+<form action="/Login.aspx?ReturnUrl=%2fReportsOnline.aspx" method="post">
+<input type="hidden" name="__RequestVerificationToken" value="tok" />
+<input id="username" name="UserName" type="text" />
+<input id="password" name="Password" type="password" />
+<input id="btnLogin" name="btnLogin" type="submit" value="Log in" />
+</form></body></html>'''
+
+LANDING_PAGE = '''<html><body>
+<ul><li id="menu-home"><a href="/ReportsOnline.aspx">Home</a></li><li id="menu-reports"><a href="/Star.aspx">STAR</a></li></ul>
+</body></html>'''
+
+
+def make_star_page(str_viewstate='VS1', str_segment=None):
+    """ The STAR report form. After a segment is selected (a postback), the page has the segment, and a new view state.
+    """
+    str_options = ''.join('<option value="{}">{}</option>'.format(str_id, tup[0]) for str_id, tup in DI_HOTELS.items())
+    str_segments = ''.join('<option value="{}">{}</option>'.format(x, x) for x in DI_IND_SEGMENTS)
+    str_segment = '' if str_segment is None else \
+        '<input type="hidden" name="{}hdnSegment" value="{}" />'.format(P, str_segment)
+    return '''<html><body>
+<form method="post" action="./Star.aspx" id="aspnetForm">
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{viewstate}" />{segment}
+<select name="ctl00$CensusID" id="ctl00_CensusID">{options}</select>
+<select name="{p}sProperty" id="ctl00_ContentPlaceHolder1_sProperty" multiple="multiple">{options}</select>
+<input id="ctl00_ContentPlaceHolder1_ckIncDups" type="checkbox" name="{p}ckIncDups" checked="checked" />
+<input id="ctl00_ContentPlaceHolder1_rbCompset" type="radio" name="{p}grpCompare" value="rbCompset" checked="checked" />
+<input id="ctl00_ContentPlaceHolder1_rbIndSegment" type="radio" name="{p}grpCompare" value="rbIndSegment" />
+<select name="{p}sSelectGrp2Segment" id="ctl00_ContentPlaceHolder1_sSelectGrp2Segment" multiple="multiple">{segments}</select>
+<input type="submit" name="{p}btnGrp2Select" value="&gt;" id="ctl00_ContentPlaceHolder1_btnGrp2Select" />
+<input name="{p}txtStartDate" type="text" value="" id="ctl00_ContentPlaceHolder1_txtStartDate" />
+<input name="{p}txtEndDate" type="text" value="" id="ctl00_ContentPlaceHolder1_txtEndDate" />
+<input type="submit" name="{p}btnSubmit2" value="Submit" id="ctl00_ContentPlaceHolder1_btnSubmit2" />
+</form></body></html>'''.format(viewstate=str_viewstate, segment=str_segment, options=str_options, segments=str_segments,
+                                p=P)
+
+
+def make_report(str_hotel_row, str_segment_row, i_metrics, str_dt_from):
+    """ A fake STAR report, as bytes. Row 2 names the hotel(s) (eg: 'Hotel Alpha #101'), row 3 the comparison set or segment.
+    From row 7, the daily table, with its "Period" line. i_metrics is the number of metric columns of the report type.
+    """
+    f_first = float(str_dt_from.replace('-', ''))  # eg: 20200101.0
+    df_top = pd.DataFrame([['STAR Report', None], [None, str_hotel_row], [None, str_segment_row],
+                           [None, None], [None, None], [None, None]])
+    df_table = pd.DataFrame([[str_dt_from] + [1.] * i_metrics,
+                             ['Period', f_first] + [float(i) for i in range(1, i_metrics)]],
+                            columns=['Date'] + ['m{}'.format(i) for i in range(i_metrics)])
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
+        df_top.to_excel(writer, header=False, index=False)
+        df_table.to_excel(writer, index=False, startrow=6)
+    return buf.getvalue()
+
+
+class StandInSTRServer(object):
+    """ Runs the stand-in on a free local port, in a background thread.
+    Each login starts a new session (cookie "sid"). drop_sessions() logs all of them out, as STR may do mid-run.
+    All form posts are kept in l_posts, as (<path>, {<name>: [<values>]}), for the tests to check.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.set_sessions = set()
+        self.i_logins = 0
+        self.l_posts = []
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.url = 'http://127.0.0.1:{}/ReportsOnline.aspx'.format(self.httpd.server_port)
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def drop_sessions(self):
+        with self.lock:
+            self.set_sessions.clear()
+
+    def get_posts(self, str_button):
+        """ Data of the form posts made by clicking str_button (eg: 'btnSubmit2'). """
+        with self.lock:
+            return [di_data for str_path, di_data in self.l_posts if P + str_button in di_data]
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def is_logged_in(self):
+                str_cookie = self.headers.get('Cookie') or ''
+                di_cookies = dict(x.strip().split('=', 1) for x in str_cookie.split(';') if '=' in x)
+                with server.lock:
+                    return di_cookies.get('sid') in server.set_sessions
+
+            def send(self, body, str_type='text/html; charset=utf-8', str_cookie=None):
+                body = body.encode() if isinstance(body, str) else body
+                self.send_response(200)
+                self.send_header('Content-Type', str_type)
+                self.send_header('Content-Length', str(len(body)))
+                if str_cookie is not None:
+                    self.send_header('Set-Cookie', str_cookie)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_report(self, body):
+                self.send(body, str_type='application/vnd.ms-excel')
+
+            def do_GET(self):
+                if not self.is_logged_in():
+                    return self.send(LOGIN_PAGE)
+                if self.path.startswith('/Star.aspx'):
+                    return self.send(make_star_page())
+                return self.send(LANDING_PAGE)
+
+            def do_POST(self):
+                str_body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+                di_data = urllib.parse.parse_qs(str_body, keep_blank_values=True)
+                with server.lock:
+                    server.l_posts.append((self.path, di_data))
+
+                if self.path.startswith('/Login.aspx'):
+                    if (di_data.get('UserName') == [USERID]) and (di_data.get('Password') == [PASSWORD]) \
+                            and (di_data.get('__RequestVerificationToken') == ['tok']):
+                        str_sid = uuid.uuid4().hex
+                        with server.lock:
+                            server.set_sessions.add(str_sid)
+                            server.i_logins += 1
+                        return self.send(LANDING_PAGE, str_cookie='sid={}; Path=/'.format(str_sid))
+                    return self.send(LOGIN_PAGE)
+                if not self.is_logged_in():
+                    return self.send(LOGIN_PAGE)
+
+                # STAR REPORT FORM. The view state must be posted back. #
+                if di_data.get('__VIEWSTATE') not in (['VS1'], ['VS2']):
+                    return self.send(make_star_page())
+                if P + 'btnGrp2Select' in di_data:  # Segment selection postback.
+                    return self.send(make_star_page('VS2', di_data[P + 'sSelectGrp2Segment'][0]))
+                if P + 'btnSubmit2' not in di_data:
+                    return self.send(make_star_page())
+                str_dt_from = di_data.get(P + 'txtStartDate', [''])[0]
+                if not str_dt_from:  # Validation error. The form is returned, as STR does.
+                    return self.send(make_star_page())
+
+                if di_data.get(P + 'grpCompare') == ['rbIndSegment']:
+                    str_hotels = ', '.join('{} #{}'.format(DI_HOTELS[x][0], x) for x in di_data[P + 'sProperty'])
+                    str_segment = DI_IND_SEGMENTS[di_data[P + 'hdnSegment'][0]]
+                    return self.send_report(make_report(str_hotels, str_segment, 12, str_dt_from))
+                if P + 'sProperty' in di_data:  # Portfolio ("ALL").
+                    str_hotels = ', '.join('{} #{}'.format(DI_HOTELS[x][0], x) for x in di_data[P + 'sProperty'])
+                    str_compset = 'Compset: Dups {}'.format('included' if P + 'ckIncDups' in di_data else 'excluded')
+                    return self.send_report(make_report(str_hotels, str_compset, 15, str_dt_from))
+                str_id = di_data['ctl00$CensusID'][0]
+                return self.send_report(make_report('{} #{}'.format(DI_HOTELS[str_id][0], str_id), 'Compset', 18, str_dt_from))
+
+        return Handler
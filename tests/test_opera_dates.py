@@ -0,0 +1,26 @@
+""" parse_opera_dates(), on Opera files read from the Opera SFTP stand-in. See opera_stand_in.py.
+"""
+import pandas as pd
+import pytest
+
+for str_module in ['configobj', 'jinja2', 'sqlalchemy', 'pysftp', 'selenium', 'openpyxl']:
+    pytest.importorskip(str_module)
+
+from opera_stand_in import make_opera_file
+
+
+@pytest.mark.parametrize('str_chunksize', ['0', '2'])
+def test_parse_opera_dates_filtered_rows(op_rb, sftp_server, str_chunksize):
+    op_rb.config['data_sources']['opera']['chunksize'] = str_chunksize
+    # The arrival date of a cancelled booking is never parsed, as the row is filtered away first. Even if it is not a date.
+    sftp_server.put('a_Historical_1.txt', make_opera_file([
+        {'confirmation_number': 1, 'arrival_date': '01-MAR-19'},
+        {'confirmation_number': 2, 'arrival_date': 'TBA', 'reservation_status': 'CANCELLED'},
+        {'confirmation_number': 3, 'arrival_date': '15-JAN-18'},
+        {'confirmation_number': 4, 'arrival_date': ' '}]))
+
+    df = op_rb.get_df_from_all_opera_files_sftp()
+    assert list(df['confirmation_number']) == [1, 3, 4]
+    assert list(df['arrival_date_dt'][:2]) == [pd.Timestamp('2019-03-01'), pd.Timestamp('2018-01-15')]
+    assert pd.isnull(df['arrival_date_dt'][2])  # Blank.
+    assert 'TBA' not in op_rb.di_op_date_cache
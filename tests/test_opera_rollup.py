@@ -0,0 +1,66 @@
+""" update_op_daily_rollup(), against the Opera SFTP stand-in. See opera_stand_in.py.
+After every update, the rollup table must be the same as a full rebuild from the files as they are then.
+"""
+import pandas as pd
+import pytest
+
+for str_module in ['configobj', 'jinja2', 'sqlalchemy', 'pysftp', 'selenium', 'openpyxl']:
+    pytest.importorskip(str_module)
+
+import sqlalchemy
+from opera_stand_in import make_opera_file
+
+
+@pytest.fixture
+def rollup_rb(op_rb):
+    """ op_rb, with fehdw on an SQLAlchemy connection to an in-memory SQLite database, for the writes of the rollup. """
+    op_rb.db_fehdw_conn = sqlalchemy.create_engine('sqlite://').connect()
+    return op_rb
+
+
+def get_rollup(rb):
+    """ Rollup table, as a list of (<resort>, <arrival date>, <n>, <n_blank>). """
+    str_table, _, _ = rb.get_op_rollup_tables()
+    df = pd.read_sql('SELECT * FROM {} ORDER BY resort, arrival_date'.format(str_table), rb.db_fehdw_conn)
+    return [(str_resort, str(pd.Timestamp(x).date()), int(i_n), int(i_blank))
+            for str_resort, x, i_n, i_blank in zip(df['resort'], df['arrival_date'], df['n'], df['n_blank'])]
+
+
+def get_full_rebuild(rb, str_table):
+    """ Rollup table from a first update into new tables str_table, from the files as they are now. """
+    di_opera = rb.config['data_sources']['opera']
+    di_opera['rollup_table'] = str_table
+    try:
+        rb.update_op_daily_rollup()
+        return get_rollup(rb)
+    finally:
+        del di_opera['rollup_table']
+
+
+def test_update_op_daily_rollup_moved_booking(rollup_rb, sftp_server):
+    rb = rollup_rb
+    sftp_server.put('a_Historical_1.txt', make_opera_file([{'confirmation_number': 1, 'arrival_date': '01-MAR-19'},
+                                                          {'confirmation_number': 2, 'arrival_date': '01-MAR-19', 'email': ' '}]))
+    rb.update_op_daily_rollup()
+    assert get_rollup(rb) == [('HRS', '2019-03-01', 2, 1)]
+
+    # Booking 1 moved to 10 MAR, in a later file. It stays counted at its first occurrence, on 1 MAR.
+    sftp_server.put('b_Historical_2.txt', make_opera_file([{'confirmation_number': 1, 'arrival_date': '10-MAR-19'},
+                                                          {'confirmation_number': 3, 'arrival_date': '10-MAR-19'}]))
+    rb.update_op_daily_rollup()
+    assert get_rollup(rb) == [('HRS', '2019-03-01', 2, 1), ('HRS', '2019-03-10', 1, 0)]
+    assert get_rollup(rb) == get_full_rebuild(rb, 'op_full_1')
+
+    # A new file, listed before the others, with booking 3 on 20 MAR. Its first occurrence moves there.
+    # 10 MAR is in none of the new or changed files, but loses booking 3.
+    sftp_server.put('0_Historical_0.txt', make_opera_file([{'confirmation_number': 3, 'arrival_date': '20-MAR-19'}]))
+    rb.update_op_daily_rollup()
+    assert get_rollup(rb) == [('HRS', '2019-03-01', 2, 1), ('HRS', '2019-03-20', 1, 0)]
+    assert get_rollup(rb) == get_full_rebuild(rb, 'op_full_2')
+
+    # The file with the first occurrence of booking 1 is removed. Booking 1 is then counted on 10 MAR, from the later file.
+    sftp_server.remove('a_Historical_1.txt')
+    rb.update_op_daily_rollup()
+    assert get_rollup(rb) == [('HRS', '2019-03-10', 1, 0), ('HRS', '2019-03-20', 1, 0)]
+    assert get_rollup(rb) == get_full_rebuild(rb, 'op_full_3')
+    assert rb.is_op_rollup_current()
@@ -0,0 +1,34 @@
+""" ingest_opera_store() and get_df_from_opera_store(), against the Opera SFTP stand-in. See opera_stand_in.py.
+"""
+import os
+
+import pandas as pd
+import pytest
+
+for str_module in ['configobj', 'jinja2', 'sqlalchemy', 'pysftp', 'selenium', 'openpyxl', 'pyarrow']:
+    pytest.importorskip(str_module)
+
+from opera_stand_in import make_opera_file
+
+
+def test_opera_store_blank_arrival_date(op_rb, sftp_server):
+    sftp_server.put('a_Historical_1.txt', make_opera_file([{'confirmation_number': 1, 'arrival_date': '01-MAR-19'},
+                                                          {'confirmation_number': 2, 'arrival_date': ' '},  # Blank.
+                                                          {'confirmation_number': 3, 'arrival_date': '15-JAN-18'}]))
+    sftp_server.put('b_Historical_2.txt', make_opera_file([{'confirmation_number': 1, 'arrival_date': '05-MAR-19'},
+                                                          {'confirmation_number': 4, 'arrival_date': '31-MAR-19'}]))
+    op_rb.ingest_opera_store()
+
+    # Integer partition names, as get_df_from_opera_store() looks them up. The row without an arrival date is not stored.
+    str_store_folder = op_rb.get_opera_store_folder()
+    assert sorted(os.listdir(str_store_folder)) == ['arrival_year=2018', 'arrival_year=2019']
+    assert os.listdir(os.path.join(str_store_folder, 'arrival_year=2018')) == ['arrival_month=1']
+    assert os.listdir(os.path.join(str_store_folder, 'arrival_year=2019')) == ['arrival_month=3']
+
+    # Same rows as from the files.
+    for str_dt_from, str_dt_to in [('2019-03-01', '2019-03-31'), ('2018-01-01', '2019-03-04')]:
+        df_store = op_rb.get_df_from_opera_store(str_dt_from=str_dt_from, str_dt_to=str_dt_to)
+        df_files = op_rb.get_df_from_all_opera_files_sftp(str_dt_from=str_dt_from, str_dt_to=str_dt_to)
+        assert len(df_store) > 0
+        assert list(df_store['confirmation_number']) == list(df_files['confirmation_number'])
+        assert list(df_store['arrival_date_dt']) == list(df_files['arrival_date_dt'])
@@ -0,0 +1,147 @@
+""" STRFormParser, STRHttpClient and get_str_perf_http(), against the STR stand-in. See str_stand_in.py.
+"""
+import pandas as pd
+import pytest
+
+for str_module in ['configobj', 'jinja2', 'sqlalchemy', 'pysftp', 'selenium', 'requests', 'openpyxl']:
+    pytest.importorskip(str_module)
+
+import str_stand_in
+from report_bot.report_bot import STRReportBot, STRFormParser, STRHttpClient, STRHttpError
+from str_stand_in import P, LOGIN_PAGE, LANDING_PAGE, make_star_page
+
+DI_PERIODS = {'P07D': ('2020-03-01', '2020-03-07'), 'MTD': ('2020-03-01', '2020-03-20')}
+
+
+def parse(str_html):
+    parser = STRFormParser()
+    parser.feed(str_html)
+    parser.close()
+    return parser
+
+
+def test_str_form_parser():
+    parser = parse(make_star_page())
+    assert len(parser.l_forms) == 1
+    form = parser.get_form('ctl00_ContentPlaceHolder1_btnSubmit2')
+    assert form['action'] == './Star.aspx'
+    # What a browser would post for the form as it is. Buttons, and unchecked checkboxes and radio buttons, are not posted.
+    assert form['fields'] == {'__VIEWSTATE': 'VS1',
+                              'ctl00$CensusID': '101',  # Single select defaults to its first option.
+                              P + 'sProperty': [],  # Multiselect, none selected.
+                              P + 'ckIncDups': 'on',  # Checked, with no value.
+                              P + 'grpCompare': 'rbCompset',
+                              P + 'sSelectGrp2Segment': [],
+                              P + 'txtStartDate': '',
+                              P + 'txtEndDate': ''}
+    assert form['ids']['ctl00_ContentPlaceHolder1_rbIndSegment'] == (P + 'grpCompare', 'rbIndSegment')
+    assert form['ids']['ctl00_ContentPlaceHolder1_btnSubmit2'] == (P + 'btnSubmit2', 'Submit')
+    assert form['options']['ctl00_ContentPlaceHolder1_sProperty'] == ['101', '102', '103']
+    assert parser.get_form('password') is None
+    assert parser.str_reports_href is None
+
+    parser = parse(LOGIN_PAGE)
+    assert parser.get_form('password')['fields'] == {'__RequestVerificationToken': 'tok', 'UserName': '', 'Password': ''}
+    assert parse(LANDING_PAGE).str_reports_href == '/Star.aspx'
+
+
+def test_post_form(str_rb, stand_in):
+    with STRHttpClient(str_rb) as client:
+        str_url, form = client.get_reports_form()
+        client.post_form(str_url, form, {'ctl00_ContentPlaceHolder1_rbIndSegment': True,  # Posts the element's own value.
+                                         'ctl00_ContentPlaceHolder1_ckIncDups': None,  # Unchecks.
+                                         'ctl00_ContentPlaceHolder1_sProperty': ['101', '102'],
+                                         'ctl00_ContentPlaceHolder1_txtEndDate': '2020-03-07'},
+                         'ctl00_ContentPlaceHolder1_btnSubmit2')
+
+    di_data, = stand_in.get_posts('btnSubmit2')
+    assert di_data['__VIEWSTATE'] == ['VS1']  # Hidden fields are posted back as is.
+    assert di_data[P + 'grpCompare'] == ['rbIndSegment']
+    assert P + 'ckIncDups' not in di_data
+    assert di_data[P + 'sProperty'] == ['101', '102']
+    assert di_data[P + 'txtEndDate'] == ['2020-03-07']
+    assert di_data[P + 'btnSubmit2'] == ['Submit']  # The button clicked, and no other.
+    assert P + 'btnGrp2Select' not in di_data
+
+
+def test_get_report_page_instead_of_file(str_rb, stand_in):
+    with STRHttpClient(str_rb) as client:
+        str_url, form = client.get_reports_form()
+        with pytest.raises(STRHttpError):
+            client.get_report(str_url, form, '', '', {})  # The stand-in returns the form, as for a validation error.
+
+
+def test_login_failed(str_rb, stand_in):
+    str_rb.config['data_sources']['str']['password'] = 'wrong'
+    with STRHttpClient(str_rb) as client:
+        with pytest.raises(STRHttpError):
+            client.get_reports_form()
+
+
+def test_session_dropped(str_rb, stand_in):
+    with STRHttpClient(str_rb) as client:
+        l_xls = client.download_rpt_basic_perf_01('2020-03-01', '2020-03-07')
+        stand_in.drop_sessions()  # STR logs us out.
+        bytes_xls = client.download_rpt_basic_perf_01a('2020-03-01', '2020-03-07')
+        assert client.i_logins == stand_in.i_logins == 2
+
+    assert len(l_xls) == len(str_stand_in.DI_HOTELS)
+    assert [str_rb.read_rpt_basic_perf_01(x, '2020-03-01', '2020-03-07', 'P07D')['hotel_code'][0] for x in l_xls] == \
+        ['HA', 'HB', 'HC']
+    assert str_rb.read_rpt_basic_perf_01(bytes_xls, '2020-03-01', '2020-03-07', 'P07D')['hotel_code'][0] == 'ALL'
+
+
+def test_get_str_perf_http(str_rb, stand_in):
+    df = str_rb.get_str_perf_http(DI_PERIODS)
+
+    assert stand_in.i_logins == 1  # One login for all reports of all periods.
+    assert list(df.columns) == list(STRReportBot.DI_STR_SCHEMA)
+    assert list(df['period_name'].cat.categories) == ['YTD', 'P90D', 'MTD', 'P07D']
+    assert list(zip(df['hotel_code'], df['period_name'])) == \
+        [(str_code, str_period_name) for str_code in sorted(['HA', 'HB', 'HC', 'ALL', 'ALL_UPSC', 'ALL_UPPER_UPSC'])
+         for str_period_name in ['MTD', 'P07D']]
+    for str_period_name, (str_dt_from, str_dt_to) in DI_PERIODS.items():
+        df_period = df[df['period_name'] == str_period_name]
+        assert (df_period['date_from'] == pd.Timestamp(str_dt_from)).all()
+        assert (df_period['occ'].astype(float) == float(str_dt_from.replace('-', ''))).all()  # See make_report().
+
+    # Portfolio and industry segment reports are on the Singapore hotels only. Portfolio reports exclude duplicates.
+    l_posts = [di_data for di_data in stand_in.get_posts('btnSubmit2') if P + 'sProperty' in di_data]
+    assert len(l_posts) == 3 * len(DI_PERIODS)
+    for di_data in l_posts:
+        assert di_data[P + 'sProperty'] == ['101', '102']
+        if di_data[P + 'grpCompare'] == ['rbCompset']:
+            assert P + 'ckIncDups' not in di_data
+
+
+@pytest.fixture
+def l_browser_runs(str_rb, monkeypatch):
+    """ Replaces the browser downloads with a stub, which records its calls. """
+    l_runs = []
+
+    def get_str_perf_parallel(self, di_periods):
+        l_runs.append(di_periods)
+        return 'browser'
+
+    str_rb.config['data_sources']['str']['client'] = 'http'
+    str_rb.config['data_sources']['str']['max_workers'] = '2'
+    monkeypatch.setattr(STRReportBot, 'get_str_perf_parallel', get_str_perf_parallel)
+    return l_runs
+
+
+def test_fallback_to_browser(str_rb, stand_in, l_browser_runs, monkeypatch):
+    monkeypatch.setattr(str_stand_in, 'make_star_page', lambda *args: '<html>New STR page</html>')  # STR changed its pages.
+
+    assert str_rb.get_str_perf_weekly() == 'browser'
+    assert str_rb.get_str_perf_monthly() == 'browser'  # Straight to the browser. HTTP is not tried again.
+    assert len(l_browser_runs) == 2
+    assert stand_in.i_logins == 1
+
+
+def test_no_fallback_on_other_errors(str_rb, l_browser_runs):
+    import requests
+
+    str_rb.config['data_sources']['str']['url'] = 'http://127.0.0.1:1/ReportsOnline.aspx'  # Nothing listens there.
+    with pytest.raises(requests.ConnectionError):
+        str_rb.get_str_perf_weekly()
+    assert l_browser_runs == []
@@ -0,0 +1,240 @@
+""" get_str_perf_parallel(), against the STR stand-in. See str_stand_in.py.
+No browser is started. Each STRSession gets a FakeBrowser instead of Chrome: the same webdriver calls, made on the stand-in's
+pages over HTTP. The downloads (download_rpt_basic_perf_01/01a/01b()), the sessions, the worker folders and the pool run as is.
+The database connection of str_rb raises if used from any thread but the one which opened it (see conftest.py), so a worker
+which touches the database fails the run.
+"""
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+for str_module in ['configobj', 'jinja2', 'sqlalchemy', 'pysftp', 'selenium', 'requests', 'openpyxl']:
+    pytest.importorskip(str_module)
+
+import report_bot.report_bot
+from report_bot.report_bot import STRReportBot, STRSession, STRHttpClient
+from str_stand_in import DI_HOTELS
+
+DI_PERIODS = {'P07D': ('2020-03-01', '2020-03-07'), 'MTD': ('2020-03-01', '2020-03-20')}
+ID_SUBMIT = 'ctl00_ContentPlaceHolder1_btnSubmit2'
+
+
+class FakeElement(object):
+    """ Element str_id of the page of a FakeBrowser. If str_value is given, its option of that value. """
+    def __init__(self, browser, str_id, str_value=None):
+        self.browser = browser
+        self.str_id = str_id
+        self.str_value = str_value
+
+    def find_element_by_xpath(self, str_xpath):  # eg: "option[@value='101']"
+        return self.browser.find_element_by_xpath('//*[@id="{}"]/{}'.format(self.str_id, str_xpath))
+
+    def click(self):
+        self.browser.click(self)
+
+    def double_click(self):
+        self.browser.di_values.setdefault(self.str_id, []).append(self.str_value)
+
+    def get_attribute(self, str_name):
+        assert str_name == 'checked'
+        return 'true' if self.browser.is_checked(self.str_id) else None
+
+    def clear(self):
+        self.browser.di_values[self.str_id] = ''
+
+    def send_keys(self, str_keys):
+        self.browser.di_values[self.str_id] = self.browser.di_values.get(self.str_id, '') + str_keys
+
+
+class FakeActionChains(object):
+    def __init__(self, driver):
+        self.l_actions = []
+
+    def double_click(self, el):
+        self.l_actions.append(el.double_click)
+        return self
+
+    def perform(self):
+        for action in self.l_actions:
+            action()
+
+
+class FakeBrowser(object):
+    """ Stands in for the Chrome webdriver of an STRSession. Pages are got and forms posted with an STRHttpClient, which keeps
+    the login. The values set on the page are kept in di_values, and posted on a button click, as STRHttpClient.post_form().
+    A report is saved into the session's download folder (through a partial download file, as Chrome does), and opens a new tab.
+    Each report is kept in l_downloads, as (<thread>, <download folder>, <start date>, <report type>, <argument>,
+    <hotel ids selected in the portfolio multiselect, or None>).
+    """
+    def __init__(self, session, l_downloads, lock):
+        self.session = session
+        self.l_downloads = l_downloads
+        self.lock = lock
+        self.client = STRHttpClient(session.str_rb)
+        self.l_handles = ['main']
+        self.current_window_handle = 'main'
+        self.switch_to = self
+        self.str_url, self.form, self.di_values, self.str_ind_seg = None, None, {}, None
+
+    @property
+    def window_handles(self):
+        return list(self.l_handles)
+
+    def window(self, str_handle):
+        self.current_window_handle = str_handle
+
+    def close(self):
+        self.l_handles.remove(self.current_window_handle)
+
+    def quit(self):
+        self.client.quit()
+
+    def get(self, str_url):
+        self.str_url, self.form, self.di_values, self.str_ind_seg = None, None, {}, None
+
+    def find_elements_by_xpath(self, str_xpath):
+        return []  # The stand-in's session is never dropped in these tests. So never on the login page.
+
+    def find_element_by_xpath(self, str_xpath):
+        from selenium.common.exceptions import NoSuchElementException
+
+        str_id = re.search(r'@id=[\'"]([^\'"]+)', str_xpath).group(1)
+        match = re.search(r'option\[@value=[\'"]([^\'"]+)', str_xpath)
+        if match is None:
+            return FakeElement(self, str_id)
+        if match.group(1) not in self.form['options'][str_id]:
+            raise NoSuchElementException(str_xpath)
+        return FakeElement(self, str_id, match.group(1))
+
+    def is_checked(self, str_id):
+        if str_id in self.di_values:
+            return self.di_values[str_id] is not None
+        return self.form['ids'][str_id][0] in self.form['fields']
+
+    def click(self, el):
+        if el.str_id == 'menu-reports':
+            self.str_url, self.form = self.client.get_reports_form()
+        elif el.str_value is not None:  # Option of a select.
+            self.di_values[el.str_id] = [el.str_value] if 'Segment' in el.str_id else el.str_value
+        elif el.str_id == 'ctl00_ContentPlaceHolder1_ckIncDups':
+            self.di_values[el.str_id] = None if self.is_checked(el.str_id) else True
+        elif el.str_id == 'ctl00_ContentPlaceHolder1_rbIndSegment':
+            self.di_values[el.str_id] = True
+        elif el.str_id == 'ctl00_ContentPlaceHolder1_btnGrp2Select':  # Postback. The page comes back with the segment added.
+            str_segment = self.di_values.pop('ctl00_ContentPlaceHolder1_sSelectGrp2Segment')[0]
+            self.str_ind_seg = {v: k for k, v in STRHttpClient.DI_IND_SEGMENTS.items()}[str_segment]
+            resp = self.client.post_form(self.str_url, self.form, dict(self.di_values,
+                                         ctl00_ContentPlaceHolder1_sSelectGrp2Segment=[str_segment]), el.str_id)
+            self.str_url, self.form = resp.url, self.client.parse(resp).get_form(ID_SUBMIT)
+        elif el.str_id == ID_SUBMIT:
+            self.submit()
+        else:
+            raise AssertionError('Unexpected click on {}'.format(el.str_id))
+
+    def submit(self):
+        resp = self.client.post_form(self.str_url, self.form, self.di_values, ID_SUBMIT)
+        assert 'html' not in resp.headers['Content-Type']
+
+        if self.str_ind_seg is not None:
+            str_type, arg = 'ind_seg', self.str_ind_seg
+        elif 'ctl00_ContentPlaceHolder1_sProperty' in self.di_values:
+            str_type, arg = 'all', None
+        else:
+            str_type, arg = 'property', self.di_values['ctl00_CensusID']
+        with self.lock:
+            self.l_downloads.append((threading.get_ident(), self.session.str_download_folder,
+                                     self.di_values['ctl00_ContentPlaceHolder1_txtStartDate'], str_type, arg,
+                                     self.di_values.get('ctl00_ContentPlaceHolder1_sProperty')))
+
+        str_fn = os.path.join(self.session.str_download_folder, 'STR_OnlineReport.xls')  # Same name for every report, as from STR.
+        with open(str_fn + '.crdownload', 'wb') as fo:
+            fo.write(resp.content)
+        os.rename(str_fn + '.crdownload', str_fn)
+        self.l_handles.append('report_{}'.format(len(self.l_downloads)))
+
+
+@pytest.fixture
+def l_downloads(str_rb, monkeypatch):
+    """ Replaces Chrome with a FakeBrowser, for all STRSessions. Returns the list of downloads. See FakeBrowser. """
+    l_downloads = []
+    lock = threading.Lock()
+
+    def start(self):
+        self.driver = FakeBrowser(self, l_downloads, lock)
+        self.i_logins += 1
+
+    monkeypatch.setattr(STRSession, 'start', start)
+    monkeypatch.setattr(STRReportBot, 'wait_for_xpath', lambda self, driver, str_xpath: driver.find_element_by_xpath(str_xpath))
+    monkeypatch.setattr(report_bot.report_bot, 'ActionChains', FakeActionChains)
+    return l_downloads
+
+
+def test_db_conn_is_main_thread_only(str_rb):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with pytest.raises(sqlite3.ProgrammingError):
+            executor.submit(str_rb.get_str_hotels).result()
+
+
+def test_get_str_perf_parallel(str_rb, l_downloads, tmp_path):
+    str_rb.config['data_sources']['str']['max_workers'] = '3'
+    str_rb.config['data_sources']['str']['archive_folder'] = str(tmp_path / 'archive')
+
+    df = str_rb.get_str_perf_parallel(DI_PERIODS)
+
+    # JOB SPLIT. Each hotel, the portfolio, and each industry segment, once for each period. #
+    ctr_jobs = Counter((str_dt_from, str_type, arg) for _, _, str_dt_from, str_type, arg, _ in l_downloads)
+    ctr_expected = Counter()
+    for str_dt_from, _ in DI_PERIODS.values():
+        ctr_expected.update([(str_dt_from, 'property', str_id) for str_id in DI_HOTELS])
+        ctr_expected.update([(str_dt_from, 'all', None), (str_dt_from, 'ind_seg', 'upscale'),
+                             (str_dt_from, 'ind_seg', 'upper_upscale')])
+    assert ctr_jobs == ctr_expected
+    # Portfolio and industry segment reports are on the Singapore hotels only, as read before the workers started.
+    assert all(l_ids == ['101', '102'] for _, _, _, str_type, _, l_ids in l_downloads if str_type != 'property')
+
+    # PER-WORKER FOLDERS. One folder for each worker thread, never shared, inside the run's download folder. #
+    di_folders = {}
+    for i_thread, str_folder, _, _, _, _ in l_downloads:
+        di_folders.setdefault(i_thread, set()).add(str_folder)
+    assert all(len(set_folders) == 1 for set_folders in di_folders.values())
+    l_folders = [set_folders.pop() for set_folders in di_folders.values()]
+    assert len(set(l_folders)) == len(l_folders) <= 3
+    str_run_folder = str_rb.get_str_download_folder()
+    for str_folder in l_folders:
+        assert os.path.basename(str_folder).startswith('worker_')
+        assert os.path.dirname(os.path.dirname(str_folder)) == str_run_folder
+    assert os.listdir(str_run_folder) == []  # Worker and period folders are removed after reading.
+    assert len(os.listdir(tmp_path / 'archive')) == sum(ctr_expected.values())  # Every download archived, none overwritten.
+
+    # RESULT FRAME. One row per report. Each row comes from a report for its own period. #
+    assert len(df) == sum(ctr_expected.values())
+    for str_period_name, (str_dt_from, str_dt_to) in DI_PERIODS.items():
+        df_period = df[df['period_name'] == str_period_name]
+        assert sorted(df_period['hotel_code']) == sorted(['HA', 'HB', 'HC', 'ALL', 'ALL_UPSC', 'ALL_UPPER_UPSC'])
+        assert (df_period['date_from'] == pd.Timestamp(str_dt_from)).all()
+        assert (df_period['date_to'] == pd.Timestamp(str_dt_to)).all()
+        assert (df_period['occ'].astype(float) == float(str_dt_from.replace('-', ''))).all()  # See make_report().
+    assert list(df.columns) == list(STRReportBot.DI_STR_SCHEMA)
+
+    # Same rows as the single-session download over HTTP. #
+    df_http = str_rb.get_str_perf_http(DI_PERIODS)
+    pd.testing.assert_frame_equal(df.reset_index(drop=True), df_http.reset_index(drop=True), check_dtype=False,
+                                  check_categorical=False)
+
+
+def test_get_str_archive_folder(str_rb, tmp_path, monkeypatch):
+    di_str = str_rb.config['data_sources']['str']
+    del di_str['archive_folder']
+    monkeypatch.chdir(tmp_path)  # Not a Windows drive here. So the default is made relative to tmp_path.
+    assert str_rb.get_str_archive_folder() == 'C:/Users/feh_admin/Downloads/temp'  # Same folder as before it was configurable.
+    assert os.path.isdir('C:/Users/feh_admin/Downloads/temp')
+
+    for str_folder in ['', 'None']:  # Explicitly off.
+        di_str['archive_folder'] = str_folder
+        assert str_rb.get_str_archive_folder() is None
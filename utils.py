@@ -1,13 +1,22 @@
 import os
 import re
 import sys
+import io
+import zipfile
 import datetime as dt
 import time
 import logging
+import numpy as np
 import pandas as pd
 from pandas import DataFrame, Series
+from pandas.api.types import union_categoricals
 from dateutil.relativedelta import relativedelta
 
+# Format of a technically valid email. Compiled once, for use by all webapps.
+RE_EMAIL = re.compile(r'[^@]+@[^@]+\.[^@]+')
+# Labels given by classify_emails(), in order of precedence.
+L_EMAIL_LABELS = ['blank', 'malformed', 'ota_proxy', 'valid']
+
 
 def dec_err_handler(retries=0):
     """
@@ -43,6 +52,150 @@ def dec_err_handler(retries=0):
     return wrap
 
 
+class UniqueKeyFilter(object):
+    """ Streaming "keep first" de-duplication on a key column, for DataFrames which arrive one at a time (eg: one per file).
+    Gives the same rows as concatenating all the DataFrames, then filtering with ~df[key].duplicated(keep='first').
+    Only the keys seen so far are held (as a Python set), not the duplicate rows. Each call costs time in proportion to the rows
+    of its own DataFrame, not to the number of keys seen so far.
+    Usage: kf = UniqueKeyFilter('confirmation_number'); then df = kf.filter(df) for each DataFrame, in order.
+    """
+    def __init__(self, str_key):
+        self.str_key = str_key
+        self.set_seen = set()
+
+    def filter(self, df):
+        """ Returns the rows of df whose key was not seen in this DataFrame or in any earlier one. Records the new keys.
+        """
+        l_keys = df[self.str_key].tolist()  # Python scalars, so that keys hash the same whatever their numpy dtype.
+        arr_keep = ~df[self.str_key].duplicated(keep='first').to_numpy()
+        arr_keep &= np.fromiter((key not in self.set_seen for key in l_keys), dtype=bool, count=len(l_keys))
+        self.set_seen.update(key for key, is_keep in zip(l_keys, arr_keep) if is_keep)
+        return df[arr_keep]
+
+    def __len__(self):
+        return len(self.set_seen)
+
+
+class FrameBuilder(object):
+    """ Accumulates DataFrame parts, and builds the final DataFrame with a single pd.concat() at the end.
+    Replaces "df_all = df_all.append(df)" in a loop, which copies all rows accumulated so far on every call (quadratic).
+    Usage: fb = FrameBuilder(di_schema=...); then fb.add(df) for each part; then df_all = fb.build().
+
+    :param di_schema: Optional dict of {<column name>: <dtype>}. Every part must have these columns, and they are cast to
+    the given dtype as each part is added (dtype None means the column must exist, but is not cast).
+    For 'category' columns, the categories of all parts are unioned at build(), so that the result stays categorical.
+    The built DataFrame has the schema columns first, in the given order, followed by any other columns.
+    :param downcast: If True, integer columns of each part are downcast to the smallest integer type that holds their values.
+    """
+    def __init__(self, di_schema=None, downcast=False):
+        self.di_schema = di_schema
+        self.downcast = downcast
+        self.l_parts = []
+
+    def add(self, df):
+        """ Adds a part. None is ignored, the same as DataFrame.append(None).
+        """
+        if df is None:
+            return
+
+        if self.di_schema is not None:
+            l_missing = [col for col in self.di_schema if col not in df.columns]
+            if l_missing:
+                raise KeyError('Columns missing from DataFrame part: {}'.format(l_missing))
+            di_cast = {col: dtype for col, dtype in self.di_schema.items() if (dtype is not None) and (df[col].dtype != dtype)}
+            if di_cast:
+                df = df.astype(di_cast)
+            df = df[list(self.di_schema) + [col for col in df.columns if col not in self.di_schema]]  # Also makes a copy.
+
+        if self.downcast:
+            di_downcast = {col: pd.to_numeric(df[col], downcast='integer') for col in df.select_dtypes(include='integer').columns}
+            if di_downcast:
+                df = df.assign(**di_downcast)
+
+        self.l_parts.append(df)
+
+    def build(self, ignore_index=True):
+        """ Returns the DataFrame of all parts added so far, and releases the parts.
+        If no parts were added, returns an empty DataFrame with the schema columns (if any).
+        """
+        if len(self.l_parts) == 0:
+            if self.di_schema is None:
+                return DataFrame()
+            return DataFrame({col: Series(dtype=dtype if dtype is not None else 'object') for col, dtype in self.di_schema.items()})
+
+        # Categorical schema columns: give all parts the same categories first, else pd.concat() falls back to object dtype.
+        for col in [col for col, dtype in (self.di_schema or {}).items() if dtype == 'category']:
+            idx_categories = union_categoricals([df[col] for df in self.l_parts]).categories
+            self.l_parts = [df.assign(**{col: df[col].cat.set_categories(idx_categories)}) for df in self.l_parts]
+
+        df = pd.concat(self.l_parts, ignore_index=ignore_index, sort=False)
+        self.l_parts = []
+        return df
+
+    def __len__(self):
+        return len(self.l_parts)
+
+
+def classify_emails(sr_email, l_ota_domains=None):
+    """ Labels every email in a Series in one vectorised pass. Rules are applied in order; the first that matches wins:
+    'blank': Empty, or missing (NaN).
+    'malformed': Does not match RE_EMAIL.
+    'ota_proxy': Domain (after the '@') is one of l_ota_domains, or a subdomain of one (case-insensitive).
+        eg: For 'booking.com', both 'xxx@booking.com' and 'xxx@guest.booking.com', but not 'booking.com@gmail.com' or 'x@notbooking.com'.
+    'valid': Everything else.
+
+    :param sr_email: Series of emails.
+    :param l_ota_domains: List of domains of OTAs which hide the guest's email behind a proxy. eg: ['booking.com', 'agoda-messaging.com'].
+    :return: Categorical Series of labels (categories are L_EMAIL_LABELS), with the same index as sr_email.
+    """
+    sr_email = sr_email.fillna('').astype(str)
+    sr_is_blank = sr_email == ''
+    sr_is_malformed = ~sr_email.str.match(RE_EMAIL)
+    if l_ota_domains:
+        # '@', then any subdomains, then an OTA domain at the end of the address (trailing spaces allowed, as Opera pads fields).
+        str_domains = '|'.join(re.escape(str_domain.strip()) for str_domain in l_ota_domains)
+        re_ota = re.compile(r'@(?:[^@]*\.)?(?:{})\s*$'.format(str_domains), flags=re.IGNORECASE)
+        sr_is_ota_proxy = sr_email.str.contains(re_ota)
+    else:
+        sr_is_ota_proxy = Series(False, index=sr_email.index)
+
+    arr_labels = np.select([sr_is_blank, sr_is_malformed, sr_is_ota_proxy], L_EMAIL_LABELS[:3], default=L_EMAIL_LABELS[3])
+    return Series(pd.Categorical(arr_labels, categories=L_EMAIL_LABELS), index=sr_email.index)
+
+
+def write_xlsx_streaming(df, str_fp):
+    """ Writes df to an XLSX file row by row, with xlsxwriter in constant_memory mode. Memory use does not grow with the row count.
+    (DataFrame.to_excel() keeps every cell in memory until the file is saved, and cannot use constant_memory because it writes column by column.)
+    Output looks like to_excel(index=False): bold header row, NaN/NaT as blank cells, datetimes as 'yyyy-mm-dd hh:mm:ss'.
+    :param df: DataFrame to write.
+    :param str_fp: Full path of the XLSX file to create.
+    :return: NA
+    """
+    import xlsxwriter  # Imported here, so that webapps which do not write XLSX files do not need it.
+
+    wb = xlsxwriter.Workbook(str_fp, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    ws = wb.add_worksheet()
+    ws.write_row(0, 0, [str(x) for x in df.columns], wb.add_format({'bold': True, 'border': 1, 'align': 'center'}))
+    for i_row, tup_row in enumerate(df.itertuples(index=False, name=None), start=1):
+        ws.write_row(i_row, 0, [None if ((x is pd.NaT) or (isinstance(x, float) and x != x)) else x for x in tup_row])  # x != x for NaN.
+    wb.close()
+
+
+def write_csv_zip(df, str_fp, str_fn_inner=None):
+    """ Writes df as a CSV file inside a ZIP archive (deflate compressed). The CSV is streamed into the archive, not built in memory.
+    :param df: DataFrame to write.
+    :param str_fp: Full path of the ZIP file to create.
+    :param str_fn_inner: Name of the CSV file inside the archive. Defaults to the ZIP filename, with extension '.csv'.
+    :return: NA
+    """
+    if str_fn_inner is None:
+        str_fn_inner = os.path.splitext(os.path.basename(str_fp))[0] + '.csv'
+    with zipfile.ZipFile(str_fp, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
+        with zf.open(str_fn_inner, mode='w') as fo:
+            with io.TextIOWrapper(fo, encoding='utf-8', newline='') as fo_text:
+                df.to_csv(fo_text, index=False)
+
+
 def get_date_ranges(str_dt_ref=None, l_periods=[]):
     """ Utility function to return pair-tuples of strings demarcating start_date and end_date of the requested period.
     Note: The period for "past N days" will not include current date. Eg: If today is 8 Jan, period of past 7 days will be 1 Jan to 7 Jan (INCLUSIVE of boundary dates).
@@ -130,6 +283,38 @@ def get_files(str_folder=None, pattern=None, latest_only=False):
         return get_latest_file(str_folder=str_folder, pattern=pattern)  # Note: The function will return a 2-values tuple!
 
 
+def wait_for_downloads(str_folder, i_count, pattern='xls$', f_timeout=120, f_poll=0.5):
+    """ Waits until a browser download is complete, instead of sleeping for a fixed time. Returns as soon as str_folder holds at least
+    i_count files matching pattern, with no partial download in the folder, and with every file's size unchanged since the last poll.
+    Partial downloads are the browser's temp files. eg: 'x.xls.crdownload' (Chrome), 'x.xls.part' (Firefox), '*.tmp'.
+    :param str_folder: Download folder.
+    :param i_count: Number of matching files expected, including those which were there before the download started.
+    :param pattern: A regex expression, to filter the list of files. Same as get_files().
+    :param f_timeout: Seconds to wait, before raising an Exception.
+    :param f_poll: Seconds between checks of the folder.
+    :return: List of tuples of (<full filename>, <filename>), as for get_files().
+    """
+    r_partial = re.compile(r'\.(crdownload|part|tmp)$')
+    f_time_end = time.time() + f_timeout
+    di_sizes_prev = None
+    while True:
+        l_fn = os.listdir(str_folder)
+        l_files = [(os.path.join(str_folder, fn), fn) for fn in l_fn if re.search(pattern, fn)]
+        if (len(l_files) >= i_count) and not any(r_partial.search(fn) for fn in l_fn):
+            try:
+                di_sizes = {fn: os.path.getsize(fp) for fp, fn in l_files}
+            except OSError:  # File was renamed between listdir() and getsize(). eg: Browser finishing the download.
+                di_sizes = None
+            if (di_sizes is not None) and (di_sizes == di_sizes_prev) and all(di_sizes.values()):
+                return l_files
+            di_sizes_prev = di_sizes
+        else:
+            di_sizes_prev = None
+        if time.time() > f_time_end:
+            raise Exception('[wait_for_downloads] Timed out after {}s, waiting for {} files in {}'.format(f_timeout, i_count, str_folder))
+        time.sleep(f_poll)
+
+
 def get_curr_time_as_string(format='%Y%m%d_%H%M', dt_date=None, leading_underscore=True):
     """ Returns current timestamp as a string.
     Convenience function. Timestamps are frequently used in filenames, to make them unique.